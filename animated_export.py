@@ -0,0 +1,447 @@
+# Streaming export of recordings to animated GIF, APNG and WebP
+#
+# Frames are decoded in small batches in recording order and written out straight away,
+# each one shown for its own header frameTime, so memory use does not grow with the recording length.
+
+import numpy as np
+
+from PIL import Image, GifImagePlugin
+
+import struct
+
+import zlib
+
+import binframe
+
+import rgb565
+
+import metrics
+
+
+supportedFormats = ("gif", "apng", "webp")
+fileExtensions = {"gif": "gif", "apng": "png", "webp": "webp"}
+
+# "sampled": one palette quantized from a sample of the frames, "fixed": one 3-3-2 palette for every recording,
+# "adaptive": a new palette for every frame (best colors, but slow and the colors can flicker between frames)
+gifPalettes = ("sampled", "fixed", "adaptive")
+
+
+def frame_duration(headerData:binframe.HeaderData, defaultFrameTime:int) -> int:
+    # A frameTime of 0 marks a screenshot or the last frame of a recording
+    if headerData["frameTime"] == 0:
+        return defaultFrameTime
+    return headerData["frameTime"]
+
+
+def decode_frames(frameIndex, defaultFrameTime:int, batchSize:int = 16):
+    """
+    Generator decoding the indexed frames in order, batchSize frames at a time with binframe.decode_stack().
+    The same output buffer is reused for every batch, so a frame has to be consumed before the next one is requested.
+
+    Yields:
+        tuple: (ndarray of shape (H, W, 3), dtype=uint8, duration in ms)
+    """
+    width, height = binframe.stack_resolution(frameIndex)
+    decoder = binframe.FrameDecoder(frameIndex)
+    buffer = np.empty((min(batchSize, len(frameIndex)), height, width, 3), dtype=np.uint8)
+    for batchStart in range(0, len(frameIndex), batchSize):
+        batchStop = min(batchStart + batchSize, len(frameIndex))
+        frames = binframe.decode_stack(frameIndex, batchStart, batchStop, out=buffer[:batchStop - batchStart], decoder=decoder)
+
+        for i, rgb in enumerate(frames):
+            yield rgb, frame_duration(frameIndex.header(batchStart + i), defaultFrameTime)
+
+
+def decode_raw_frames(frameIndex, defaultFrameTime:int, batchSize:int = 16):
+    """
+    Like decode_frames(), but yields the raw RGB565 data without converting it.
+
+    Yields:
+        tuple: (ndarray of shape (H, W), dtype='>u2', duration in ms)
+    """
+    width, height = binframe.stack_resolution(frameIndex)
+    decoder = binframe.FrameDecoder(frameIndex)
+    buffer = np.empty((min(batchSize, len(frameIndex)), height, width), dtype='>u2')
+    for batchStart in range(0, len(frameIndex), batchSize):
+        batchStop = min(batchStart + batchSize, len(frameIndex))
+        frames = binframe.read_raw_stack(frameIndex, batchStart, batchStop, buffer[:batchStop - batchStart], decoder)
+
+        for i, values565 in enumerate(frames):
+            yield values565, frame_duration(frameIndex.header(batchStart + i), defaultFrameTime)
+
+
+def palette_lookup_table(palette:bytes) -> np.ndarray:
+    """
+    Maps every RGB565 value to the index of the nearest color of a 256 color palette.
+    Returns:
+        ndarray: of shape (65536,), dtype=uint8
+    """
+    paletteImage = Image.new("P", (1, 1))
+    paletteImage.putpalette(palette)
+    # All 65536 colors in one image, mapped by Pillow's nearest color search without dithering
+    allColors = Image.fromarray(rgb565.get_lookup_table().reshape((256, 256, 3)), 'RGB')
+    indices = allColors.quantize(palette=paletteImage, dither=Image.Dither.NONE)
+    return np.asarray(indices, dtype=np.uint8).reshape(65536)
+
+
+def fixed_palette() -> tuple:
+    """
+    The 3-3-2 palette: 3 bits of red, 3 bits of green and 2 bits of blue per index.
+    Returns:
+        tuple: (palette of 768 bytes, lookup table from palette_lookup_table())
+    """
+    indices = np.arange(256)
+    colors = np.stack(((indices >> 5)*255//7, ((indices >> 2) & 7)*255//7, (indices & 3)*255//3), axis=1)
+    palette = colors.astype(np.uint8).tobytes()
+
+    # Rounding each channel to the nearest level equals the nearest color, so no search is needed
+    rgb = rgb565.get_lookup_table().astype(np.uint16)
+    lookupTable = ((rgb[:, 0]*7 + 127)//255 << 5) | ((rgb[:, 1]*7 + 127)//255 << 2) | ((rgb[:, 2]*3 + 127)//255)
+    return palette, lookupTable.astype(np.uint8)
+
+
+def sampled_palette(frameIndex, sampleFrames:int = 16) -> tuple:
+    """
+    Quantizes one palette from evenly spaced frames of the recording.
+    If the sampled frames use at most 256 colors, they become the palette unchanged.
+    Returns:
+        tuple: (palette of 768 bytes, lookup table from palette_lookup_table())
+    """
+    width, height = binframe.stack_resolution(frameIndex)
+    decoder = binframe.FrameDecoder(frameIndex)
+    positions = sorted(set(np.linspace(0, len(frameIndex) - 1, min(sampleFrames, len(frameIndex))).round().astype(int).tolist()))
+
+    counts = np.zeros(65536, dtype=np.int64)
+    values565 = np.empty((1, height, width), dtype='>u2')
+    for i in positions:
+        binframe.read_raw_stack(frameIndex, i, i + 1, values565, decoder)
+        counts += np.bincount(values565.reshape(-1), minlength=65536)
+
+    usedColors = np.flatnonzero(counts)
+    table = rgb565.get_lookup_table()
+    if len(usedColors) <= 256:
+        colors = np.zeros((256, 3), dtype=np.uint8)
+        colors[:len(usedColors)] = table[usedColors]
+        palette = colors.tobytes()
+    else:
+        # Every used color once, repeated in proportion to how often it was sampled (at most 64 times)
+        repeats = np.clip(counts[usedColors]*64//counts[usedColors].max(), 1, 64)
+        sample = np.repeat(table[usedColors], repeats, axis=0)
+        quantized = Image.fromarray(sample.reshape((1, len(sample), 3)), 'RGB').quantize(256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+        palette = bytes(quantized.getpalette("RGB")[:768]).ljust(768, b"\0")
+    return palette, palette_lookup_table(palette)
+
+
+class GifStreamWriter():
+    """
+    Writes a looping GIF frame by frame.
+    With a palette, the file gets one global color table and the frames are passed to add_indexed_frame() as palette indices.
+    Otherwise add_frame() gives every frame its own palette.
+    """
+    def __init__(self, path, palette:bytes = None):
+        self.palette = palette
+        self._file = open(path, 'wb')
+        self._headerWritten = False
+        # GIF delays are stored in 1/100 s, the rounding error is carried over to the following frames
+        self._elapsedMs = 0
+        self._writtenCs = 0
+
+    def add_frame(self, rgb:np.ndarray, duration:int):
+        frame = Image.fromarray(rgb, 'RGB').convert("P", palette=Image.Palette.ADAPTIVE)
+        self._write_frame(frame, duration, True)
+
+    def add_indexed_frame(self, indices:np.ndarray, duration:int):
+        """
+        Arguments:
+            indices (ndarray): of shape (H, W), dtype=uint8, indices into the palette of the writer
+        """
+        frame = Image.fromarray(indices)
+        frame.putpalette(self.palette)
+        self._write_frame(frame, duration, False)
+
+    def _write_frame(self, frame:Image.Image, duration:int, includeColorTable:bool):
+        if not self._headerWritten:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": 0})
+            self._file.write(b"".join(header))
+            self._headerWritten = True
+
+        self._elapsedMs += duration
+        # Most viewers replace delays below 2/100 s with a much longer default
+        delayCs = max(2, round(self._elapsedMs / 10) - self._writtenCs)
+        if delayCs > 0xFFFF:
+            # Longest possible delay, the rest of a very long merged pause is dropped instead of delaying the following frames
+            delayCs = 0xFFFF
+            self._elapsedMs = (self._writtenCs + delayCs)*10
+        self._writtenCs += delayCs
+
+        self._file.write(b"".join(GifImagePlugin.getdata(frame, duration=delayCs*10, include_color_table=includeColorTable)))
+
+    def close(self):
+        if not self._file.closed:
+            self._file.write(b";")
+            self._file.close()
+
+
+class ApngStreamWriter():
+    """
+    Writes a looping APNG frame by frame.
+    The frame count in the acTL chunk is patched in when the file is closed.
+    """
+    signature = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, path, width:int, height:int, compressLevel:int = 6):
+        self.width = width
+        self.height = height
+        self.compressLevel = compressLevel
+
+        self._frameCount = 0
+        self._sequenceNumber = 0
+        # Every row starts with a filter type byte, 0 means no filter
+        self._rows = np.zeros((height, 1 + width*3), dtype=np.uint8)
+
+        self._file = open(path, 'wb')
+        self._file.write(self.signature)
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self._actlPosition = self._file.tell()
+        self._write_chunk(b"acTL", struct.pack(">II", 0, 0))
+
+    def _write_chunk(self, chunkType:bytes, data:bytes):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunkType)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunkType))))
+
+    def add_frame(self, rgb:np.ndarray, duration:int):
+        if rgb.shape != (self.height, self.width, 3):
+            raise ValueError("All frames have to share one resolution")
+
+        self._rows[:, 1:] = rgb.reshape((self.height, self.width*3))
+        data = zlib.compress(self._rows, self.compressLevel)
+
+        # The delay is a fraction of seconds, ms / 1000 or for merged frames longer than 65 s 1/100 s
+        delay, delayDenominator = (duration, 1000) if duration <= 0xFFFF else (min(round(duration/10), 0xFFFF), 100)
+
+        # fcTL: sequence, size, offset, delay, dispose and blend operations
+        self._write_chunk(b"fcTL", struct.pack(
+            ">IIIIIHHBB", self._sequenceNumber, self.width, self.height, 0, 0, delay, delayDenominator, 0, 0
+        ))
+        self._sequenceNumber += 1
+
+        if self._frameCount == 0:
+            self._write_chunk(b"IDAT", data)
+        else:
+            self._write_chunk(b"fdAT", struct.pack(">I", self._sequenceNumber) + data)
+            self._sequenceNumber += 1
+
+        self._frameCount += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._write_chunk(b"IEND", b"")
+            self._file.seek(self._actlPosition)
+            self._write_chunk(b"acTL", struct.pack(">II", self._frameCount, 0))
+            self._file.close()
+
+
+class _RecordingImage(Image.Image):
+    """
+    Multi-frame image that decodes a frame only when it is seeked to.
+    Pillow's WebP encoder takes its frames one by one from it and keeps only the compressed data.
+    Arguments:
+        positions (list): optional, positions of the frames in the index that make up the animation
+        progressCallback (function): optional, called with (indexed frames before the decoded one, total indexed frames)
+            before every frame is decoded. If it raises (e.g. task_runner.TaskCancelled), the encoder stops.
+    """
+    def __init__(self, frameIndex, positions:list = None, progressCallback = None):
+        super().__init__()
+        self._decoder = binframe.FrameDecoder(frameIndex)
+        self._frameCount = len(frameIndex)
+        self._progressCallback = progressCallback
+        self._positions = positions if positions is not None else list(range(len(frameIndex)))
+        self._currentFrame = -1
+        self.n_frames = len(self._positions)
+        self.is_animated = self.n_frames > 1
+        self.seek(0)
+
+    def seek(self, frame:int):
+        if frame == self._currentFrame:
+            return
+        # Pillow seeks back to the first frame once it is done, which is not progress
+        if self._progressCallback is not None and frame > self._currentFrame:
+            self._progressCallback(self._positions[frame], self._frameCount)
+        decoded = self._decoder.to_image(self._positions[frame])
+        self.im = decoded.im
+        self._mode = decoded.mode
+        self._size = decoded.size
+        self._currentFrame = frame
+
+    def tell(self) -> int:
+        return self._currentFrame
+
+
+def unique_raw_frames(frameIndex, defaultFrameTime:int):
+    """
+    Generator yielding the raw data of the indexed frames in order. Consecutive identical frames (menus, pauses)
+    are merged into one frame shown for the sum of their durations. They are recognized by binframe.frame_digest()
+    before their data is copied, so they are not converted or encoded at all.
+    The yielded array has to be consumed before the next one is requested.
+
+    Yields:
+        tuple: (ndarray of shape (H, W), dtype='>u2', duration in ms, number of merged frames)
+    """
+    width, height = binframe.stack_resolution(frameIndex)
+    decoder = binframe.FrameDecoder(frameIndex)
+    # The pending frame stays in one buffer while the next frame is read into the other
+    buffers = [np.empty((height, width), dtype='>u2') for _ in range(2)]
+    pending = None
+    pendingDuration = 0
+    pendingCount = 0
+    digest = b""
+    for i in range(len(frameIndex)):
+        target = buffers[1] if pending is buffers[0] else buffers[0]
+        frameDigest = decoder.read_raw_into(i, target.view(np.uint8).reshape(-1), digest)
+        duration = frame_duration(frameIndex.header(i), defaultFrameTime)
+        if pending is not None and frameDigest == digest:
+            pendingDuration += duration
+            pendingCount += 1
+            metrics.registry.count("duplicate_frames")
+            continue
+
+        if pending is not None:
+            yield pending, pendingDuration, pendingCount
+        pending = target
+        pendingDuration = duration
+        pendingCount = 1
+        digest = frameDigest
+
+    if pending is not None:
+        yield pending, pendingDuration, pendingCount
+
+
+def unique_frame_runs(frameIndex, defaultFrameTime:int) -> list:
+    """
+    Finds the runs of consecutive identical frames, like unique_raw_frames() but without keeping their data.
+    Returns:
+        list: of (position of the first frame of the run, summed duration in ms)
+    """
+    width, height = binframe.stack_resolution(frameIndex)
+    decoder = binframe.FrameDecoder(frameIndex)
+    scratch = bytearray(width*height*2)
+    runs = []
+    digest = b""
+    for i in range(len(frameIndex)):
+        frameDigest = decoder.read_raw_into(i, scratch, digest)
+        duration = frame_duration(frameIndex.header(i), defaultFrameTime)
+        if len(runs) > 0 and frameDigest == digest:
+            runs[-1] = (runs[-1][0], runs[-1][1] + duration)
+            metrics.registry.count("duplicate_frames")
+        else:
+            runs.append((i, duration))
+            digest = frameDigest
+    return runs
+
+
+def export_animation(frameIndex, exportPath, format, defaultFrameTime:int = 25, progressCallback = None, gifPalette:str = "sampled", mergeDuplicates:bool = True) -> int:
+    """
+    Exports all indexed frames in order into one animated file.
+    Arguments:
+        frameIndex: binframe.FrameIndex or binframe_archive.BinFramesArchive
+        format (str): one of supportedFormats
+        defaultFrameTime (int): duration in ms for frames without a frameTime
+        progressCallback (function): optional, called with (exported frames, total frames)
+        gifPalette (str): one of gifPalettes, only used for GIF
+        mergeDuplicates (bool): write consecutive identical frames as one frame shown for the sum of their durations
+
+    Returns:
+        int: the number of frames in the exported file (lower than the number of indexed frames if duplicates were merged)
+    """
+    if len(frameIndex) == 0:
+        raise ValueError("There are no frames to export")
+
+    if format == "webp":
+        if mergeDuplicates:
+            runs = unique_frame_runs(frameIndex, defaultFrameTime)
+        else:
+            runs = [(i, frame_duration(frameIndex.header(i), defaultFrameTime)) for i in range(len(frameIndex))]
+        positions = [position for position, _ in runs]
+        durations = [duration for _, duration in runs]
+        _RecordingImage(frameIndex, positions, progressCallback).save(exportPath, format="WEBP", save_all=True, duration=durations, loop=0, lossless=True)
+        if progressCallback is not None:
+            progressCallback(len(frameIndex), len(frameIndex))
+        return len(runs)
+
+    if format == "gif" and gifPalette != "adaptive":
+        return export_indexed_gif(frameIndex, exportPath, defaultFrameTime, progressCallback, gifPalette, mergeDuplicates)
+
+    if format == "gif":
+        writer = GifStreamWriter(exportPath)
+    elif format == "apng":
+        headerData = frameIndex.header(0)
+        writer = ApngStreamWriter(exportPath, headerData["width"], headerData["height"])
+    else:
+        raise ValueError(f"Unsupported format: {format}")
+
+    writtenFrames = 0
+    doneFrames = 0
+    try:
+        if mergeDuplicates:
+            rgb = None
+            for values565, duration, frameCount in unique_raw_frames(frameIndex, defaultFrameTime):
+                with metrics.registry.timer("convert"):
+                    rgb = rgb565.rgb565_to_rgb888(values565, rgb)
+                with metrics.registry.timer("encode"):
+                    writer.add_frame(rgb, duration)
+                writtenFrames += 1
+                doneFrames += frameCount
+                if progressCallback is not None:
+                    progressCallback(doneFrames, len(frameIndex))
+        else:
+            for rgb, duration in decode_frames(frameIndex, defaultFrameTime):
+                with metrics.registry.timer("encode"):
+                    writer.add_frame(rgb, duration)
+                writtenFrames += 1
+                if progressCallback is not None:
+                    progressCallback(writtenFrames, len(frameIndex))
+    finally:
+        writer.close()
+    return writtenFrames
+
+
+def export_indexed_gif(frameIndex, exportPath, defaultFrameTime:int = 25, progressCallback = None, gifPalette:str = "sampled", mergeDuplicates:bool = True) -> int:
+    """
+    Exports a GIF with one palette for the whole recording. The raw RGB565 data of every frame is mapped to
+    palette indices with a single table lookup, so Pillow's quantizer is not run for every frame.
+    Returns:
+        int: the number of frames in the exported file
+    """
+    with metrics.registry.timer("palette"):
+        if gifPalette == "fixed":
+            palette, lookupTable = fixed_palette()
+        elif gifPalette == "sampled":
+            palette, lookupTable = sampled_palette(frameIndex)
+        else:
+            raise ValueError(f"Unsupported GIF palette: {gifPalette}")
+
+    if mergeDuplicates:
+        frames = unique_raw_frames(frameIndex, defaultFrameTime)
+    else:
+        frames = ((values565, duration, 1) for values565, duration in decode_raw_frames(frameIndex, defaultFrameTime))
+
+    writer = GifStreamWriter(exportPath, palette)
+    indices = None
+    writtenFrames = 0
+    doneFrames = 0
+    try:
+        for values565, duration, frameCount in frames:
+            with metrics.registry.timer("encode"):
+                if indices is None:
+                    indices = np.empty(values565.shape, dtype=np.uint8)
+                np.take(lookupTable, values565, out=indices)
+                writer.add_indexed_frame(indices, duration)
+            writtenFrames += 1
+            doneFrames += frameCount
+            if progressCallback is not None:
+                progressCallback(doneFrames, len(frameIndex))
+    finally:
+        writer.close()
+    return writtenFrames
@@ -0,0 +1,179 @@
+# Headless exporter that converts a whole directory of .binFrame files (or a .binFrames archive) using all CPU cores
+#
+# Usage: python batch_export.py <input directory or archive> <output directory> [-f png|bmp|gif|apng|webp|npy] [--gif-palette sampled|fixed|adaptive] [--keep-duplicates] [-j workers]
+# Still images are exported in parallel, animated formats are streamed into one file (runs of identical frames become one longer frame).
+# npy writes all frames into one NumPy array of shape (N, H, W, 3), e.g. for analysis scripts or datasets.
+
+import argparse
+
+import os
+
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import binframe
+
+import animated_export
+
+import metrics
+
+
+supportedFormats = ("png", "bmp")
+stackFormats = ("npy",)
+
+
+def export_path(path, outputDirectory, format) -> str:
+    return outputDirectory + "/" + str(path).split("/")[-1][:-8] + format
+
+
+# Decoder of this worker process, set up once by init_worker().
+# Every worker gets consecutive frames, so its decoder applies delta frames in order.
+_workerDecoder = None
+
+
+def init_worker(source, paths):
+    """
+    Runs once in every worker process.
+    Arguments:
+        source: path of the archive, None for a directory
+        paths (list): the frame paths of the parent's directory index, None for an archive.
+            The workers use exactly these paths in this order instead of listing the directory again, so a frame is never
+            exported under the name of another one if the directory changes meanwhile, and they never write its index cache.
+    """
+    global _workerDecoder
+    frameIndex = binframe.FrameIndex.from_paths(paths) if paths is not None else binframe.open_frames(source)
+    _workerDecoder = binframe.FrameDecoder(frameIndex)
+
+
+def export_file(job) -> tuple:
+    """
+    Worker function run inside the process pool.
+    Arguments:
+        job (tuple): (position of the frame, export path)
+
+    Returns:
+        tuple: (export path, error message or None, seconds spent on the frame)
+    """
+    frameNumber, exportPath = job
+    startTime = time.perf_counter()
+    try:
+        _workerDecoder.to_image(frameNumber).save(exportPath)
+    except (ValueError, OSError, EOFError) as e:
+        return (exportPath, str(e), time.perf_counter() - startTime)
+    return (exportPath, None, time.perf_counter() - startTime)
+
+
+def export_frames(frameIndex, outputDirectory, format, workers:int = None, progressCallback = None, mpContext = None) -> tuple:
+    """
+    Exports every frame of a directory index or an archive in parallel.
+    Arguments:
+        progressCallback (function): optional, called with (finished frames, total frames).
+            If it raises, the remaining frames are cancelled and the exception is passed on.
+        mpContext: optional multiprocessing context for the worker processes
+    Returns:
+        tuple: (number of exported frames, list of (export path, error) for failed frames, elapsed seconds)
+    """
+    if format not in supportedFormats:
+        raise ValueError(f"Unsupported format: {format}")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if isinstance(frameIndex, binframe.FrameIndex):
+        initArgs = (None, list(frameIndex.paths))
+    else:
+        initArgs = (frameIndex.path, None)
+    jobs = [(i, export_path(path, outputDirectory, format)) for i, path in enumerate(frameIndex.paths)]
+    # Send the jobs in chunks so thousands of small files do not cost one IPC round trip each
+    chunkSize = max(1, min(64, len(jobs) // (workers * 4)))
+
+    failed = []
+    startTime = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mpContext, initializer=init_worker, initargs=initArgs)
+    try:
+        for finished, (path, error, seconds) in enumerate(executor.map(export_file, jobs, chunksize=chunkSize)):
+            # The workers are separate processes, so their timings are collected here
+            metrics.registry.record("export_frame", seconds)
+            if error is not None:
+                failed.append((path, error))
+                metrics.registry.count("export_errors")
+            else:
+                metrics.registry.count("frames_exported")
+            if progressCallback is not None:
+                progressCallback(finished + 1, len(jobs))
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - startTime
+
+    return (len(jobs) - len(failed), failed, elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a directory of .binFrame files or a .binFrames archive without the GUI.")
+    parser.add_argument("input", help="directory with .binFrame files or a .binFrames archive")
+    parser.add_argument("output", help="directory to export the images to")
+    parser.add_argument("-f", "--format", choices=supportedFormats + animated_export.supportedFormats + stackFormats, default=supportedFormats[0])
+    parser.add_argument("--gif-palette", choices=animated_export.gifPalettes, default=animated_export.gifPalettes[0], help="GIF only: one palette sampled from the recording, the fixed 3-3-2 palette or a palette per frame")
+    parser.add_argument("--keep-duplicates", action="store_true", help="animated formats only: write consecutive identical frames separately instead of merging them into one longer frame")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes, threads for npy (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    try:
+        frameIndex = binframe.open_frames(args.input)
+    except (ValueError, OSError) as e:
+        print(f"Cannot open {args.input}: {e}")
+        return 1
+    if len(frameIndex) == 0:
+        print("There were no supported files in the input.")
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+    metricsWriter = metrics.start_writer_from_environment()
+    try:
+        return run_export(frameIndex, args)
+    finally:
+        if metricsWriter is not None:
+            metricsWriter.stop()
+
+
+def run_export(frameIndex, args) -> int:
+    if args.format in stackFormats:
+        exportPath = export_path(frameIndex.paths[0], args.output, args.format)
+        startTime = time.perf_counter()
+        try:
+            stack = binframe.save_stack(frameIndex, exportPath, workers=args.workers)
+        except (ValueError, OSError, EOFError) as e:
+            print(f"Failed to export {exportPath}: {e}")
+            return 1
+        elapsed = time.perf_counter() - startTime
+        print(f"Exported {len(frameIndex)} frames as an array of shape {stack.shape} to {exportPath} in {elapsed:.3f} s ({len(frameIndex)/max(elapsed, 1e-9):.1f} frames/s)")
+        return 0
+
+    if args.format in animated_export.supportedFormats:
+        exportPath = export_path(frameIndex.paths[0], args.output, animated_export.fileExtensions[args.format])
+        startTime = time.perf_counter()
+        try:
+            writtenFrames = animated_export.export_animation(frameIndex, exportPath, args.format, gifPalette=args.gif_palette, mergeDuplicates=not args.keep_duplicates)
+        except (ValueError, OSError, EOFError) as e:
+            print(f"Failed to export {exportPath}: {e}")
+            return 1
+        elapsed = time.perf_counter() - startTime
+        print(f"Exported {len(frameIndex)} frames to {exportPath} in {elapsed:.3f} s ({len(frameIndex)/max(elapsed, 1e-9):.1f} frames/s)")
+        if writtenFrames < len(frameIndex):
+            print(f"{len(frameIndex) - writtenFrames} duplicate frames were merged into the frames before them instead of being decoded again")
+        return 0
+
+    exported, failed, elapsed = export_frames(frameIndex, args.output, args.format, args.workers)
+
+    for path, error in failed:
+        print(f"Failed to export {path}: {error}")
+
+    print(f"Exported {exported}/{len(frameIndex)} frames in {elapsed:.3f} s ({exported/max(elapsed, 1e-9):.1f} frames/s)")
+    return 0 if len(failed) == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
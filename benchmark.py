@@ -0,0 +1,578 @@
+# Benchmarks of the hot paths, on a synthetic .binFrame corpus and a fake GamePico on a pseudo terminal
+#
+# Usage: python benchmark.py run [-o results.json] [--quick] [--only name ...] [--compare previous.json]
+#        python benchmark.py generate <directory> [--count N] [--size WxH] [--content gradient|noise|static] [--gzip LEVEL]
+#
+# The results are written as JSON, so runs on different versions or machines can be compared with --compare.
+
+import argparse
+
+import gzip
+
+import json
+
+import os
+
+import platform
+
+import tempfile
+
+import threading
+
+import time
+
+import zlib
+
+import numpy as np
+
+import PIL
+from PIL import Image
+
+import binframe
+
+import rgb565
+
+import pixel_formats
+
+
+contentTypes = ("gradient", "noise", "static")
+
+
+def generate_content(content:str, width:int, height:int, frameNumber:int, rng:np.random.Generator) -> bytes:
+    """
+    Returns the raw big-endian RGB565 data of one synthetic frame.
+    Arguments:
+        content (str): "gradient" (smooth, changes every frame), "noise" (incompressible) or
+            "static" (a fixed background with a small moving sprite, like most game screens)
+    """
+    if content == "noise":
+        return rng.integers(0, 65536, width*height, dtype=np.uint16).astype('>u2').tobytes()
+
+    y, x = np.mgrid[0:height, 0:width]
+    if content == "gradient":
+        shift = frameNumber
+    elif content == "static":
+        shift = 0
+    else:
+        raise ValueError(f"Unknown content: {content}")
+    red = ((x + shift)*31//max(width - 1, 1)) & 0x1F
+    green = ((y + shift)*63//max(height - 1, 1)) & 0x3F
+    blue = ((x + y)*31//max(width + height - 2, 1)) & 0x1F
+    values565 = ((red << 11) | (green << 5) | blue).astype('>u2')
+
+    if content == "static":
+        spriteX = (frameNumber*3) % max(width - 24, 1)
+        spriteY = (frameNumber*2) % max(height - 24, 1)
+        values565[spriteY:spriteY + 24, spriteX:spriteX + 24] = 0xF800
+    return values565.tobytes()
+
+
+def generate_corpus(directory, count:int = 100, width:int = 240, height:int = 240, content:str = "static", compressLevel:int = None, seed:int = 0) -> list:
+    """
+    Writes a recording of synthetic V1 .binFrame files with sequential ids and a frameTime of 40 ms.
+    Returns:
+        list: the paths of the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        payload = generate_content(content, width, height, i, rng)
+        wbits = None
+        if compressLevel is not None:
+            wbits = 31
+            compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, wbits)
+            payload = compressor.compress(payload) + compressor.flush()
+
+        path = f"{directory}/frame_{i:06d}.binFrame"
+        with open(path, 'wb') as f:
+            f.write(binframe.pack_header(width, height, i, 40 if i < count - 1 else 0, wbits))
+            f.write(payload)
+        paths.append(path)
+    return paths
+
+
+def measure(function, iterations:int, warmup:int = 1) -> dict:
+    for _ in range(warmup):
+        function()
+
+    times = []
+    for _ in range(iterations):
+        startTime = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - startTime)
+    times.sort()
+
+    return {
+        "iterations": iterations,
+        "mean_ms": sum(times)/len(times)*1000,
+        "median_ms": times[len(times)//2]*1000,
+        "min_ms": times[0]*1000,
+    }
+
+
+class Corpora():
+    """
+    Creates the corpora lazily in a working directory, so a benchmark only pays for the corpora it uses.
+    """
+    def __init__(self, directory, frameCount:int):
+        self.directory = directory
+        self.frameCount = frameCount
+        self._directories = {}
+
+    def get(self, content:str, compressLevel:int = None, count:int = None, width:int = 240, height:int = 240) -> str:
+        count = count or self.frameCount
+        name = f"{content}_{'gzip' + str(compressLevel) if compressLevel is not None else 'raw'}_{count}_{width}x{height}"
+        if name not in self._directories:
+            generate_corpus(f"{self.directory}/{name}", count, width, height, content, compressLevel)
+            self._directories[name] = f"{self.directory}/{name}"
+        return self._directories[name]
+
+
+def bench_header_parsing(corpora:Corpora, quick:bool) -> dict:
+    directory = corpora.get("static")
+    paths = binframe.list_binframe_files(directory)
+    with open(paths[0], 'rb') as f:
+        headerBytes = f.read(binframe.headerLengthV1)
+
+    results = {}
+    results["parse_header"] = measure(lambda: binframe.parse_header(headerBytes), 2000 if quick else 20000, warmup=100)
+    results["read_file_header_per_file"] = measure(lambda: [binframe.read_file_header(path) for path in paths], 3 if quick else 10)
+    results["read_file_header_per_file"]["per_file_ms"] = results["read_file_header_per_file"]["median_ms"]/len(paths)
+    return results
+
+
+def bench_gzip_decode(corpora:Corpora, quick:bool) -> dict:
+    results = {}
+    for content in contentTypes:
+        path = binframe.list_binframe_files(corpora.get(content, compressLevel=6))[0]
+        with open(path, 'rb') as f:
+            data = f.read()
+        payload = data[binframe.headerLengthV1:]
+        results[content] = measure(lambda: gzip.decompress(payload), 20 if quick else 200)
+        results[content]["compressed_bytes"] = len(payload)
+        # Streamed into a preallocated buffer, as done by binframe
+        out = bytearray(240*240*2)
+        results[f"{content}_decompress_into"] = measure(lambda: binframe.decompress_into(payload, out, 31), 20 if quick else 200)
+    return results
+
+
+def bench_color_convert(corpora:Corpora, quick:bool) -> dict:
+    rng = np.random.default_rng(0)
+    values565 = np.frombuffer(generate_content("noise", 240, 240, 0, rng), dtype='>u2').reshape((240, 240))
+    out = np.empty((240, 240, 3), dtype=np.uint8)
+    rgb565.get_lookup_table()
+
+    iterations = 50 if quick else 500
+    results = {
+        "color_array_convert": measure(lambda: binframe.color_array_convert(values565), iterations),
+        "color_array_convert_preallocated": measure(lambda: binframe.color_array_convert(values565, out), iterations),
+        "formula_reference": measure(lambda: rgb565.formula_convert(values565), iterations),
+    }
+
+    # Every pixel format of V2 frames, with random data and a full palette
+    for pixelFormat in pixel_formats.formats.values():
+        palette = rng.integers(0, 65536, pixelFormat.paletteSize, dtype=np.uint16).astype('>u2').tobytes()
+        rawData = rng.integers(0, 256, pixelFormat.frame_size(240, 240), dtype=np.uint8).tobytes()
+        results[f"{pixelFormat.name}_to_rgb888"] = measure(lambda: pixelFormat.to_rgb888(rawData, 240, 240, palette, out), iterations)
+    return results
+
+
+def bench_convert_image(corpora:Corpora, quick:bool) -> dict:
+    import frame_renderer
+
+    rawData = generate_content("gradient", 240, 240, 0, np.random.default_rng(0))
+    iterations = 50 if quick else 500
+    renderer = frame_renderer.FrameRenderer(3)
+    return {
+        "convert_image": measure(lambda: binframe.convert_image(rawData, 240, 240), iterations),
+        # The live view before and after the preallocated renderer, at the default scale of 3
+        "convert_and_resize_x3": measure(lambda: binframe.convert_image(rawData, 240, 240).resize((720, 720), Image.Resampling.NEAREST), iterations),
+        "renderer_prepare_x3": measure(lambda: renderer.prepare(rawData, 240, 240), iterations),
+        "load_image_raw": measure(lambda: binframe.load_image(binframe.list_binframe_files(corpora.get("static"))[0]), iterations),
+        "load_image_gzip": measure(lambda: binframe.load_image(binframe.list_binframe_files(corpora.get("static", 6))[0]), iterations),
+    }
+
+
+def bench_directory_loading(corpora:Corpora, quick:bool) -> dict:
+    # Small compressed frames, so the corpus has many files without taking much space
+    count = 300 if quick else 3000
+    directory = corpora.get("static", compressLevel=9, count=count)
+
+    def load_with_headers():
+        frameIndex = binframe.FrameIndex(directory, useCache=False)
+        for i in range(len(frameIndex)):
+            frameIndex.header(i)
+
+    iterations = 3 if quick else 10
+    results = {
+        "files": count,
+        "list_directory": measure(lambda: binframe.list_binframe_files(directory), iterations),
+        "index_without_cache": measure(lambda: binframe.FrameIndex(directory, useCache=False), iterations),
+        "index_and_headers_without_cache": measure(load_with_headers, iterations),
+    }
+
+    # The corpus was just written, so its mtime is too recent to be trusted and the directory would be listed every time
+    binframe.FrameIndex(directory).close()
+    pastTime_ns = time.time_ns() - 10*binframe.racyInterval_ns
+    os.utime(directory, ns=(pastTime_ns, pastTime_ns))
+    binframe.FrameIndex(directory).close()
+    frameIndex = binframe.FrameIndex(directory)
+    lastPath = frameIndex.paths[-1]
+    results["index_from_cache"] = measure(lambda: binframe.FrameIndex(directory), iterations)
+    results["refresh_unchanged"] = measure(frameIndex.refresh, iterations*100)
+    results["index_of"] = measure(lambda: frameIndex.index_of(lastPath), iterations*100)
+
+    import frame_fsck
+
+    for workers in sorted({1, os.cpu_count() or 1}):
+        startTime = time.perf_counter()
+        frame_fsck.check_source(directory, workers)
+        elapsed = time.perf_counter() - startTime
+        results[f"fsck_{workers}_workers"] = {"seconds": elapsed, "frames_per_s": count/elapsed}
+    return results
+
+
+def bench_export(corpora:Corpora, quick:bool) -> dict:
+    import animated_export
+    import batch_export
+
+    count = 30 if quick else 200
+    frameIndex = binframe.FrameIndex(corpora.get("static", compressLevel=6, count=count))
+    results = {"frames": count}
+    with tempfile.TemporaryDirectory() as outputDirectory:
+        for workers in sorted({1, os.cpu_count() or 1}):
+            startTime = time.perf_counter()
+            batch_export.export_frames(frameIndex, outputDirectory, "png", workers)
+            elapsed = time.perf_counter() - startTime
+            results[f"png_{workers}_workers"] = {"seconds": elapsed, "frames_per_s": count/elapsed}
+
+        for gifPalette in animated_export.gifPalettes:
+            startTime = time.perf_counter()
+            animated_export.export_animation(frameIndex, f"{outputDirectory}/recording.gif", "gif", gifPalette=gifPalette)
+            elapsed = time.perf_counter() - startTime
+            results[f"gif_{gifPalette}"] = {"seconds": elapsed, "frames_per_s": count/elapsed}
+
+        startTime = time.perf_counter()
+        binframe.save_stack(frameIndex, f"{outputDirectory}/recording.npy")
+        elapsed = time.perf_counter() - startTime
+        results["npy"] = {"seconds": elapsed, "frames_per_s": count/elapsed}
+    return results
+
+
+class FakeGamePico(threading.Thread):
+    """
+    Replays frames on the master side of a pseudo terminal like a GamePico streaming its display.
+    Arguments:
+        protocol (int): 1 for the original ready/continue/retry/end protocol, 2 for "Stream protocol info.md"
+        linkBaudrate (int): optional, limits the throughput like a real serial link (10 bits per byte)
+    """
+    def __init__(self, masterFd:int, frames:list, width:int, height:int, protocol:int = 1, packetCount:int = 16, linkBaudrate:int = None):
+        super().__init__(name="FakeGamePico", daemon=True)
+        self.masterFd = masterFd
+        self.frames = frames
+        self.width = width
+        self.height = height
+        self.protocol = protocol
+        self.packetCount = packetCount
+        self.linkBaudrate = linkBaudrate
+        self.sentFrames = 0
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+
+    def read(self) -> bytes:
+        try:
+            return os.read(self.masterFd, 256)
+        except (BlockingIOError, OSError):
+            return b""
+
+    def write(self, data):
+        data = memoryview(bytes(data))
+        while len(data) > 0 and not self._stopEvent.is_set():
+            try:
+                written = os.write(self.masterFd, data)
+            except BlockingIOError:
+                time.sleep(0.0005)
+                continue
+            data = data[written:]
+            if self.linkBaudrate is not None:
+                time.sleep(written*10/self.linkBaudrate)
+
+    def current_frame(self) -> bytes:
+        frame = self.frames[self.sentFrames % len(self.frames)]
+        self.sentFrames += 1
+        return frame
+
+    def run(self):
+        if self.protocol == 2:
+            import stream_sender
+            sender = stream_sender.StreamSender(self.read, self.write, self.width, self.height, self.current_frame)
+            while not self._stopEvent.is_set():
+                if not sender.poll():
+                    time.sleep(0.0002)
+            return
+
+        packetSize = self.width*self.height*2//self.packetCount
+        lineBuffer = b""
+        frame = None
+        packet = 0
+        while not self._stopEvent.is_set():
+            data = self.read()
+            if not data:
+                time.sleep(0.0002)
+                continue
+            lineBuffer += data
+            while b"\n" in lineBuffer:
+                line, lineBuffer = lineBuffer.split(b"\n", 1)
+                if line == b"ready":
+                    frame = self.current_frame()
+                    packet = 0
+                    self.write(b"OK")
+                elif line == b"continue" and frame is not None and packet < self.packetCount:
+                    self.write(frame[packet*packetSize:(packet + 1)*packetSize])
+                    packet += 1
+                elif line == b"retry" and frame is not None and packet > 0:
+                    self.write(frame[(packet - 1)*packetSize:packet*packetSize])
+                elif line == b"end":
+                    frame = None
+
+
+def stream_end_to_end(protocol:int, duration:float, linkBaudrate:int = None, scaleFactor:int = 3) -> dict:
+    """
+    Runs the stream_receiver used by display_stream against a FakeGamePico and converts and scales the frames
+    with the FrameRenderer of display_stream (without handing them to Tk).
+    """
+    import pty
+    import tty
+
+    import frame_renderer
+    import stream_receiver
+
+    width = 240
+    height = 240
+    rng = np.random.default_rng(0)
+    frames = [generate_content("static", width, height, i, rng) for i in range(30)]
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+
+    device = FakeGamePico(master, frames, width, height, protocol, linkBaudrate=linkBaudrate)
+    device.start()
+    ringBuffer = stream_receiver.FrameRingBuffer(3)
+    receiver = stream_receiver.SerialReceiver(os.ttyname(slave), ringBuffer)
+    receiver.start()
+    renderer = frame_renderer.FrameRenderer(scaleFactor)
+
+    shownFrames = 0
+    latencies = []
+    try:
+        # Wait for the first frame, so the handshake is not part of the measurement
+        waitUntil = time.perf_counter() + 5
+        while len(ringBuffer) == 0 and time.perf_counter() < waitUntil and receiver.is_alive():
+            time.sleep(0.001)
+        ringBuffer.pop_latest()
+        firstReceived = receiver.receivedFrames
+
+        startTime = time.perf_counter()
+        while time.perf_counter() - startTime < duration and receiver.is_alive():
+            frame = ringBuffer.pop_latest()
+            if frame is None:
+                time.sleep(0.001)
+                continue
+            renderer.prepare(frame["data"], frame["width"], frame["height"])
+            latencies.append(time.perf_counter() - frame["receivedTime"])
+            shownFrames += 1
+        elapsed = time.perf_counter() - startTime
+        receivedFrames = receiver.receivedFrames - firstReceived
+    finally:
+        receiver.stop()
+        device.stop()
+        os.close(master)
+        os.close(slave)
+
+    if receiver.error is not None:
+        raise receiver.error
+    latencies.sort()
+    return {
+        "protocol": 2 if receiver.link is not None else 1,
+        "link_baudrate": linkBaudrate,
+        "seconds": elapsed,
+        "received_frames_per_s": receivedFrames/elapsed,
+        "shown_frames_per_s": shownFrames/elapsed,
+        "median_latency_ms": latencies[len(latencies)//2]*1000 if latencies else None,
+        "timeouts": receiver.timeouts,
+    }
+
+
+def multi_stream_end_to_end(deviceCount:int, protocol:int, duration:float) -> dict:
+    """
+    Runs one multi_stream_receiver.MultiStreamReceiver against several FakeGamePicos at once.
+    """
+    import pty
+    import tty
+
+    import multi_stream_receiver
+
+    width = 240
+    height = 240
+    rng = np.random.default_rng(0)
+    frames = [generate_content("static", width, height, i, rng) for i in range(30)]
+
+    receiver = multi_stream_receiver.MultiStreamReceiver()
+    receiver.start()
+    devices = []
+    descriptors = []
+    sessions = []
+    try:
+        for _ in range(deviceCount):
+            master, slave = pty.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            descriptors += [master, slave]
+            device = FakeGamePico(master, frames, width, height, protocol)
+            device.start()
+            devices.append(device)
+            sessions.append(receiver.add_device(os.ttyname(slave), width=width, height=height))
+
+        # Wait for the first frame of every device, so the handshakes are not part of the measurement
+        waitUntil = time.perf_counter() + 5
+        while any(session.receivedFrames == 0 and session.error is None for session in sessions) and time.perf_counter() < waitUntil:
+            time.sleep(0.001)
+        firstReceived = [session.receivedFrames for session in sessions]
+        startTime = time.perf_counter()
+        time.sleep(duration)
+        elapsed = time.perf_counter() - startTime
+        receivedFrames = [session.receivedFrames - first for session, first in zip(sessions, firstReceived)]
+    finally:
+        receiver.stop()
+        for device in devices:
+            device.stop()
+        for descriptor in descriptors:
+            os.close(descriptor)
+
+    for session in sessions:
+        if session.error is not None:
+            raise session.error
+    return {
+        "devices": deviceCount,
+        "seconds": elapsed,
+        "received_frames_per_s": sum(receivedFrames)/elapsed,
+        "slowest_device_frames_per_s": min(receivedFrames)/elapsed,
+        "timeouts": sum(session.timeouts for session in sessions),
+    }
+
+
+def bench_stream(corpora:Corpora, quick:bool) -> dict:
+    duration = 1 if quick else 3
+    return {
+        "v1_unlimited": stream_end_to_end(1, duration),
+        "v2_unlimited": stream_end_to_end(2, duration),
+        "v2_4_devices": multi_stream_end_to_end(4, 2, duration),
+    }
+
+
+benchmarks = {
+    "header_parsing": bench_header_parsing,
+    "gzip_decode": bench_gzip_decode,
+    "color_convert": bench_color_convert,
+    "convert_image": bench_convert_image,
+    "directory_loading": bench_directory_loading,
+    "export": bench_export,
+    "stream": bench_stream,
+}
+
+
+def run_benchmarks(names:list = None, quick:bool = False, corpusDirectory = None) -> dict:
+    names = names or list(benchmarks)
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "quick": quick,
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as temporaryDirectory:
+        corpora = Corpora(corpusDirectory or temporaryDirectory, 20 if quick else 100)
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            results["results"][name] = benchmarks[name](corpora, quick)
+    return results
+
+
+def flatten(results:dict, prefix:str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(previous:dict, current:dict):
+    # Times are better when lower, rates when higher
+    previousValues = flatten(previous["results"])
+    for key, value in flatten(current["results"]).items():
+        if key not in previousValues or previousValues[key] == 0:
+            continue
+        if key.endswith("_ms") or key.endswith("seconds"):
+            change = previousValues[key]/value if value else float("inf")
+        elif key.endswith("_per_s"):
+            change = value/previousValues[key]
+        else:
+            continue
+        print(f"{key}: {previousValues[key]:.4g} -> {value:.4g} ({change:.2f}x {'faster' if change >= 1 else 'slower'})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the .binFrame tools and the live stream.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    runParser = subparsers.add_parser("run", help="run the benchmarks")
+    runParser.add_argument("-o", "--output", help="write the results to this JSON file")
+    runParser.add_argument("--quick", action="store_true", help="fewer iterations and smaller corpora")
+    runParser.add_argument("--only", nargs="+", choices=list(benchmarks), help="run only these benchmarks")
+    runParser.add_argument("--corpus-dir", help="keep the generated corpora in this directory")
+    runParser.add_argument("--compare", help="JSON results of a previous run to compare with")
+
+    generateParser = subparsers.add_parser("generate", help="write a synthetic .binFrame corpus")
+    generateParser.add_argument("directory")
+    generateParser.add_argument("--count", type=int, default=100)
+    generateParser.add_argument("--size", default="240x240", help="WIDTHxHEIGHT")
+    generateParser.add_argument("--content", choices=contentTypes, default="static")
+    generateParser.add_argument("--gzip", type=int, default=None, metavar="LEVEL", help="compress the frames with this GZIP level")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        width, height = (int(value) for value in args.size.lower().split("x"))
+        generate_corpus(args.directory, args.count, width, height, args.content, args.gzip)
+        print(f"Generated {args.count} frames in {args.directory}")
+        return 0
+
+    results = run_benchmarks(args.only, args.quick, args.corpus_dir)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+        print(f"Results written to {args.output}")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,1063 @@
+# Shared helpers for reading .binFrame files, usable without a GUI (see "binFrame format info.md")
+
+import numpy as np
+
+from typing import TypedDict
+
+from PIL import Image
+
+import hashlib
+
+import mmap
+
+import os
+
+import struct
+
+import threading
+
+import time
+
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import rgb565
+
+import pixel_formats
+
+import delta_codec
+
+import metrics
+
+
+class HeaderData(TypedDict):
+    version: int
+    headerLength: int
+    width: int
+    height: int
+    id: int
+    frameTime: int
+    gzip: bool
+    gzip_wbits: int
+    delta: bool
+    pixelFormat: int
+    palette: bytes
+    crc32: int
+
+
+class FrameIndexEntry(TypedDict):
+    path: str
+    fileSize: int
+    header: HeaderData
+
+
+versionStruct = struct.Struct(">H")
+
+# V1: version, width, height, id, frameTime, flags, gzip wbits (the rest of the 32 bytes is padding)
+headerStructV1 = struct.Struct(">HIIIIBB")
+headerLengthV1 = 32
+
+# V2: version, header length, width, height, id, frameTime, flags, gzip wbits, pixel format, (padding), palette entries
+headerStructV2 = struct.Struct(">HHIIIIBBBxH")
+# Without the palette, which directly follows these 32 bytes
+headerLengthV2 = 32
+
+# Only the version and the id are needed to sort a directory
+versionAndIdStructs = {1: struct.Struct(">H8xI"), 2: struct.Struct(">H10xI")}
+
+# Bits of the flags byte
+gzipFlag = 1 << 0
+deltaFlag = 1 << 1
+crcFlag = 1 << 2
+
+# CRC32 of the payload as it is stored (after compression), in the reserved bytes if crcFlag is set
+crcStruct = struct.Struct(">I")
+crcOffsets = {1: 20, 2: 26}
+
+# Compressed data is streamed through the decompressor in pieces of this size, so no whole intermediate copy is created
+decompressChunkSize = 64*1024
+
+# Pixels converted by one table lookup in decode_stack(). The lookup creates an index array of 8 bytes per pixel,
+# above about this size it no longer fits into the CPU cache and a single lookup over a large stack gets slower.
+stackLookupPixels = 1 << 17
+
+
+def is_bit_set(byte: int, bitIndex: int) -> bool:
+    return (byte >> bitIndex) & 1 == 1
+
+
+def parse_header(buffer, offset:int = 0) -> HeaderData:
+    """
+    Parses a header of any supported version from any bytes-like object (bytes, mmap, memoryview).
+    Raises ValueError for unsupported versions or a truncated header.
+    """
+    if len(buffer) - offset < versionStruct.size:
+        raise ValueError("The file is too short to contain a header")
+    parser = headerParsers.get(versionStruct.unpack_from(buffer, offset)[0])
+    if parser is None:
+        raise ValueError("Unsupported file version")
+    return parser(buffer, offset)
+
+
+def parse_header_v1(buffer, offset:int = 0) -> HeaderData:
+    """
+    Parses a V1 header with a single unpack, its pixel data is always big-endian RGB565.
+    """
+    if len(buffer) - offset < headerLengthV1:
+        raise ValueError("The file is too short to contain a header")
+
+    version, width, height, id, frameTime, flags, wbits = headerStructV1.unpack_from(buffer, offset)
+
+    headerData = HeaderData()
+    headerData["version"] = version
+    headerData["headerLength"] = headerLengthV1
+    headerData["width"] = width
+    headerData["height"] = height
+    headerData["id"] = id
+    headerData["frameTime"] = frameTime
+    headerData["gzip"] = is_bit_set(flags, 0)
+    headerData["gzip_wbits"] = wbits
+    headerData["delta"] = is_bit_set(flags, 1)
+    headerData["pixelFormat"] = pixel_formats.rgb565BE
+    headerData["palette"] = b""
+    headerData["crc32"] = crcStruct.unpack_from(buffer, offset + crcOffsets[1])[0] if flags & crcFlag else None
+    return headerData
+
+
+def parse_header_v2(buffer, offset:int = 0) -> HeaderData:
+    """
+    Parses a V2 header including its palette.
+    Raises ValueError for unknown pixel formats, too large palettes and header lengths that do not fit the palette.
+    """
+    if len(buffer) - offset < headerLengthV2:
+        raise ValueError("The file is too short to contain a header")
+
+    version, headerLength, width, height, id, frameTime, flags, wbits, pixelFormat, paletteEntries = headerStructV2.unpack_from(buffer, offset)
+    if paletteEntries > pixel_formats.get(pixelFormat).paletteSize:
+        raise ValueError("The palette is larger than the pixel format allows")
+    if headerLength < headerLengthV2 + paletteEntries*2:
+        raise ValueError("The header length does not include the palette")
+    if len(buffer) - offset < headerLength:
+        raise ValueError("The file is too short to contain a header")
+
+    headerData = HeaderData()
+    headerData["version"] = version
+    headerData["headerLength"] = headerLength
+    headerData["width"] = width
+    headerData["height"] = height
+    headerData["id"] = id
+    headerData["frameTime"] = frameTime
+    headerData["gzip"] = is_bit_set(flags, 0)
+    headerData["gzip_wbits"] = wbits
+    headerData["delta"] = is_bit_set(flags, 1)
+    headerData["pixelFormat"] = pixelFormat
+    headerData["palette"] = bytes(buffer[offset + headerLengthV2:offset + headerLengthV2 + paletteEntries*2])
+    headerData["crc32"] = crcStruct.unpack_from(buffer, offset + crcOffsets[2])[0] if flags & crcFlag else None
+    return headerData
+
+
+headerParsers = {1: parse_header_v1, 2: parse_header_v2}
+
+
+def header_flags(gzip_wbits:int, delta:bool, payloadCrc:int) -> int:
+    flags = 0
+    if gzip_wbits is not None:
+        flags |= gzipFlag
+    if delta:
+        flags |= deltaFlag
+    if payloadCrc is not None:
+        flags |= crcFlag
+    return flags
+
+
+def pack_header(width:int, height:int, id:int, frameTime:int = 0, gzip_wbits:int = None, delta:bool = False, payloadCrc:int = None) -> bytes:
+    """
+    Builds a V1 header.
+    Arguments:
+        gzip_wbits (int): wbits of the GZIP compressed payload, None for an uncompressed payload
+        delta (bool): the payload is delta data against the previous frame of the recording
+        payloadCrc (int): optional zlib.crc32() of the payload as it is stored, checked by frame_fsck.py
+    """
+    header = bytearray(headerLengthV1)
+    headerStructV1.pack_into(header, 0, 1, width, height, id, frameTime, header_flags(gzip_wbits, delta, payloadCrc), gzip_wbits or 0)
+    if payloadCrc is not None:
+        crcStruct.pack_into(header, crcOffsets[1], payloadCrc)
+    return bytes(header)
+
+
+def pack_header_v2(width:int, height:int, id:int, frameTime:int = 0, gzip_wbits:int = None, delta:bool = False,
+                   pixelFormat:int = pixel_formats.rgb565BE, palette:bytes = b"", payloadCrc:int = None) -> bytes:
+    """
+    Builds a V2 header.
+    Arguments:
+        pixelFormat (int): id of the format of the pixel data (see pixel_formats.py)
+        palette (bytes): big-endian RGB565 colors of the palette of an indexed format
+    """
+    paletteEntries = len(palette)//2
+    if paletteEntries > pixel_formats.get(pixelFormat).paletteSize:
+        raise ValueError("The palette is larger than the pixel format allows")
+    header = bytearray(headerLengthV2)
+    headerStructV2.pack_into(header, 0, 2, headerLengthV2 + paletteEntries*2, width, height, id, frameTime,
+                             header_flags(gzip_wbits, delta, payloadCrc), gzip_wbits or 0, pixelFormat, paletteEntries)
+    if payloadCrc is not None:
+        crcStruct.pack_into(header, crcOffsets[2], payloadCrc)
+    return bytes(header) + bytes(palette[:paletteEntries*2])
+
+
+def read_header_bytes(f) -> bytes:
+    """
+    Reads the complete header of any version from a file opened in binary mode, e.g. including the palette of a V2 header.
+    """
+    rawHeader = f.read(headerLengthV1)
+    if len(rawHeader) >= headerLengthV2 and versionStruct.unpack_from(rawHeader)[0] == 2:
+        headerLength = headerStructV2.unpack_from(rawHeader)[1]
+        if headerLength > len(rawHeader):
+            rawHeader += f.read(headerLength - len(rawHeader))
+    return rawHeader
+
+
+def read_file_header(path) -> HeaderData:
+    with open(path, 'rb') as f:
+        return parse_header(read_header_bytes(f))
+
+
+def frame_size(headerData:HeaderData) -> int:
+    """
+    Returns the number of bytes of the (decompressed) pixel data of a full frame.
+    """
+    return pixel_formats.get(headerData["pixelFormat"]).frame_size(headerData["width"], headerData["height"])
+
+
+def sort_id(rawHeader) -> int:
+    """
+    Returns the id of a raw header without parsing the rest of it, None if it is not a supported header.
+    """
+    if len(rawHeader) < headerLengthV1:
+        return None
+    idStruct = versionAndIdStructs.get(versionStruct.unpack_from(rawHeader)[0])
+    if idStruct is None:
+        return None
+    return idStruct.unpack_from(rawHeader)[1]
+
+
+def decompress_into(payload, out, wbits:int) -> str:
+    """
+    Streams GZIP compressed data through a zlib decompressobj straight into a preallocated buffer.
+    Arguments:
+        payload: the compressed data (any bytes-like object, e.g. a memoryview of a memory-mapped file)
+        out: writable byte buffer (bytearray, memoryview or uint8 ndarray) with the exact size of the decompressed data
+        wbits (int): the gzip_wbits of the header, other values (e.g. 0) fall back to detecting the format with the largest window
+
+    Returns:
+        str: None if out was filled exactly, otherwise why the data is damaged (truncated, too long or corrupted).
+            The content of out is undefined then. No exception is raised for damaged data.
+    """
+    if not 16 + 9 <= wbits <= 16 + 15:
+        wbits = 32 + 15
+    decompressor = zlib.decompressobj(wbits)
+    payload = memoryview(payload)
+    out = memoryview(out)
+    size = len(out)
+    offset = 0
+    position = 0
+    data = b""
+    try:
+        while not decompressor.eof:
+            if len(data) == 0 and position < len(payload):
+                data = payload[position:position + decompressChunkSize]
+                position += decompressChunkSize
+            # One byte more than still fits, so data that is too long is noticed
+            produced = decompressor.decompress(data, min(decompressChunkSize, size - offset + 1))
+            data = decompressor.unconsumed_tail
+            if offset + len(produced) > size:
+                return "The decompressed data is longer than the frame"
+            out[offset:offset + len(produced)] = produced
+            offset += len(produced)
+            if len(produced) == 0 and len(data) == 0 and position >= len(payload):
+                break
+    except zlib.error as e:
+        return f"The compressed data is corrupted ({e})"
+    finally:
+        payload.release()
+
+    if not decompressor.eof:
+        return "The compressed data is truncated"
+    if offset < size:
+        return "The decompressed data is shorter than the frame"
+    return None
+
+
+class FrameBufferReader():
+    """
+    Reads one frame from a buffer holding a complete .binFrame (header followed by the payload).
+    Use it as a context manager, or call close() when done.
+    """
+    def __init__(self, buffer, name = ""):
+        self.name = name
+        self._buffer = memoryview(buffer)
+        try:
+            self.header = parse_header(self._buffer)
+        except:
+            self._buffer.release()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._buffer.release()
+
+    def frame_data(self) -> memoryview:
+        """
+        Returns the complete frame (header and payload) as a zero-copy view of the buffer.
+        The view has to be released before the reader is closed.
+        """
+        return self._buffer[:]
+
+    def payload(self) -> memoryview:
+        """
+        Returns the (possibly compressed) data after the header as a zero-copy view of the buffer.
+        The view has to be released before the reader is closed.
+        """
+        return self._buffer[self.header["headerLength"]:]
+
+    def verify_checksum(self) -> str:
+        """
+        Returns:
+            str: None if the payload matches the CRC32 in the header or there is none, otherwise the problem
+        """
+        if self.header["crc32"] is None:
+            return None
+        with self.payload() as payload:
+            if zlib.crc32(payload) != self.header["crc32"]:
+                return "The payload does not match the CRC32 in the header"
+        return None
+
+    def raw_data(self):
+        """
+        Returns the pixel data in the format of the header (the delta data for delta frames). Uncompressed frames are returned
+        as a zero-copy memoryview, compressed frames are decompressed into a new bytearray.
+        Raises ValueError if the compressed data is damaged.
+        """
+        if not self.header["gzip"]:
+            return self.payload()
+
+        if not self.header["delta"]:
+            rawData = bytearray(frame_size(self.header))
+            error = self.read_raw_into(rawData)
+            if error is not None:
+                raise ValueError(f"{error}: {self.name}")
+            return rawData
+
+        # The size of delta data is not known in advance
+        with self.payload() as payload, metrics.registry.timer("decompress"):
+            wbits = self.header["gzip_wbits"] if 16 + 9 <= self.header["gzip_wbits"] <= 16 + 15 else 32 + 15
+            try:
+                return bytearray(zlib.decompress(payload, wbits))
+            except zlib.error as e:
+                raise ValueError(f"The compressed data is corrupted ({e}): {self.name}")
+
+    def read_raw_into(self, out) -> str:
+        """
+        Writes the pixel data of a full frame, in the format of the header, into a writable byte buffer of frame_size() bytes.
+        Compressed data is streamed into it by decompress_into(), uncompressed data is copied from the buffer.
+
+        Returns:
+            str: None if the frame is complete, otherwise why it is damaged, without raising an exception
+        """
+        if self.header["delta"]:
+            raise ValueError("A delta frame can only be decoded after the frames before it (use FrameDecoder)")
+        out = memoryview(out)
+        size = frame_size(self.header)
+        if len(out) != size:
+            raise ValueError(f"The buffer does not match the size of the frame: {self.name}")
+
+        if self.header["gzip"]:
+            with self.payload() as payload, metrics.registry.timer("decompress"):
+                return decompress_into(payload, out, self.header["gzip_wbits"])
+
+        with self.payload() as payload:
+            if len(payload) < size:
+                return "The frame data is shorter than the frame"
+            if len(payload) > size:
+                return "The frame data is longer than the frame"
+            out[:] = payload
+        return None
+
+    def to_array(self, out:np.ndarray = None) -> np.ndarray:
+        if self.header["delta"]:
+            raise ValueError("A delta frame can only be decoded after the frames before it (use FrameDecoder)")
+        rawData = self.raw_data()
+        try:
+            if len(rawData) != frame_size(self.header):
+                raise ValueError(f"The frame data does not match the size of the frame: {self.name}")
+            with metrics.registry.timer("convert"):
+                return pixel_formats.get(self.header["pixelFormat"]).to_rgb888(rawData, self.header["width"], self.header["height"], self.header["palette"], out)
+        finally:
+            if isinstance(rawData, memoryview):
+                rawData.release()
+
+    def to_image(self) -> Image.Image:
+        return Image.fromarray(self.to_array(), 'RGB')
+
+
+class BinFrameReader(FrameBufferReader):
+    """
+    Opens a .binFrame file once and memory-maps it, so the header and the payload
+    are read without any further system calls or copies.
+    """
+    def __init__(self, path):
+        startTime = time.perf_counter()
+        self._file = open(path, 'rb')
+        try:
+            self.fileSize = os.fstat(self._file.fileno()).st_size
+            if self.fileSize < headerLengthV1:
+                raise ValueError("The file is too short to contain a header")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                super().__init__(self._mmap, path)
+            except:
+                self._mmap.close()
+                raise
+        except:
+            self._file.close()
+            raise
+        self.path = path
+        metrics.registry.record("read", time.perf_counter() - startTime)
+
+    def close(self):
+        if not self._file.closed:
+            super().close()
+            self._mmap.close()
+            self._file.close()
+
+
+def list_binframe_files(directory) -> list:
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(".binFrame") and entry.is_file():
+                files.append(directory + "/" + entry.name)
+    files.sort()
+    return files
+
+
+def list_binframe_names(directory) -> list:
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if entry.name.endswith(".binFrame") and entry.is_file()]
+
+
+# The headers of a directory are kept in this file inside it between sessions (see FrameIndex)
+indexCacheName = ".binFrameIndex"
+# Magic, version, directory mtime (0 if the directory has to be listed again), number of entries, CRC32 of the entries
+indexCacheStruct = struct.Struct(">4sHQII")
+indexCacheMagic = b"BFIX"
+indexCacheVersion = 2
+# Every entry: length of the name, file size, length of the header (with the palette of V2 headers), followed by the name and the raw header
+indexCacheEntryStruct = struct.Struct(">HQH")
+
+# A directory that was modified shortly before it was listed can still change without getting a new mtime
+# (the timestamps of FAT have a resolution of 2 s), so it is listed again on the next refresh
+racyInterval_ns = 2_000_000_000
+
+
+def read_index_cache(directory) -> tuple:
+    """
+    Returns:
+        tuple: (directory mtime, {file name: (file size, raw header)}), (0, {}) if there is no valid cache
+    """
+    try:
+        with open(directory + "/" + indexCacheName, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return 0, {}
+    if len(data) < indexCacheStruct.size:
+        return 0, {}
+
+    magic, version, directoryMtime, count, checksum = indexCacheStruct.unpack_from(data, 0)
+    # A cache that was only written partially (or by two processes at once) fails the checksum and is rebuilt
+    if magic != indexCacheMagic or version != indexCacheVersion or zlib.crc32(memoryview(data)[indexCacheStruct.size:]) != checksum:
+        return 0, {}
+
+    headers = {}
+    offset = indexCacheStruct.size
+    try:
+        for _ in range(count):
+            nameLength, fileSize, headerLength = indexCacheEntryStruct.unpack_from(data, offset)
+            offset += indexCacheEntryStruct.size
+            name = data[offset:offset + nameLength].decode("utf-8")
+            offset += nameLength
+            headers[name] = (fileSize, data[offset:offset + headerLength])
+            offset += headerLength
+    except (struct.error, UnicodeDecodeError):
+        return 0, {}
+    return directoryMtime, headers
+
+
+def write_index_cache(directory, directoryMtime:int, headers:dict) -> bool:
+    """
+    Overwrites an existing cache file in place, replacing it would change the mtime of the directory.
+    Returns:
+        bool: False if the directory is not writable
+    """
+    body = bytearray()
+    for name, (fileSize, rawHeader) in headers.items():
+        encodedName = name.encode("utf-8")
+        body += indexCacheEntryStruct.pack(len(encodedName), fileSize, len(rawHeader))
+        body += encodedName
+        body += rawHeader
+    try:
+        with open(directory + "/" + indexCacheName, 'r+b') as f:
+            f.write(indexCacheStruct.pack(indexCacheMagic, indexCacheVersion, directoryMtime, len(headers), zlib.crc32(body)))
+            f.write(body)
+            f.truncate()
+    except OSError:
+        return False
+    return True
+
+
+class FrameIndex():
+    """
+    Index of all .binFrame files in a directory, sorted by the id in their headers (the recording order).
+    Sorting needs every header (32 bytes each), so they are kept in a cache file inside the directory.
+    While the directory has the mtime stored in the cache, opening the index does not even list the directory.
+    Files added later (e.g. by a running recording) are picked up by refresh(), which only reads their headers.
+    The files are expected to stay unchanged once they exist, use useCache=False after overwriting frames under the same names.
+    Arguments:
+        useCache (bool): read and update the cache file of the directory
+    """
+    def __init__(self, directory, useCache:bool = True):
+        self.directory = directory
+        self.useCache = useCache and directory is not None
+        self.paths = []
+        self._positions = {}
+        # Parsed when they are first needed
+        self._entries = []
+
+        # File name -> (file size, raw header) of every listed file, the content of the cache file.
+        # Files whose header could not be read have an empty header, they are sorted last and read again on every refresh.
+        self._headers = {}
+        self._headersChanged = False
+        self._cacheMtime = 0
+        self._unreadable = set()
+        self._listedMtime = None
+        self._listedRacy = False
+
+        if directory is None:
+            return
+        if self.useCache:
+            self._cacheMtime, self._headers = read_index_cache(directory)
+        self.refresh()
+        self.save_cache()
+
+    @classmethod
+    def from_paths(cls, paths):
+        """
+        Index of the given .binFrame files in the given order, e.g. a selection from different directories.
+        Its `directory` is None and it is never refreshed.
+        """
+        frameIndex = cls(None)
+        frameIndex.paths = list(paths)
+        frameIndex._positions = {path: i for i, path in enumerate(frameIndex.paths)}
+        frameIndex._entries = [None] * len(frameIndex.paths)
+        return frameIndex
+
+    def __len__(self):
+        return len(self.paths)
+
+    def close(self):
+        self.save_cache()
+
+    def _read_header(self, name) -> bytes:
+        """
+        Returns the raw header of a file from the cache or from the file, empty if it cannot be read (yet).
+        """
+        cached = self._headers.get(name)
+        if cached is not None and len(cached[1]) > 0:
+            return cached[1]
+        try:
+            with open(self.directory + "/" + name, 'rb') as f:
+                fileSize = os.fstat(f.fileno()).st_size
+                rawHeader = read_header_bytes(f)
+        except OSError:
+            fileSize, rawHeader = 0, b""
+        if sort_id(rawHeader) is None:
+            fileSize, rawHeader = 0, b""
+        if cached != (fileSize, rawHeader):
+            self._headers[name] = (fileSize, rawHeader)
+            self._headersChanged = True
+        return rawHeader
+
+    @staticmethod
+    def _sort_key(name, rawHeader:bytes) -> tuple:
+        id = sort_id(rawHeader)
+        if id is None:
+            return (1, 0, name)
+        return (0, id, name)
+
+    def _set_paths(self, names:list):
+        self.paths = [self.directory + "/" + name for name in names]
+        self._positions = {path: i for i, path in enumerate(self.paths)}
+        self._entries = [None] * len(self.paths)
+        self._unreadable = {name for name in names if len(self._headers[name][1]) == 0}
+
+    def refresh(self) -> bool:
+        """
+        Adds new files and removes deleted ones, a single stat while the directory is unchanged.
+        New frames with higher ids than all known frames are appended, so the positions of the known frames stay valid.
+        Returns:
+            bool: True if the index changed, positions have to be looked up again with index_of() then
+        """
+        if self.directory is None:
+            return False
+        directoryMtime = os.stat(self.directory).st_mtime_ns
+        if directoryMtime == self._listedMtime and not self._listedRacy:
+            return False
+
+        if self._listedMtime is None and directoryMtime == self._cacheMtime != 0:
+            names = list(self._headers)
+        else:
+            with metrics.registry.timer("list_directory"):
+                names = list_binframe_names(self.directory)
+        self._listedRacy = time.time_ns() - directoryMtime < racyInterval_ns
+        self._listedMtime = directoryMtime
+
+        prefixLength = len(self.directory) + 1
+        added = [name for name in names if self.directory + "/" + name not in self._positions]
+        removedCount = len(self.paths) - (len(names) - len(added))
+        recovered = [name for name in self._unreadable if len(self._read_header(name)) > 0]
+        if len(added) == 0 and removedCount == 0 and len(recovered) == 0:
+            return False
+
+        added.sort(key=lambda name: self._sort_key(name, self._read_header(name)))
+        if len(self.paths) == 0:
+            self._set_paths(added)
+            return True
+        lastName = self.paths[-1][prefixLength:]
+        if removedCount == 0 and len(recovered) == 0 and self._sort_key(lastName, self._headers[lastName][1]) < self._sort_key(added[0], self._headers[added[0]][1]):
+            # The usual case during a recording, the new frames follow all known frames
+            for name in added:
+                path = self.directory + "/" + name
+                self._positions[path] = len(self.paths)
+                self._entries.append(None)
+                self.paths.append(path)
+                if len(self._headers[name][1]) == 0:
+                    self._unreadable.add(name)
+            return True
+
+        if removedCount > 0:
+            existing = set(names)
+            for name in [name for name in self._headers if name not in existing]:
+                del self._headers[name]
+                self._headersChanged = True
+        with metrics.registry.timer("sort_index"):
+            self._set_paths(sorted(names, key=lambda name: self._sort_key(name, self._read_header(name))))
+        return True
+
+    def save_cache(self):
+        """
+        Writes the cache file if the index changed since it was read or written.
+        """
+        if not self.useCache or self._listedMtime is None:
+            return
+        # A listing that may be incomplete has to be repeated next time, which a stored mtime of 0 enforces
+        directoryMtime = 0 if self._listedRacy else self._listedMtime
+        if not self._headersChanged and directoryMtime == self._cacheMtime:
+            return
+
+        cachePath = self.directory + "/" + indexCacheName
+        if not os.path.exists(cachePath):
+            try:
+                # Creating the file changes the mtime of the directory, so this listing cannot be trusted next time
+                open(cachePath, 'xb').close()
+            except OSError:
+                return
+            directoryMtime = 0
+        if write_index_cache(self.directory, directoryMtime, self._headers):
+            self._cacheMtime = directoryMtime
+            self._headersChanged = False
+
+    def index_of(self, path) -> int:
+        return self._positions[path]
+
+    def entry(self, index:int) -> FrameIndexEntry:
+        entry = self._entries[index]
+        if entry is None:
+            path = self.paths[index]
+            cached = self._headers.get(path[len(self.directory) + 1:]) if self.directory is not None else None
+            if cached is not None and len(cached[1]) > 0:
+                entry = FrameIndexEntry(path=path, fileSize=cached[0], header=parse_header(cached[1]))
+            else:
+                # Raises the error of the file, e.g. for unsupported versions
+                with open(path, 'rb') as f:
+                    entry = FrameIndexEntry(
+                        path=path,
+                        fileSize=os.fstat(f.fileno()).st_size,
+                        header=parse_header(read_header_bytes(f))
+                    )
+            self._entries[index] = entry
+        return entry
+
+    def header(self, index:int) -> HeaderData:
+        return self.entry(index)["header"]
+
+    def mtime(self, index:int) -> int:
+        return os.stat(self.paths[index]).st_mtime_ns
+
+    def open_frame(self, index:int) -> FrameBufferReader:
+        return BinFrameReader(self.paths[index])
+
+
+class FrameDecoder():
+    """
+    Decodes the frames of a frame index (binframe.FrameIndex or binframe_archive.BinFramesArchive), including delta frames.
+    A delta frame is applied to the frame before it, so the raw data of the last decoded delta frame is kept:
+    decoding in recording order applies every delta once, any other position is rebuilt from the nearest full frame before it.
+    It can be shared between threads.
+    """
+    def __init__(self, frameIndex):
+        self.frameIndex = frameIndex
+        self._frameBuffer = None
+        self._bufferIndex = None
+        self._lock = threading.Lock()
+        # Compressed full frames are decompressed into a buffer of the calling thread, which is reused for every frame
+        self._threadBuffers = threading.local()
+
+    def reset(self):
+        """
+        Forgets the kept frame, needed after the positions in the frame index changed (see FrameIndex.refresh()).
+        """
+        with self._lock:
+            self._bufferIndex = None
+
+    def _scratch_buffer(self, size:int) -> bytearray:
+        scratch = getattr(self._threadBuffers, "scratch", None)
+        if scratch is None or len(scratch) != size:
+            scratch = self._threadBuffers.scratch = bytearray(size)
+        return scratch
+
+    def _read_rgb565_into(self, reader:FrameBufferReader, out):
+        """
+        Writes a full frame of any pixel format into `out` as big-endian RGB565 data. Raises ValueError for damaged frames.
+        """
+        headerData = reader.header
+        if headerData["pixelFormat"] == pixel_formats.rgb565BE:
+            error = reader.read_raw_into(out)
+        else:
+            rawData = self._scratch_buffer(frame_size(headerData))
+            error = reader.read_raw_into(rawData)
+            if error is None:
+                with metrics.registry.timer("convert"):
+                    values565 = np.frombuffer(out, dtype='>u2').reshape((headerData["height"], headerData["width"]))
+                    pixel_formats.get(headerData["pixelFormat"]).to_rgb565(rawData, headerData["width"], headerData["height"], headerData["palette"], values565)
+        if error is not None:
+            raise ValueError(f"{error}: {reader.name}")
+
+    def _rebuild(self, index:int):
+        if self._bufferIndex == index:
+            return
+
+        # Walk back to the nearest full frame, or to the frame that is already in the buffer
+        start = index
+        while self.frameIndex.header(start)["delta"]:
+            if start - 1 == self._bufferIndex:
+                break
+            if start == 0:
+                raise ValueError(f"There is no full frame before the delta frame {self.frameIndex.paths[index]}")
+            start -= 1
+
+        self._bufferIndex = None
+        for i in range(start, index + 1):
+            with self.frameIndex.open_frame(i) as reader:
+                width = reader.header["width"]
+                height = reader.header["height"]
+                if not reader.header["delta"]:
+                    # The buffer always holds RGB565 data, which is what the rectangles of delta frames contain
+                    if self._frameBuffer is None or len(self._frameBuffer) != width*height*2:
+                        self._frameBuffer = bytearray(width*height*2)
+                    self._read_rgb565_into(reader, self._frameBuffer)
+                    continue
+
+                if reader.header["pixelFormat"] != pixel_formats.rgb565BE:
+                    raise ValueError(f"Delta frames have to use the RGB565 pixel format: {reader.name}")
+                if len(self._frameBuffer) != width*height*2:
+                    raise ValueError(f"The delta frame does not match the resolution of the previous frame: {reader.name}")
+                rawData = reader.raw_data()
+                try:
+                    with metrics.registry.timer("apply_delta"):
+                        delta_codec.apply_delta(self._frameBuffer, width, height, rawData)
+                finally:
+                    if isinstance(rawData, memoryview):
+                        rawData.release()
+        self._bufferIndex = index
+
+    def raw_data(self, index:int) -> bytes:
+        """
+        Returns a copy of the raw big-endian RGB565 data of the frame, whatever its pixel format.
+        """
+        headerData = self.frameIndex.header(index)
+        if not headerData["delta"]:
+            with self.frameIndex.open_frame(index) as reader:
+                if headerData["pixelFormat"] != pixel_formats.rgb565BE:
+                    rawData = bytearray(headerData["width"]*headerData["height"]*2)
+                    self._read_rgb565_into(reader, rawData)
+                    return bytes(rawData)
+                rawData = reader.raw_data()
+                try:
+                    return bytes(rawData)
+                finally:
+                    if isinstance(rawData, memoryview):
+                        rawData.release()
+
+        with self._lock:
+            self._rebuild(index)
+            return bytes(self._frameBuffer)
+
+    def read_raw_into(self, index:int, out, previousDigest:bytes = None) -> bytes:
+        """
+        Writes the raw big-endian RGB565 data of the frame into a writable byte buffer of width*height*2 bytes (e.g. a slot of a uint8 view of a stack),
+        without creating a copy of it first. Frames of other pixel formats are converted.
+        Arguments:
+            previousDigest (bytes): optional frame_digest() of the frame before it (b"" if there is none). The digest of this frame
+                is then computed straight from its source (the memory map of an uncompressed file, the decompressed data or the
+                rebuilt delta frame), and if both are equal, the frame is a duplicate and is not copied into out.
+                Compressed and converted frames are always written into out, their digest is computed from there.
+
+        Returns:
+            bytes: the frame_digest() of the frame, None if previousDigest was not given
+        """
+        headerData = self.frameIndex.header(index)
+        size = headerData["width"]*headerData["height"]*2
+        out = memoryview(out)
+        if len(out) != size:
+            raise ValueError(f"The buffer does not match the resolution of the frame: {self.frameIndex.paths[index]}")
+
+        if not headerData["delta"]:
+            with self.frameIndex.open_frame(index) as reader:
+                if reader.header["gzip"] or reader.header["pixelFormat"] != pixel_formats.rgb565BE:
+                    self._read_rgb565_into(reader, out)
+                    return frame_digest(out) if previousDigest is not None else None
+
+                with reader.payload() as payload:
+                    if len(payload) != size:
+                        raise ValueError(f"The frame data does not match the size of the frame: {reader.name}")
+                    return self._copy_raw(payload, out, previousDigest)
+
+        with self._lock:
+            self._rebuild(index)
+            return self._copy_raw(self._frameBuffer, out, previousDigest)
+
+    @staticmethod
+    def _copy_raw(source, out:memoryview, previousDigest:bytes) -> bytes:
+        if previousDigest is None:
+            out[:] = source
+            return None
+        digest = frame_digest(source)
+        if digest != previousDigest:
+            out[:] = source
+        return digest
+
+    def to_array(self, index:int, out:np.ndarray = None) -> np.ndarray:
+        headerData = self.frameIndex.header(index)
+        if not headerData["delta"]:
+            # Full frames are converted directly, without going through the buffer
+            with self.frameIndex.open_frame(index) as reader:
+                if not reader.header["gzip"]:
+                    return reader.to_array(out=out)
+                rawData = self._scratch_buffer(frame_size(headerData))
+                error = reader.read_raw_into(rawData)
+                if error is not None:
+                    raise ValueError(f"{error}: {reader.name}")
+            with metrics.registry.timer("convert"):
+                return pixel_formats.get(headerData["pixelFormat"]).to_rgb888(rawData, headerData["width"], headerData["height"], headerData["palette"], out)
+
+        with self._lock:
+            self._rebuild(index)
+            with metrics.registry.timer("convert"):
+                return rgb565.convert_buffer(self._frameBuffer, headerData["width"], headerData["height"], out=out)
+
+    def to_image(self, index:int) -> Image.Image:
+        return Image.fromarray(self.to_array(index), 'RGB')
+
+
+def color_array_convert(values565:np.ndarray, out:np.ndarray = None) -> np.ndarray:
+    """
+    Converts the 16-bit color format to the 24-bit RGB format.
+    Arguments:
+        values565 (ndarray): ndarray of shape (H, W) or flat, dtype=uint16
+        out (ndarray): optional preallocated output buffer
+
+    Returns:
+        ndarray: of shape (H, W, 3), dtype=uint8
+    """
+    return rgb565.rgb565_to_rgb888(values565, out)
+
+
+def convert_image(raw_data, width, height) -> Image.Image:
+    # Convert the raw big-endian RGB565 data to an RGB888 array and create the image using Pillow
+    return Image.fromarray(rgb565.convert_buffer(raw_data, width, height), 'RGB')
+
+
+def frame_digest(rawData) -> bytes:
+    """
+    Hash of the raw RGB565 data of a frame (any bytes-like object), equal digests mean identical frames.
+    """
+    return hashlib.blake2b(rawData, digest_size=16).digest()
+
+
+def stack_resolution(frameIndex, start:int = 0, stop:int = None) -> tuple:
+    """
+    Checks from the headers that a range of frames shares one resolution.
+    Returns:
+        tuple: (width, height)
+    Raises ValueError if the range is empty or the resolutions differ.
+    """
+    start, stop, _ = slice(start, stop).indices(len(frameIndex))
+    if stop <= start:
+        raise ValueError("There are no frames to decode")
+
+    firstHeader = frameIndex.header(start)
+    for i in range(start + 1, stop):
+        headerData = frameIndex.header(i)
+        if headerData["width"] != firstHeader["width"] or headerData["height"] != firstHeader["height"]:
+            raise ValueError(f"All frames have to share one resolution: {frameIndex.paths[i]}")
+    return (firstHeader["width"], firstHeader["height"])
+
+
+def read_raw_stack(frameIndex, start:int, stop:int, out:np.ndarray = None, decoder:FrameDecoder = None, executor:ThreadPoolExecutor = None) -> np.ndarray:
+    """
+    Reads the raw RGB565 data of a range of frames with one resolution into one array, without converting it.
+    Arguments:
+        out (ndarray): optional preallocated output of shape (N, H, W), dtype='>u2'
+        decoder (FrameDecoder): optional decoder of the same frames (see decode_stack())
+        executor (ThreadPoolExecutor): optional, reads the full frames in parallel (zlib releases the GIL while decompressing),
+            the delta frames are still applied in order by the calling thread
+
+    Returns:
+        ndarray: of shape (N, H, W), dtype='>u2' (out, if it was given)
+    """
+    width, height = stack_resolution(frameIndex, start, stop)
+    # The file data is big-endian, so it is copied as it is and the byte order is handled by the lookups
+    if out is None:
+        out = np.empty((stop - start, height, width), dtype='>u2')
+    elif out.shape != (stop - start, height, width) or out.dtype != np.dtype('>u2'):
+        raise ValueError(f"The output array has to be of shape {(stop - start, height, width)} and dtype >u2")
+    if decoder is None:
+        decoder = FrameDecoder(frameIndex)
+
+    outBytes = out.view(np.uint8).reshape((len(out), width*height*2))
+    if executor is None:
+        for i in range(len(out)):
+            decoder.read_raw_into(start + i, outBytes[i])
+        return out
+
+    deltaFrames = [i for i in range(len(out)) if frameIndex.header(start + i)["delta"]]
+    fullFrames = [i for i in range(len(out)) if not frameIndex.header(start + i)["delta"]]
+    results = executor.map(lambda i: decoder.read_raw_into(start + i, outBytes[i]), fullFrames)
+    for i in deltaFrames:
+        decoder.read_raw_into(start + i, outBytes[i])
+    # Passes on the first exception of the workers
+    for _ in results:
+        pass
+    return out
+
+
+def decode_stack(frames, start:int = 0, stop:int = None, out:np.ndarray = None, batchSize:int = 64, decoder:FrameDecoder = None, progressCallback = None, workers:int = 1) -> np.ndarray:
+    """
+    Decodes a range of frames into one array. The raw data of up to batchSize frames is read into one preallocated
+    uint16 stack, which is then converted by table lookups over as many frames at once as fit into stackLookupPixels.
+    Arguments:
+        frames: list of .binFrame paths, binframe.FrameIndex or binframe_archive.BinFramesArchive
+        start, stop (int): positions of the frames, like a slice (stop None = until the last frame)
+        out (ndarray): optional preallocated output of shape (N, H, W, 3), e.g. a memmap
+        batchSize (int): limits the memory used for the stack and the lookup for long ranges
+        decoder (FrameDecoder): optional decoder of the same frames, so a range following the previous one
+            does not rebuild its delta frames from the last full frame
+        progressCallback (function): optional, called with (decoded frames, total frames) after every batch
+        workers (int): threads reading, decompressing and converting the frames, None for the CPU count
+
+    Returns:
+        ndarray: of shape (N, H, W, 3), dtype=uint8 (out, if it was given)
+    Raises ValueError if the frames do not share one resolution or their data is damaged.
+    """
+    frameIndex = FrameIndex.from_paths(frames) if isinstance(frames, (list, tuple)) else frames
+    start, stop, _ = slice(start, stop).indices(len(frameIndex))
+    width, height = stack_resolution(frameIndex, start, stop)
+    count = stop - start
+
+    if out is None:
+        out = np.empty((count, height, width, 3), dtype=np.uint8)
+    elif out.shape != (count, height, width, 3) or out.dtype != np.uint8:
+        raise ValueError(f"The output array has to be of shape {(count, height, width, 3)} and dtype uint8")
+    if decoder is None:
+        decoder = FrameDecoder(frameIndex)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ThreadPoolExecutor(workers) if workers > 1 else None
+
+    stack = np.empty((min(batchSize, count), height, width), dtype='>u2')
+    framesPerLookup = max(1, stackLookupPixels // max(1, width*height))
+    try:
+        for batchStart in range(0, count, len(stack)):
+            batchCount = min(len(stack), count - batchStart)
+            read_raw_stack(frameIndex, start + batchStart, start + batchStart + batchCount, stack[:batchCount], decoder, executor)
+
+            with metrics.registry.timer("convert_stack"):
+                lookups = [(i, min(i + framesPerLookup, batchCount)) for i in range(0, batchCount, framesPerLookup)]
+                convert = lambda lookup: rgb565.rgb565_to_rgb888(stack[lookup[0]:lookup[1]], out[batchStart + lookup[0]:batchStart + lookup[1]])
+                if executor is None:
+                    for lookup in lookups:
+                        convert(lookup)
+                else:
+                    for _ in executor.map(convert, lookups):
+                        pass
+            if progressCallback is not None:
+                progressCallback(batchStart + batchCount, count)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return out
+
+
+def save_stack(frames, path, start:int = 0, stop:int = None, batchSize:int = 64, progressCallback = None, workers:int = 1) -> np.ndarray:
+    """
+    Decodes a range of frames directly into a .npy file, so long recordings never have to fit into memory.
+    Arguments are the same as for decode_stack().
+
+    Returns:
+        ndarray: memmap of the written file, of shape (N, H, W, 3), dtype=uint8
+    """
+    frameIndex = FrameIndex.from_paths(frames) if isinstance(frames, (list, tuple)) else frames
+    start, stop, _ = slice(start, stop).indices(len(frameIndex))
+    width, height = stack_resolution(frameIndex, start, stop)
+
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(stop - start, height, width, 3))
+    decode_stack(frameIndex, start, stop, out, batchSize, progressCallback=progressCallback, workers=workers)
+    out.flush()
+    return out
+
+
+def open_frames(path):
+    """
+    Opens either a directory of .binFrame files or a .binFrames archive.
+    Both returned indexes provide paths, index_of(), entry(), header(), mtime(), open_frame(), refresh() and close().
+    """
+    if os.path.isdir(path):
+        return FrameIndex(path)
+
+    import binframe_archive
+    return binframe_archive.BinFramesArchive(path)
+
+
+def load_image(path) -> Image.Image:
+    """
+    Reads the header and the payload of a .binFrame file and converts it to a Pillow image.
+    Raises ValueError for unsupported versions and damaged data.
+    """
+    with BinFrameReader(path) as reader:
+        return reader.to_image()
@@ -0,0 +1,303 @@
+# Reader, writer and converter for .binFrames archives (see "binFrames format info.md")
+#
+# Usage: python binframe_archive.py pack [--delta [--keyframe-interval N]] <directory> <archive.binFrames>
+#        python binframe_archive.py unpack <archive.binFrames> <directory>
+
+import argparse
+
+import mmap
+
+import os
+
+import struct
+
+import zlib
+
+import binframe
+from binframe import HeaderData, FrameIndexEntry
+
+import delta_codec
+
+
+archiveMagic = b"BINFRAMS"
+archiveVersion = 1
+# Magic, container version, 6 reserved bytes
+archiveHeaderStruct = struct.Struct(">8sH6x")
+# Length of the following frame
+recordPrefixStruct = struct.Struct(">I")
+# Frame data offset, frame data length, frame id, frameTime
+indexEntryStruct = struct.Struct(">QIII")
+# Index offset, frame count, magic
+footerStruct = struct.Struct(">QI4s")
+footerMagic = b"BFIX"
+
+
+class BinFramesWriter():
+    """
+    Appends complete V1 frames (header + payload) to a new archive.
+    The index is only written by close(), an archive that was not closed can still be
+    opened because its frames are found by following the length prefixes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(archiveHeaderStruct.pack(archiveMagic, archiveVersion))
+        self._index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def add_frame(self, frameData):
+        """
+        Arguments:
+            frameData (bytes-like): a complete .binFrame, exactly as it would be stored in its own file
+        """
+        headerData = binframe.parse_header(frameData)
+        self._file.write(recordPrefixStruct.pack(len(frameData)))
+        self._index.append((self._file.tell(), len(frameData), headerData["id"], headerData["frameTime"]))
+        self._file.write(frameData)
+
+    def close(self):
+        if self._file.closed:
+            return
+        indexOffset = self._file.tell()
+        for entry in self._index:
+            self._file.write(indexEntryStruct.pack(*entry))
+        self._file.write(footerStruct.pack(indexOffset, len(self._index), footerMagic))
+        self._file.close()
+
+
+class BinFramesArchive():
+    """
+    Memory-mapped, read-only view of a .binFrames archive.
+    Provides the same interface as binframe.FrameIndex, every frame is accessed in O(1) through the trailing index.
+    Each frame gets a virtual path "<archive path>/frame_<position>.binFrame".
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            fileStat = os.fstat(self._file.fileno())
+            self._mtime = fileStat.st_mtime_ns
+            if fileStat.st_size < archiveHeaderStruct.size:
+                raise ValueError("The file is not a .binFrames archive")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+        try:
+            magic, version = archiveHeaderStruct.unpack_from(self._mmap, 0)
+            if magic != archiveMagic:
+                raise ValueError("The file is not a .binFrames archive")
+            if version != archiveVersion:
+                raise ValueError("Unsupported archive version")
+
+            self._recoveredIndex = None
+            self._indexOffset, frameCount = self._read_footer()
+            if self._indexOffset is None:
+                self._recoveredIndex = self._scan_records()
+                frameCount = len(self._recoveredIndex)
+        except:
+            self.close()
+            raise
+
+        self.paths = [f"{path}/frame_{i:06d}.binFrame" for i in range(frameCount)]
+        self._positions = {framePath: i for i, framePath in enumerate(self.paths)}
+
+    def _read_footer(self) -> tuple:
+        if len(self._mmap) < archiveHeaderStruct.size + footerStruct.size:
+            return (None, 0)
+        indexOffset, frameCount, magic = footerStruct.unpack_from(self._mmap, len(self._mmap) - footerStruct.size)
+        if magic != footerMagic or indexOffset + frameCount*indexEntryStruct.size + footerStruct.size != len(self._mmap):
+            return (None, 0)
+        return (indexOffset, frameCount)
+
+    def _scan_records(self) -> list:
+        # The archive was not closed properly, rebuild the index from the length prefixes.
+        # The scan stops at the first record that is incomplete or has no valid header, like a frame that was being written.
+        index = []
+        offset = archiveHeaderStruct.size
+        while offset + recordPrefixStruct.size <= len(self._mmap):
+            length, = recordPrefixStruct.unpack_from(self._mmap, offset)
+            offset += recordPrefixStruct.size
+            if length < binframe.headerLengthV1 or offset + length > len(self._mmap):
+                break
+            try:
+                headerData = binframe.parse_header(self._mmap, offset)
+            except ValueError:
+                break
+            if headerData["headerLength"] > length:
+                break
+            index.append((offset, length, headerData["id"], headerData["frameTime"]))
+            offset += length
+        return index
+
+    @property
+    def recovered(self) -> bool:
+        return self._recoveredIndex is not None
+
+    def close(self):
+        if not self._file.closed:
+            self._mmap.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def index_record(self, index:int) -> tuple:
+        """
+        Returns:
+            tuple: (frame data offset, frame data length, id, frameTime)
+        """
+        if not 0 <= index < len(self.paths):
+            raise IndexError("Frame index out of range")
+        if self._recoveredIndex is not None:
+            return self._recoveredIndex[index]
+        return indexEntryStruct.unpack_from(self._mmap, self._indexOffset + index*indexEntryStruct.size)
+
+    def index_of(self, path) -> int:
+        return self._positions[path]
+
+    def refresh(self) -> bool:
+        # The index of an archive is only written when it is closed, so frames cannot be added to an open archive
+        return False
+
+    def entry(self, index:int) -> FrameIndexEntry:
+        offset, length, _, _ = self.index_record(index)
+        return FrameIndexEntry(
+            path=self.paths[index],
+            fileSize=length,
+            header=binframe.parse_header(self._mmap, offset)
+        )
+
+    def mtime(self, index:int) -> int:
+        # All frames share the modification time of the archive
+        return self._mtime
+
+    def header(self, index:int) -> HeaderData:
+        return binframe.parse_header(self._mmap, self.index_record(index)[0])
+
+    def frame_data(self, index:int) -> memoryview:
+        """
+        Returns the complete frame as a zero-copy view, it has to be released before the archive is closed.
+        """
+        offset, length, _, _ = self.index_record(index)
+        return memoryview(self._mmap)[offset:offset + length]
+
+    def open_frame(self, index:int) -> binframe.FrameBufferReader:
+        with self.frame_data(index) as frameData:
+            return binframe.FrameBufferReader(frameData, self.paths[index])
+
+
+def delta_frames(frameIndex, keyframeInterval:int = 60):
+    """
+    Generator re-encoding the indexed frames as delta frames against the frame before them.
+    Every keyframeInterval frames (and whenever a delta would not be smaller) a full frame is stored instead,
+    so any frame can be decoded without going back through the whole recording.
+    Full frames of the source are copied unchanged, so they keep their pixel format, compression and checksum.
+    Delta frames are always RGB565, and so are the full frames that replace delta frames of the source.
+    Those keep the compression and the payload checksum of the source frame, headers with invalid wbits are compressed as GZIP.
+
+    Yields:
+        bytes: complete .binFrame data
+    """
+    decoder = binframe.FrameDecoder(frameIndex)
+    previous = None
+    sinceKeyframe = 0
+    for i in range(len(frameIndex)):
+        headerData = frameIndex.header(i)
+        width = headerData["width"]
+        height = headerData["height"]
+        rawData = decoder.raw_data(i)
+
+        payload = None
+        if previous is not None and len(previous) == len(rawData) and sinceKeyframe < keyframeInterval:
+            payload = delta_codec.encode_delta(previous, rawData, width, height)
+        isDelta = payload is not None
+        if isDelta:
+            sinceKeyframe += 1
+        else:
+            payload = rawData
+            sinceKeyframe = 1
+        previous = rawData
+
+        if not isDelta and not headerData["delta"]:
+            # Indexed or RGB888 frames would grow several times as RGB565
+            with frameIndex.open_frame(i) as reader:
+                with reader.frame_data() as frameData:
+                    yield bytes(frameData)
+            continue
+
+        wbits = None
+        if headerData["gzip"]:
+            # The same fallback as binframe.decompress_into() for headers without valid wbits
+            wbits = headerData["gzip_wbits"] if 16 + 9 <= headerData["gzip_wbits"] <= 16 + 15 else 16 + 15
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            payload = compressor.compress(payload) + compressor.flush()
+
+        payloadCrc = zlib.crc32(payload) if headerData["crc32"] is not None else None
+        yield binframe.pack_header(width, height, headerData["id"], headerData["frameTime"], wbits, isDelta, payloadCrc) + payload
+
+
+def pack_directory(directory, archivePath, keyframeInterval:int = 0) -> int:
+    """
+    Arguments:
+        keyframeInterval (int): if above 0, the frames are stored as delta frames with a full frame at least this often
+    """
+    frameIndex = binframe.FrameIndex(directory)
+    with BinFramesWriter(archivePath) as writer:
+        if keyframeInterval > 0:
+            for frameData in delta_frames(frameIndex, keyframeInterval):
+                writer.add_frame(frameData)
+        else:
+            for path in frameIndex.paths:
+                with open(path, 'rb') as f:
+                    writer.add_frame(f.read())
+    return len(frameIndex)
+
+
+def unpack_archive(archivePath, directory) -> int:
+    os.makedirs(directory, exist_ok=True)
+    with BinFramesArchive(archivePath) as archive:
+        for i in range(len(archive)):
+            with archive.frame_data(i) as frameData:
+                with open(directory + "/" + archive.paths[i].split("/")[-1], 'wb') as f:
+                    f.write(frameData)
+        return len(archive)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert between .binFrame directories and .binFrames archives.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    packParser = subparsers.add_parser("pack", help="pack a directory of .binFrame files into an archive")
+    packParser.add_argument("--delta", action="store_true", help="store only the changed parts of each frame")
+    packParser.add_argument("--keyframe-interval", type=int, default=60, help="with --delta, store a full frame at least this often (default 60)")
+    packParser.add_argument("directory")
+    packParser.add_argument("archive")
+    unpackParser = subparsers.add_parser("unpack", help="unpack an archive into a directory of .binFrame files")
+    unpackParser.add_argument("archive")
+    unpackParser.add_argument("directory")
+    args = parser.parse_args(argv)
+
+    if args.command == "pack":
+        print(f"Packed {pack_directory(args.directory, args.archive, args.keyframe_interval if args.delta else 0)} frames into {args.archive}")
+    else:
+        print(f"Unpacked {unpack_archive(args.archive, args.directory)} frames into {args.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
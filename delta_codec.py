@@ -0,0 +1,220 @@
+# Delta encoding of RGB565 frames (see "binFrame format info.md", delta data)
+#
+# A delta only carries the rectangles of the screen that changed since the previous frame.
+# The module only needs struct, so the encoder also runs on the PICO. On a PC numpy is used to find the changes faster.
+#
+# Running this file directly checks that encoding and applying deltas reproduces the frames exactly.
+
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# MicroPython has no struct.Struct, so the formats are kept as strings
+# Number of rectangles
+deltaHeaderFormat = ">H"
+deltaHeaderSize = 2
+# x, y, width, height of a rectangle, followed by width*height*2 bytes of big-endian RGB565 data
+rectFormat = ">HHHH"
+rectSize = 8
+
+
+def find_dirty_rects(previous, current, width, height, tileSize=16):
+    """
+    Compares two raw RGB565 frames in bands of tileSize rows. In each band the changed tiles
+    that are next to each other are merged into one rectangle, which is then shrunk to the changed rows.
+    Returns:
+        list: of (x, y, width, height) tuples
+    """
+    if np is not None:
+        return _find_dirty_rects_numpy(previous, current, width, height, tileSize)
+    return _find_dirty_rects_python(previous, current, width, height, tileSize)
+
+
+def _find_dirty_rects_python(previous, current, width, height, tileSize):
+    rowLength = width*2
+    tileLength = tileSize*2
+    tileColumns = (width + tileSize - 1)//tileSize
+    rects = []
+    for bandTop in range(0, height, tileSize):
+        bandBottom = min(bandTop + tileSize, height)
+        dirtyRows = []
+        for y in range(bandTop, bandBottom):
+            start = y*rowLength
+            if previous[start:start + rowLength] != current[start:start + rowLength]:
+                dirtyRows.append(y)
+        if len(dirtyRows) == 0:
+            continue
+
+        dirtyTiles = []
+        for column in range(tileColumns):
+            dirty = False
+            for y in dirtyRows:
+                start = y*rowLength + column*tileLength
+                if previous[start:start + tileLength] != current[start:start + tileLength]:
+                    dirty = True
+                    break
+            dirtyTiles.append(dirty)
+        _append_runs(rects, dirtyTiles, dirtyRows[0], dirtyRows[-1] + 1, width, tileSize)
+    return rects
+
+
+def _find_dirty_rects_numpy(previous, current, width, height, tileSize):
+    changed = np.frombuffer(previous, dtype=np.uint16, count=width*height).reshape((height, width)) != \
+              np.frombuffer(current, dtype=np.uint16, count=width*height).reshape((height, width))
+
+    # Pad to whole tiles, so the changes can be reduced per tile with a single reshape
+    bands = (height + tileSize - 1)//tileSize
+    tileColumns = (width + tileSize - 1)//tileSize
+    padded = np.zeros((bands*tileSize, tileColumns*tileSize), dtype=bool)
+    padded[:height, :width] = changed
+    padded = padded.reshape((bands, tileSize, tileColumns, tileSize))
+    dirtyTiles = padded.any(axis=(1, 3))
+    dirtyRows = padded.any(axis=(2, 3))
+
+    rects = []
+    for band in np.flatnonzero(dirtyTiles.any(axis=1)):
+        rows = np.flatnonzero(dirtyRows[band])
+        _append_runs(rects, dirtyTiles[band].tolist(), band*tileSize + int(rows[0]), band*tileSize + int(rows[-1]) + 1, width, tileSize)
+    return rects
+
+
+def _append_runs(rects, dirtyTiles, top, bottom, width, tileSize):
+    column = 0
+    while column < len(dirtyTiles):
+        if not dirtyTiles[column]:
+            column += 1
+            continue
+        runStart = column
+        while column < len(dirtyTiles) and dirtyTiles[column]:
+            column += 1
+        x = runStart*tileSize
+        rects.append((x, top, min(column*tileSize, width) - x, bottom - top))
+
+
+def encode_rects(current, width, rects):
+    rowLength = width*2
+    parts = [struct.pack(deltaHeaderFormat, len(rects))]
+    for x, y, w, h in rects:
+        parts.append(struct.pack(rectFormat, x, y, w, h))
+        for row in range(y, y + h):
+            start = row*rowLength + x*2
+            parts.append(bytes(current[start:start + w*2]))
+    return b"".join(parts)
+
+
+def encode_delta(previous, current, width, height, tileSize=16):
+    """
+    Encodes the changes from the previous to the current raw RGB565 frame.
+    Returns:
+        bytes: the delta data, or None if the delta would not be smaller than the full frame
+    """
+    rects = find_dirty_rects(previous, current, width, height, tileSize)
+    size = deltaHeaderSize
+    for _, _, w, h in rects:
+        size += rectSize + w*h*2
+    if size >= width*height*2:
+        return None
+    return encode_rects(current, width, rects)
+
+
+def apply_delta(frameBuffer, width, height, deltaData):
+    """
+    Patches the raw RGB565 data of the previous frame in place, so it holds the new frame.
+    Arguments:
+        frameBuffer (bytearray): width*height*2 bytes of the previous frame
+        deltaData (bytes-like): the delta data
+
+    Returns:
+        int: the number of patched rectangles
+    Raises ValueError if the delta data is damaged or does not fit the frame.
+    """
+    if len(deltaData) < deltaHeaderSize:
+        raise ValueError("The delta data is too short")
+    rectCount, = struct.unpack_from(deltaHeaderFormat, deltaData, 0)
+
+    rowLength = width*2
+    offset = deltaHeaderSize
+    for _ in range(rectCount):
+        if offset + rectSize > len(deltaData):
+            raise ValueError("The delta data is truncated")
+        x, y, w, h = struct.unpack_from(rectFormat, deltaData, offset)
+        offset += rectSize
+        if x + w > width or y + h > height or offset + w*h*2 > len(deltaData):
+            raise ValueError("A delta rectangle does not fit the frame")
+
+        for row in range(y, y + h):
+            start = row*rowLength + x*2
+            frameBuffer[start:start + w*2] = deltaData[offset:offset + w*2]
+            offset += w*2
+    return rectCount
+
+
+def validate_delta(width, height, deltaData):
+    """
+    Checks delta data like apply_delta() does, without a frame buffer. Data left after the last rectangle is also an error.
+    Returns:
+        int: the number of rectangles
+    Raises ValueError if the delta data is damaged or does not fit the frame.
+    """
+    if len(deltaData) < deltaHeaderSize:
+        raise ValueError("The delta data is too short")
+    rectCount, = struct.unpack_from(deltaHeaderFormat, deltaData, 0)
+
+    offset = deltaHeaderSize
+    for _ in range(rectCount):
+        if offset + rectSize > len(deltaData):
+            raise ValueError("The delta data is truncated")
+        x, y, w, h = struct.unpack_from(rectFormat, deltaData, offset)
+        offset += rectSize + w*h*2
+        if x + w > width or y + h > height or offset > len(deltaData):
+            raise ValueError("A delta rectangle does not fit the frame")
+    if offset != len(deltaData):
+        raise ValueError("There is data after the last delta rectangle")
+    return rectCount
+
+
+def self_check(width=240, height=240, frameCount=50):
+    import random
+
+    random.seed(1)
+    frame = bytearray(random.getrandbits(8) for _ in range(width*height*2))
+    decoded = bytearray(frame)
+    fullSize = 0
+    deltaSize = 0
+    for i in range(frameCount):
+        previous = bytes(frame)
+        # Redraw a few random rectangles, like sprites moving over a static background
+        for _ in range(i % 4):
+            x = random.randrange(width)
+            y = random.randrange(height)
+            w = random.randrange(1, width - x + 1) if i % 10 == 0 else min(random.randrange(1, 32), width - x)
+            h = min(random.randrange(1, 32), height - y)
+            color = random.getrandbits(16).to_bytes(2, "big")
+            for row in range(y, y + h):
+                frame[(row*width + x)*2:(row*width + x + w)*2] = color*w
+
+        rects = find_dirty_rects(previous, frame, width, height)
+        if np is not None and rects != _find_dirty_rects_python(previous, frame, width, height, 16):
+            raise AssertionError(f"Frame {i}: numpy and pure Python found different rectangles")
+
+        delta = encode_delta(previous, frame, width, height)
+        fullSize += len(frame)
+        if delta is None:
+            decoded[:] = frame
+            deltaSize += len(frame)
+        else:
+            if validate_delta(width, height, delta) != apply_delta(decoded, width, height, delta):
+                raise AssertionError(f"Frame {i}: validate_delta() and apply_delta() disagree on the rectangles")
+            deltaSize += len(delta)
+        if decoded != frame:
+            raise AssertionError(f"Frame {i} was not reproduced by its delta")
+
+    print(f"Delta self-check passed: {frameCount} frames, {deltaSize} bytes instead of {fullSize} ({deltaSize/fullSize*100:.1f} %)")
+
+
+if __name__ == "__main__":
+    self_check()
@@ -11,13 +11,25 @@ import time
 
 from typing import TypedDict
 
-from tkinter.filedialog import askdirectory
+from tkinter.filedialog import askdirectory, asksaveasfilename
 
-from PIL import Image, ImageTk
+from PIL import Image
 
-import sys
-import glob
-import serial
+import rgb565
+
+import stream_receiver
+
+import stream_protocol
+
+import stream_recorder
+
+import metrics
+
+import port_discovery
+
+import frame_renderer
+
+import stream_server
 
 class HeaderData(TypedDict):
     version: int
@@ -40,6 +52,35 @@ class main_window(ttk.Window):
         self.defaultFont = "Consolas"
         self.style.configure(".", font=f"{self.defaultFont} 9")
 
+        # Frames are received on a background thread, the GUI only takes the newest one from the buffer
+        self.frameBuffer = stream_receiver.FrameRingBuffer(3)
+        self.receiver = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # Every received frame is handed to the recorder on the receiver thread while a recording runs
+        self.recorder = None
+        self.recordingTargets = {"files":".binFrame files", "archive":".binFrames archive"}
+
+        # Displayed frames per second for the overlay, the stage timings are collected in metrics.registry
+        self.displayRate = metrics.RateMeter()
+        self.metricsWriter = metrics.start_writer_from_environment()
+
+        # Converts and scales the frames into buffers that are reused, the displayed PhotoImage is only
+        # replaced when the frame size or the scale factor changes
+        self.scaleFactors = [1, 2, 3, 4, 5, 6]
+        self.renderer = frame_renderer.FrameRenderer(3)
+
+        # Ports are found on a background thread, the GUI only reads the cached list
+        self.portScanner = port_discovery.PortScanner()
+        self.portScanner.start()
+        self.portListVersion = -1
+        self.availablePorts = []
+        self.connectRetryInterval_s = 2
+        self.nextConnectTime = 0
+
+        # Optional stream_server.StreamServer that serves the displayed frames to other viewers on this computer
+        self.streamServer = None
+        self.streamServerPort = 8080
 
         self.init_GUI()
 
@@ -69,25 +110,77 @@ class main_window(ttk.Window):
         self.portLabel = ttk.Label(self.portFrame, text="Pico port: ")
         self.portLabel.pack(fill=X, side=LEFT, expand=True)
 
-        self.availablePorts = self.list_serial_ports()
-
+        # Filled in by check_data_available once the first scan finished
         self.portBox = ttk.Combobox(self.portFrame, values=self.availablePorts, state=READONLY)
         self.portBox.pack(fill=X, side=RIGHT, expand=True)
-        try:
-            self.portBox.set(self.availablePorts[0])
-            self.init_serial_port()
-        except IndexError:
-            pass
 
         self.portBox.bind("<<ComboboxSelected>>", self.init_serial_port)
 
+        self.statsLabel = ttk.Label(self.operationFrame, text="")
+        self.statsLabel.pack(fill=X, side=TOP, expand=False, pady=10)
+
+        self.showOverlay = ttk.BooleanVar(value=False)
+        self.overlayButton = ttk.Checkbutton(self.operationFrame, text="Show FPS and latency overlay", variable=self.showOverlay)
+        self.overlayButton.pack(fill=X, side=TOP, expand=False, pady=(0, 10))
+
+        self.scaleFrame = ttk.Frame(self.operationFrame)
+        self.scaleFrame.pack(fill=X, side=TOP, expand=False, pady=(0, 10))
+        self.scaleLabel = ttk.Label(self.scaleFrame, text="Scale: ")
+        self.scaleLabel.pack(fill=X, side=LEFT, expand=True)
+        self.scaleBox = ttk.Combobox(self.scaleFrame, values=[f"{scaleFactor}x" for scaleFactor in self.scaleFactors], state=READONLY)
+        self.scaleBox.pack(fill=X, side=RIGHT, expand=True)
+        self.scaleBox.set(f"{self.renderer.scaleFactor}x")
+        self.scaleBox.bind("<<ComboboxSelected>>", self.change_scale_factor)
+
+        self.shareStream = ttk.BooleanVar(value=False)
+        self.shareStreamButton = ttk.Checkbutton(self.operationFrame, text=f"Share the stream on http://127.0.0.1:{self.streamServerPort}/",
+                                                 variable=self.shareStream, command=self.toggle_stream_server)
+        self.shareStreamButton.pack(fill=X, side=TOP, expand=False, pady=(0, 10))
+
+
+        self.recordingFrame = ttk.LabelFrame(self.operationFrame, text="Recording", padding=10)
+        self.recordingFrame.pack(fill=X, side=TOP, expand=False)
+
+        self.recordingTargetFrame = ttk.Frame(self.recordingFrame)
+        self.recordingTargetFrame.pack(fill=X, side=TOP, expand=False)
+        self.recordingTargetLabel = ttk.Label(self.recordingTargetFrame, text="Save as: ")
+        self.recordingTargetLabel.pack(fill=X, side=LEFT, expand=True)
+        self.recordingTargetBox = ttk.Combobox(self.recordingTargetFrame, values=list(self.recordingTargets.values()), state=READONLY)
+        self.recordingTargetBox.pack(fill=X, side=RIGHT, expand=True)
+        self.recordingTargetBox.set(self.recordingTargets["files"])
+
+        self.recordingGzip = ttk.BooleanVar(value=False)
+        self.recordingGzipButton = ttk.Checkbutton(self.recordingFrame, text="GZIP compression", variable=self.recordingGzip)
+        self.recordingGzipButton.pack(fill=X, side=TOP, expand=False, pady=5)
+
+        self.recordingIndexed = ttk.BooleanVar(value=False)
+        self.recordingIndexedButton = ttk.Checkbutton(self.recordingFrame, text="Store frames with few colors indexed", variable=self.recordingIndexed)
+        self.recordingIndexedButton.pack(fill=X, side=TOP, expand=False, pady=5)
+
+        self.recordButton = ttk.Button(
+            self.recordingFrame,
+            text="Start recording",
+            style="danger.TButton",
+            command=self.toggle_recording
+        )
+        self.recordButton.pack(fill=X, side=TOP, expand=False)
+
         self.imageLabel = ttk.Label(self.displayFrame)
         self.imageLabel.pack(anchor=CENTER, fill=None, side=TOP, expand=True, pady=10)
 
+        # Placed over the top left corner of the image while the overlay is enabled, so the text is not drawn into the frames
+        self.overlayLabel = ttk.Label(self.displayFrame, text="", foreground="#00FF00", background="black", padding=4)
+
 
     def init_serial_port(self, *_):
+        if self.receiver is not None:
+            self.receiver.stop()
+            self.receiver = None
+
         if not self.portBox.get() == "":
-            self.serialPort = serial.Serial(self.portBox.get(), 115200, timeout=0.5)
+            self.receiver = stream_receiver.SerialReceiver(self.portBox.get(), self.frameBuffer)
+            self.receiver.recorder = self.recorder
+            self.receiver.start()
 
 
     def show_GUI(self):
@@ -103,149 +196,208 @@ class main_window(ttk.Window):
         pass
 
     
-    def update_image_frame(self):
-        self.currentFrame = ImageTk.PhotoImage(self.convertedImage)
-        self.imageLabel.configure(image=self.currentFrame)
-        self.update()
+    def change_scale_factor(self, *_):
+        self.renderer.set_scale_factor(int(self.scaleBox.get().rstrip("x")))
+
+
+    def update_image_frame(self, frame:stream_receiver.ReceivedFrame):
+        # The convert, scale and render timers are recorded by the renderer
+        if self.renderer.render(frame["data"], frame["width"], frame["height"]):
+            self.imageLabel.configure(image=self.renderer.photoImage)
 
     
     def check_data_available(self):
-        try:
-            self.serialPort.writelines(["ready\n".encode("utf-8")])
-            if self.serialPort.in_waiting > 0:
-                self.serialPort.read(2)
-                self.receive_image()
-            self.after(40, self.check_data_available)
-        except AttributeError:
+        if self.portScanner.version != self.portListVersion:
+            self.portListVersion = self.portScanner.version
             self.availablePorts = self.list_serial_ports()
             self.portBox.configure(values=self.availablePorts)
 
-            self.init_serial_port()
+        if self.receiver is None or not self.receiver.is_alive():
+            # There is no port or it failed, connect to the first port found by the scanner
+            if self.receiver is not None:
+                self.receiver = None
+                self.portScanner.rescan()
+
+            if time.perf_counter() >= self.nextConnectTime:
+                if self.portBox.get() not in self.availablePorts:
+                    self.portBox.set(self.availablePorts[0] if len(self.availablePorts) > 0 else "")
+                if not self.portBox.get() == "":
+                    self.nextConnectTime = time.perf_counter() + self.connectRetryInterval_s
+                    self.init_serial_port()
+
+            self.after(100, self.check_data_available)
+            return
+
+        frame = self.frameBuffer.pop_latest()
+        if frame is not None:
+            self.show_frame(frame)
+        self.after(10, self.check_data_available)
+
 
-            try:
-                self.portBox.set(self.availablePorts[0])
-            except IndexError:
-                pass
-        
-            self.after(2000, self.check_data_available)
-        except serial.SerialException:
-            self.serialPort = 0
-            self.availablePorts = self.list_serial_ports()
-            self.portBox.configure(values=self.availablePorts)
+    def show_frame(self, frame:stream_receiver.ReceivedFrame):
+        self.update_image_frame(frame)
+        # Time from the complete reception of the frame until it is on the screen
+        metrics.registry.record("frame_latency", time.perf_counter() - frame["receivedTime"])
+        self.displayRate.tick()
+        self.update_overlay()
+        if self.streamServer is not None:
+            self.streamServer.publish(frame)
+
+        statsText = (f"Received frames: {self.receiver.receivedFrames}\n"
+                     f"Dropped frames: {self.frameBuffer.droppedFrames + self.frameBuffer.skippedFrames}\n"
+                     f"Timeouts: {self.receiver.timeouts}")
+        if self.receiver.link is not None:
+            statsText += (f"\nProtocol: v{self.receiver.link['version']}\n"
+                          f"Delta frames: {self.receiver.protocolStats['deltaFrames']}\n"
+                          f"CRC errors: {self.receiver.protocolStats['crcErrors']}\n"
+                          f"Delta errors: {self.receiver.protocolStats['deltaErrors']}\n"
+                          f"Retransmits: {self.receiver.protocolStats['retransmitRequests']}\n"
+                          + stream_protocol.link_summary(self.receiver.link, self.receiver.linkTuner))
+        else:
+            # The original protocol has no way to change its parameters
+            statsText += f"\nProtocol: v1, {self.receiver.packetCount} packets per frame"
+        if self.recorder is not None:
+            statsText += (f"\nRecorded frames: {self.recorder.recordedFrames}\n"
+                          f"Not recorded (writer too slow): {self.recorder.droppedFrames}\n"
+                          f"Merged duplicates: {self.recorder.duplicateFrames}")
+            if self.recorder.error is not None:
+                self.stop_recording()
+        if self.streamServer is not None:
+            clients = self.streamServer.httpServer.stats()["clients"]
+            statsText += f"\nViewers: {clients['mjpeg']} MJPEG, {clients['websocket']} WebSocket"
+        self.statsLabel.configure(text=statsText)
+
+
+    def update_overlay(self):
+        if not self.showOverlay.get():
+            self.overlayLabel.place_forget()
+            return
+
+        latencyP50, latencyP95, latencyP99 = metrics.registry.percentiles("frame_latency", 50, 95, 99)
+        text = f"{self.displayRate.rate():.1f} FPS"
+        if latencyP50 is not None:
+            text += f"\nlatency p50 {latencyP50*1000:.1f} ms\np95 {latencyP95*1000:.1f} ms  p99 {latencyP99*1000:.1f} ms"
+        self.overlayLabel.configure(text=text)
+        self.overlayLabel.place(in_=self.imageLabel, x=6, y=6)
+
+
+    def toggle_stream_server(self):
+        if self.streamServer is not None:
+            self.streamServer.stop()
+            self.streamServer = None
+        if not self.shareStream.get():
+            return
 
-            try:
-                self.portBox.set(self.availablePorts[0])
-            except IndexError:
-                self.portBox.set("")
-        
-            self.after(2000, self.check_data_available)
+        try:
+            self.streamServer = stream_server.StreamServer(self.streamServerPort)
+        except OSError as e:
+            self.shareStream.set(False)
+            popup.ToastNotification(
+                title="Sharing failed",
+                message=f"The stream server could not be started on port {self.streamServerPort}: {e}",
+                duration=5000,
+                icon="❌",
+                bootstyle=DANGER
+            ).show_toast()
+
+
+    def toggle_recording(self):
+        if self.recorder is None:
+            self.start_recording()
+        else:
+            self.stop_recording()
 
 
-    @staticmethod
-    def list_serial_ports():
-        # Source of this code: https://stackoverflow.com/questions/12090503/listing-available-com-ports-with-python
+    def start_recording(self):
+        archive = self.recordingTargetBox.get() == self.recordingTargets["archive"]
+        if archive:
+            path = asksaveasfilename(parent=self, title="Save the recording as", defaultextension=".binFrames", filetypes=[(".binFrames archive", "*.binFrames")])
+        else:
+            path = askdirectory(parent=self, title="Select a folder for the recorded frames", mustexist=False)
+        if not path:
+            return
+
+        try:
+            self.recorder = stream_recorder.StreamRecorder(path, archive, compressLevel=6 if self.recordingGzip.get() else None, indexedColors=self.recordingIndexed.get())
+        except OSError as e:
+            popup.ToastNotification(
+                title="Recording failed",
+                message=f"The recording could not be started: {e}",
+                duration=5000,
+                icon="❌",
+                bootstyle=DANGER
+            ).show_toast()
+            return
+
+        if self.receiver is not None:
+            self.receiver.recorder = self.recorder
+        self.recordButton.configure(text="Stop recording")
+        self.recordingTargetBox.configure(state=DISABLED)
+        self.recordingGzipButton.configure(state=DISABLED)
+        self.recordingIndexedButton.configure(state=DISABLED)
+
+
+    def stop_recording(self):
+        recorder = self.recorder
+        self.recorder = None
+        if self.receiver is not None:
+            self.receiver.recorder = None
+        # Writes the frames that are still queued
+        recorder.close()
+
+        self.recordButton.configure(text="Start recording")
+        self.recordingTargetBox.configure(state=READONLY)
+        self.recordingGzipButton.configure(state=NORMAL)
+        self.recordingIndexedButton.configure(state=NORMAL)
+
+        if recorder.error is not None:
+            popup.ToastNotification(
+                title="Recording failed",
+                message=f"Writing the recording failed after {recorder.recordedFrames} frames: {recorder.error}",
+                duration=5000,
+                icon="❌",
+                bootstyle=DANGER
+            ).show_toast()
+        else:
+            popup.ToastNotification(
+                title="Recording saved",
+                message=f"{recorder.recordedFrames} frames were saved to {recorder.path}, {recorder.droppedFrames} frames could not be recorded in time and {recorder.duplicateFrames} identical frames were merged.",
+                duration=5000,
+                icon="✅",
+                bootstyle=SUCCESS
+            ).show_toast()
+
+
+    def on_close(self):
+        if self.receiver is not None:
+            self.receiver.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.streamServer is not None:
+            self.streamServer.stop()
+        if self.metricsWriter is not None:
+            self.metricsWriter.stop()
+        self.portScanner.stop()
+        self.destroy()
+
+
+    def list_serial_ports(self):
         """ Lists serial port names
 
-            :raises EnvironmentError:
-                On unsupported or unknown platforms
             :returns:
-                A list of the serial ports available on the system
+                The ports found by the background scan, GamePico (RP2040) ports first
         """
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 1) for i in range(256)]
-        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            # this excludes your current terminal "/dev/tty"
-            ports = glob.glob('/dev/tty[A-Za-z]*')
-        elif sys.platform.startswith('darwin'):
-            ports = glob.glob('/dev/tty.*')
-        else:
-            raise EnvironmentError('Unsupported platform')
-
-        result = []
-        for port in ports:
-            try:
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError):
-                pass
-        return result
-       
+        return list(self.portScanner.ports)
+
 
     @staticmethod
     def color_array_convert(values565:np.ndarray) -> np.ndarray:
-        """ 
-        Converts the 16-bit color format to the 24-bit RGB format.
-        Arguments:
-            values565 (ndarray): ndarray of shape (H, W) or flat, dtype=uint16
-        
-        Returns:
-            ndarray: of shape (H, W, 3), dtype=uint8
-        """
-        r5 = (values565 >> 11) & 0x1F
-        g6 = (values565 >> 5) & 0x3F
-        b5 = values565 & 0x1F
-
-        # Convert to 8-bit (0–255) by scaling:
-        r8 = ((r5 * 255) // 31).astype(np.uint8)
-        g8 = ((g6 * 255) // 63).astype(np.uint8)
-        b8 = ((b5 * 255) // 31).astype(np.uint8)
-
-        return np.stack((r8, g8, b8), axis=-1)
-
-
-    def receive_image(self, scaleFactor:int = 3):
-        width = 240
-        height = 240
-        packetCount = 16
-        timeoutMs = 500
+        return rgb565.rgb565_to_rgb888(values565)
 
-        outputImage = Image.new("RGB", (width, height))
 
-        print("Receiving data... ", end="")
-        startTime = time.time_ns()
-
-        rawData = bytearray()
-
-        self.serialPort.writelines(["continue\n".encode("utf-8")])
-
-        while len(rawData) != width*height*2:
-            packet = self.serialPort.read(width*height*2//packetCount)
-            if len(packet) == width*height*2//packetCount:
-                rawData += packet
-                self.serialPort.writelines(["continue\n".encode("utf-8")])
-            else:
-                self.serialPort.writelines(["retry\n".encode("utf-8")])
-
-            if (time.time_ns() - startTime)//10000000 > timeoutMs:
-                print("Request timeout!")
-                return
-    
-        self.serialPort.writelines(["end\n".encode("utf-8")])
-
-        print(f"elapsed {(time.time_ns() - startTime)//1000/1000} ms")
-
-        print(f"Converting image, ", end="")
-        startTime = time.time_ns()
-        outputImage = self.convert_image(rawData, width, height)
-        print(f"elapsed {(time.time_ns() - startTime)//1000/1000} ms")
-
-        self.convertedImage = outputImage.resize((width*scaleFactor, height*scaleFactor), Image.Resampling.NEAREST)
-
-        self.update_image_frame()
-
-    
     def convert_image(self, raw_data, width, height):
-        # Convert raw RGB565 data from a bytearray to a NumPy array
-        image_data_565 = np.frombuffer(raw_data, dtype='>u2').reshape((height, width))
-
-        # Convert the RGB565 array to RGB888 array
-        rgb888_data = self.color_array_convert(image_data_565)
-
-        # Create the image using Pillow
-        img = Image.fromarray(rgb888_data, 'RGB')
-
-        return img
+        # Convert the raw big-endian RGB565 data to an RGB888 array and create the image using Pillow
+        return Image.fromarray(rgb565.convert_buffer(raw_data, width, height), 'RGB')
 
         
 if __name__ == "__main__":
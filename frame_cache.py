@@ -0,0 +1,155 @@
+# Cache of decoded frames with a background read-ahead, used for the preview navigation
+
+import threading
+
+from collections import OrderedDict
+
+from PIL import Image
+
+import binframe
+
+
+class DecodedFrameCache():
+    """
+    Thread-safe LRU cache of decoded Pillow images limited by the total size of their pixel data.
+    Keys are (path, mtime) pairs, so a frame that was overwritten on disk is decoded again.
+    """
+    def __init__(self, byteBudget:int = 256*1024*1024):
+        self.byteBudget = byteBudget
+        self.usedBytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def image_size(image:Image.Image) -> int:
+        return image.width * image.height * len(image.getbands())
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._frames
+
+    def get(self, key) -> Image.Image:
+        """
+        Returns the cached image and marks it as the most recently used one, or None.
+        """
+        with self._lock:
+            image = self._frames.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image:Image.Image):
+        size = self.image_size(image)
+        if size > self.byteBudget:
+            return
+
+        with self._lock:
+            oldImage = self._frames.pop(key, None)
+            if oldImage is not None:
+                self.usedBytes -= self.image_size(oldImage)
+
+            self._frames[key] = image
+            self.usedBytes += size
+
+            # Evict the least recently used frames until the budget is met again
+            while self.usedBytes > self.byteBudget:
+                _, evictedImage = self._frames.popitem(last=False)
+                self.usedBytes -= self.image_size(evictedImage)
+
+    def set_budget(self, byteBudget:int):
+        with self._lock:
+            self.byteBudget = byteBudget
+            while self.usedBytes > self.byteBudget and len(self._frames) > 0:
+                _, evictedImage = self._frames.popitem(last=False)
+                self.usedBytes -= self.image_size(evictedImage)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.usedBytes = 0
+
+
+class FramePrefetcher():
+    """
+    Loads frames of a frame index through the cache and decodes the frames
+    around the current position on a background thread, mostly in the direction of travel.
+    """
+    def __init__(self, frameIndex, cache:DecodedFrameCache, readAhead:int = 8, readBehind:int = 2):
+        self.frameIndex = frameIndex
+        self.decoder = binframe.FrameDecoder(frameIndex)
+        self.cache = cache
+        self.readAhead = readAhead
+        self.readBehind = readBehind
+
+        self._pending = []
+        self._stopped = False
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name="FramePrefetcher", daemon=True)
+        self._thread.start()
+
+    def frame_key(self, index:int) -> tuple:
+        return (self.frameIndex.paths[index], self.frameIndex.mtime(index))
+
+    def decode(self, index:int) -> Image.Image:
+        return self.decoder.to_image(index)
+
+    def load(self, index:int) -> Image.Image:
+        """
+        Returns the decoded frame, from the cache if possible.
+        Raises the same exceptions as the frame readers when the frame has to be decoded and is corrupted.
+        """
+        key = self.frame_key(index)
+        image = self.cache.get(key)
+        if image is None:
+            image = self.decode(index)
+            self.cache.put(key, image)
+        return image
+
+    def navigate(self, index:int, direction:int = 1):
+        """
+        Schedules the frames following the current one (in the direction of travel) and a few behind it.
+        Frames scheduled for a previous position are dropped.
+        """
+        frameCount = len(self.frameIndex)
+        if frameCount == 0:
+            return
+        direction = 1 if direction >= 0 else -1
+
+        # The preview wraps around at both ends, so the read-ahead does too
+        pending = [(index + direction*i) % frameCount for i in range(1, self.readAhead + 1)]
+        pending += [(index - direction*i) % frameCount for i in range(1, self.readBehind + 1)]
+
+        with self._condition:
+            self._pending = pending
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._pending = []
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and len(self._pending) == 0:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                index = self._pending.pop(0)
+
+            try:
+                key = self.frame_key(index)
+                if key not in self.cache:
+                    self.cache.put(key, self.decode(index))
+            except Exception:
+                # Corrupted frames are reported when they are actually selected
+                pass
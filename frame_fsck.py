@@ -0,0 +1,271 @@
+# Integrity checker for a directory of .binFrame files or a .binFrames archive, run before long exports
+#
+# Usage: python frame_fsck.py <input directory or archive> [-j workers] [--json report path, - for stdout]
+# Every frame is checked in a worker process: its header, the CRC32 of its payload (if the header carries one, see
+# "binFrame format info.md"), the GZIP stream and the size of the decompressed data, or the rectangles of delta data.
+# The id sequence (gaps, duplicates) and the delta chains are then checked across all frames.
+# The exit code is 0 if no problems were found, 1 otherwise.
+
+import argparse
+
+import os
+
+import sys
+
+import json
+
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import binframe
+
+import binframe_archive
+
+import delta_codec
+
+import pixel_formats
+
+import metrics
+
+
+# Kinds of problems in the report
+headerProblem = "header"
+checksumProblem = "checksum"
+payloadProblem = "payload"
+chainProblem = "chain"
+sequenceProblem = "sequence"
+
+# Frames sent to a worker at once, so 100k small files do not cost one IPC round trip each
+jobSize = 256
+
+
+# Archives and decompression buffers of this worker process, so each archive is only mapped once
+_openedArchives = {}
+_scratchBuffers = {}
+
+
+def _scratch_buffer(size:int) -> bytearray:
+    buffer = _scratchBuffers.get(size)
+    if buffer is None:
+        buffer = _scratchBuffers[size] = bytearray(size)
+    return buffer
+
+
+def check_frame(reader:binframe.FrameBufferReader) -> list:
+    """
+    Checks one frame without decoding its pixels. The decompressed data goes into a reused buffer.
+    Returns:
+        list: of (kind, description) tuples, empty if the frame is intact
+    """
+    problems = []
+    headerData = reader.header
+    error = reader.verify_checksum()
+    if error is not None:
+        problems.append((checksumProblem, error))
+
+    try:
+        size = binframe.frame_size(headerData)
+    except ValueError as e:
+        return problems + [(headerProblem, str(e))]
+    if headerData["width"] == 0 or headerData["height"] == 0:
+        problems.append((headerProblem, "The frame has no pixels"))
+
+    if headerData["delta"]:
+        if headerData["pixelFormat"] != pixel_formats.rgb565BE:
+            return problems + [(headerProblem, "A delta frame has to contain RGB565 data")]
+        try:
+            deltaData = reader.raw_data()
+            try:
+                delta_codec.validate_delta(headerData["width"], headerData["height"], deltaData)
+            finally:
+                if isinstance(deltaData, memoryview):
+                    deltaData.release()
+        except ValueError as e:
+            problems.append((payloadProblem, str(e)))
+        return problems
+
+    error = reader.read_raw_into(_scratch_buffer(size))
+    if error is not None:
+        problems.append((payloadProblem, error))
+    return problems
+
+
+def open_frame(archivePath, key, path) -> binframe.FrameBufferReader:
+    if archivePath is None:
+        return binframe.BinFrameReader(path)
+    if archivePath not in _openedArchives:
+        _openedArchives[archivePath] = binframe_archive.BinFramesArchive(archivePath)
+    return _openedArchives[archivePath].open_frame(key)
+
+
+def check_frames(job) -> list:
+    """
+    Worker function run inside the process pool.
+    Arguments:
+        job (tuple): (archive path or None for a directory, list of (position in the archive or file name, path))
+
+    Returns:
+        list: of (key, id or None, delta, checksummed, size of the frame data, list of problems) for every frame of the job
+    """
+    archivePath, frames = job
+    results = []
+    for key, path in frames:
+        try:
+            reader = open_frame(archivePath, key, path)
+        except (ValueError, OSError, IndexError) as e:
+            results.append((key, None, False, False, 0, [(headerProblem, str(e))]))
+            continue
+        with reader:
+            with reader.payload() as payload:
+                size = reader.header["headerLength"] + len(payload)
+            problems = check_frame(reader)
+            results.append((key, reader.header["id"], reader.header["delta"], reader.header["crc32"] is not None, size, problems))
+    return results
+
+
+def id_ranges(ids:list) -> list:
+    """
+    Returns:
+        list: of [first, last] ranges of the ids missing between the smallest and the largest id
+    """
+    missing = []
+    for previous, current in zip(ids, ids[1:]):
+        if current > previous + 1:
+            missing.append([previous + 1, current - 1])
+    return missing
+
+
+def check_source(path, workers:int = None, progressCallback = None, mpContext = None) -> dict:
+    """
+    Checks every frame of a directory or an archive in parallel.
+    Arguments:
+        progressCallback (function): optional, called with (checked frames, total frames)
+        mpContext: optional multiprocessing context for the worker processes
+    Returns:
+        dict: the report (see main())
+    Raises ValueError or OSError if the directory cannot be listed or the file is not an archive.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if os.path.isdir(path):
+        archivePath = None
+        frames = [(name, path + "/" + name) for name in binframe.list_binframe_names(path)]
+    else:
+        archivePath = path
+        with binframe_archive.BinFramesArchive(path) as archive:
+            frames = list(enumerate(archive.paths))
+
+    jobs = [(archivePath, frames[i:i + jobSize]) for i in range(0, len(frames), jobSize)]
+    results = []
+    startTime = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mpContext)
+    try:
+        for jobResults in executor.map(check_frames, jobs):
+            results.extend(jobResults)
+            if progressCallback is not None:
+                progressCallback(len(results), len(frames))
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+    # The frames of a directory are played in the order of their ids (like binframe.FrameIndex), an archive keeps its order
+    if archivePath is None:
+        results.sort(key=lambda result: (result[1] is None, result[1] or 0, result[0]))
+    paths = dict(frames)
+
+    problems = []
+    damaged = set()
+    previousIntact = False
+    previousId = None
+    for position, (key, id, delta, _, _, frameProblems) in enumerate(results):
+        for kind, description in frameProblems:
+            problems.append({"path": paths[key], "position": position, "id": id, "kind": kind, "problem": description})
+        if len(frameProblems) > 0:
+            damaged.add(position)
+        elif delta and (not previousIntact or previousId is None or id != previousId + 1):
+            # The frames after a damaged or missing frame cannot be decoded until the next full frame
+            problems.append({"path": paths[key], "position": position, "id": id, "kind": chainProblem,
+                             "problem": "The frame before this delta frame is damaged or missing"})
+            damaged.add(position)
+        previousIntact = position not in damaged
+        previousId = id
+
+    positionsById = {}
+    for position, result in enumerate(results):
+        if result[1] is not None:
+            positionsById.setdefault(result[1], []).append(position)
+    ids = sorted(positionsById)
+    missingIds = id_ranges(ids)
+    duplicateIds = []
+    for id in ids:
+        if len(positionsById[id]) > 1:
+            duplicateIds.append({"id": id, "paths": [paths[results[position][0]] for position in positionsById[id]]})
+            for position in positionsById[id]:
+                problems.append({"path": paths[results[position][0]], "position": position, "id": id, "kind": sequenceProblem,
+                                 "problem": "Another frame has the same id"})
+
+    metrics.registry.count("frames_checked", len(results))
+    metrics.registry.count("damaged_frames", len(damaged))
+    return {
+        "source": path,
+        "frames": len(results),
+        "damagedFrames": len(damaged),
+        "checksummedFrames": sum(1 for result in results if result[3]),
+        "bytes": sum(result[4] for result in results),
+        "elapsed_s": round(time.perf_counter() - startTime, 3),
+        "missingIds": missingIds,
+        "duplicateIds": duplicateIds,
+        "problems": problems,
+        "ok": len(problems) == 0 and len(missingIds) == 0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check every frame of a directory of .binFrame files or a .binFrames archive for damage.")
+    parser.add_argument("input", help="directory with .binFrame files or a .binFrames archive")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--json", default=None, help="write the report as JSON to this file, - for stdout")
+    args = parser.parse_args(argv)
+
+    metricsWriter = metrics.start_writer_from_environment()
+    try:
+        report = check_source(args.input, args.workers)
+    except (ValueError, OSError) as e:
+        print(f"Cannot open {args.input}: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if metricsWriter is not None:
+            metricsWriter.stop()
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=1)
+        print_report(report)
+    return 0 if report["ok"] else 1
+
+
+def print_report(report:dict):
+    for problem in report["problems"]:
+        print(f"{problem['path']} (id {problem['id']}): {problem['problem']}")
+    for first, last in report["missingIds"]:
+        print(f"Missing ids {first}-{last}" if first != last else f"Missing id {first}")
+
+    elapsed = max(report["elapsed_s"], 1e-9)
+    print(f"Checked {report['frames']} frames ({report['bytes']/1e6:.1f} MB, {report['checksummedFrames']} with a checksum) "
+          f"in {elapsed:.3f} s ({report['frames']/elapsed:.1f} frames/s)")
+    if report["ok"]:
+        print("No problems were found.")
+    else:
+        print(f"{report['damagedFrames']} damaged frames, {sum(last - first + 1 for first, last in report['missingIds'])} missing ids, "
+              f"{len(report['duplicateIds'])} duplicate ids")
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,127 @@
+# Converts and upscales received frames for the live view without allocating memory per frame
+#
+# All buffers are allocated once for a frame size and scale factor and reused for every following frame:
+#   RGB565 data -> index buffer -> RGBA buffer (lookup table) -> scaled RGBA buffer (integer repetition)
+# Frames of other pixel formats (see pixel_formats.py) are first converted into an RGB565 buffer.
+# The scaled buffer is mapped into a Pillow image, which is pasted into one long-lived Tk PhotoImage.
+
+import numpy as np
+
+from PIL import Image
+
+import rgb565
+
+import pixel_formats
+
+import metrics
+
+
+class FrameRenderer():
+    """
+    Renders RGB565 frames into one PhotoImage that is only replaced when the frame size or the scale factor changes.
+    Arguments:
+        scaleFactor (int): integer upscale of the displayed image
+    """
+    def __init__(self, scaleFactor:int = 3):
+        self.scaleFactor = scaleFactor
+        self.width = 0
+        self.height = 0
+        # Only created by render(), so prepare() can be used without a Tk window
+        self.photoImage = None
+
+        self._indices = None
+        self._values565 = None
+        self._rgba = None
+        self._scaled = None
+        self._scaledBlocks = None
+        self.image = None
+
+    def set_scale_factor(self, scaleFactor:int):
+        """
+        Takes effect with the next frame.
+        """
+        scaleFactor = max(1, int(scaleFactor))
+        if scaleFactor != self.scaleFactor:
+            self.scaleFactor = scaleFactor
+            # Forces _allocate() on the next frame
+            self.width = 0
+            self.height = 0
+
+    def _allocate(self, width:int, height:int):
+        scale = self.scaleFactor
+        self.width = width
+        self.height = height
+        self._indices = np.empty((height, width), dtype=np.intp)
+        self._values565 = np.empty((height, width), dtype='>u2')
+        self._rgba = np.empty((height, width), dtype=np.uint32)
+        self._scaled = np.empty((height*scale, width*scale), dtype=np.uint32)
+        # View of the scaled buffer in which every source pixel owns one (scale, scale) block
+        self._scaledBlocks = self._scaled.reshape((height, scale, width, scale))
+        # Shares the memory of the scaled buffer, so it always shows its current content
+        self.image = Image.frombuffer('RGBA', (width*scale, height*scale), self._scaled, 'raw', 'RGBA', 0, 1)
+        self.photoImage = None
+
+    def prepare(self, rawData, width:int, height:int, pixelFormat:int = pixel_formats.rgb565BE, palette:bytes = b"") -> Image.Image:
+        """
+        Converts the pixel data (big-endian RGB565 unless another format is given) and upscales it into the preallocated buffers.
+        Returns:
+            Image: the image mapped onto the scaled buffer, valid until the next call
+        """
+        if width != self.width or height != self.height:
+            self._allocate(width, height)
+
+        with metrics.registry.timer("convert"):
+            if pixelFormat == pixel_formats.rgb565BE:
+                values565 = np.frombuffer(rawData, dtype='>u2', count=width*height).reshape((height, width))
+            else:
+                values565 = pixel_formats.get(pixelFormat).to_rgb565(rawData, width, height, palette, self._values565)
+            rgb565.rgb565_to_rgba8888(values565, self._rgba, self._indices)
+        with metrics.registry.timer("scale"):
+            # Fill the first row of every block one column at a time, then copy it to the other rows.
+            # Broadcasting the whole block at once is about twice as slow, the innermost axis is too short.
+            for column in range(self.scaleFactor):
+                self._scaledBlocks[:, 0, :, column] = self._rgba
+            self._scaledBlocks[:, 1:] = self._scaledBlocks[:, :1]
+        return self.image
+
+    def render(self, rawData, width:int, height:int, pixelFormat:int = pixel_formats.rgb565BE, palette:bytes = b"") -> bool:
+        """
+        Shows a frame in `photoImage`. Needs an existing Tk window.
+        Returns:
+            bool: True if photoImage was replaced and has to be set on the widget again
+        """
+        image = self.prepare(rawData, width, height, pixelFormat, palette)
+        # Imported here, so the benchmark can use prepare() where tkinter is not installed
+        from PIL import ImageTk
+        with metrics.registry.timer("render"):
+            replaced = self.photoImage is None
+            if replaced:
+                self.photoImage = ImageTk.PhotoImage('RGBA', image.size)
+            self.photoImage.paste(image)
+        return replaced
+
+
+def verify(width:int = 240, height:int = 240):
+    values = np.random.default_rng(0).integers(0, 65536, width*height, dtype=np.uint16).astype('>u2')
+    rawData = values.tobytes()
+    renderer = FrameRenderer()
+    for scaleFactor in (1, 2, 3, 5):
+        renderer.set_scale_factor(scaleFactor)
+        image = renderer.prepare(rawData, width, height)
+        expected = Image.fromarray(rgb565.convert_buffer(rawData, width, height), 'RGB').resize((width*scaleFactor, height*scaleFactor), Image.Resampling.NEAREST)
+        if not np.array_equal(np.asarray(image.convert('RGB')), np.asarray(expected)):
+            raise AssertionError(f"Rendered frame does not match the Pillow conversion at scale {scaleFactor}")
+
+    # Every 4-bit index of a 16 color palette
+    indexedFormat = pixel_formats.get(pixel_formats.indexed4)
+    palette = values[:16].tobytes()
+    values565 = values[:16][np.arange(width*height).reshape((height, width)) % 16]
+    image = renderer.prepare(indexedFormat.encode(values565, palette), width, height, indexedFormat.id, palette)
+    expected = Image.fromarray(rgb565.rgb565_to_rgb888(values565), 'RGB').resize(image.size, Image.Resampling.NEAREST)
+    if not np.array_equal(np.asarray(image.convert('RGB')), np.asarray(expected)):
+        raise AssertionError("Rendered indexed frame does not match the Pillow conversion")
+    print("Rendered frames match the Pillow conversion at scales 1, 2, 3 and 5 and for indexed data.")
+
+
+if __name__ == "__main__":
+    verify()
@@ -0,0 +1,216 @@
+# Timers, counters and rolling percentiles shared by all tools
+#
+# Every stage records into the shared `registry`, e.g.
+#     with metrics.registry.timer("decompress"):
+#         ...
+#     metrics.registry.count("serial_bytes", len(packet))
+#
+# Setting the environment variable GAMEPICO_METRICS to a .json or .csv path makes the tools dump a snapshot
+# of all metrics into that file periodically (every GAMEPICO_METRICS_INTERVAL seconds, 10 by default).
+
+import csv
+
+import json
+
+import os
+
+import sys
+
+import threading
+
+import time
+
+from collections import deque
+
+
+class RollingHistogram():
+    """
+    Keeps the last `size` samples, so the percentiles follow the current behavior instead of the whole run.
+    """
+    def __init__(self, size:int = 1024):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value:float):
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentiles(self, *percents) -> list:
+        samples = sorted(self._samples)
+        if len(samples) == 0:
+            return [None for _ in percents]
+        return [samples[min(len(samples) - 1, int(len(samples)*percent/100))] for percent in percents]
+
+    def summary(self) -> dict:
+        p50, p95, p99 = self.percentiles(50, 95, 99)
+        return {
+            "count": self.count,
+            "mean_ms": self.total/self.count*1000 if self.count > 0 else None,
+            "p50_ms": p50*1000 if p50 is not None else None,
+            "p95_ms": p95*1000 if p95 is not None else None,
+            "p99_ms": p99*1000 if p99 is not None else None,
+        }
+
+
+class _Timer():
+    def __init__(self, metrics, name:str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._metrics.record(self._name, time.perf_counter() - self._startTime)
+
+
+class Metrics():
+    """
+    Thread-safe registry of named timers (durations in seconds) and counters.
+    """
+    def __init__(self, histogramSize:int = 1024):
+        self.histogramSize = histogramSize
+        self.startTime = time.time()
+        self._timers = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def timer(self, name:str) -> _Timer:
+        """
+        Context manager recording the duration of its block.
+        """
+        return _Timer(self, name)
+
+    def record(self, name:str, seconds:float):
+        with self._lock:
+            histogram = self._timers.get(name)
+            if histogram is None:
+                histogram = self._timers[name] = RollingHistogram(self.histogramSize)
+            histogram.add(seconds)
+
+    def count(self, name:str, amount:int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counter(self, name:str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def percentiles(self, name:str, *percents) -> list:
+        """
+        Returns the percentiles of a timer in seconds (None if nothing was recorded yet).
+        """
+        with self._lock:
+            histogram = self._timers.get(name)
+            if histogram is None:
+                return [None for _ in percents]
+            return histogram.percentiles(*percents)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "time": time.time(),
+                "uptime_s": time.time() - self.startTime,
+                "timers": {name: histogram.summary() for name, histogram in sorted(self._timers.items())},
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+            self.startTime = time.time()
+
+
+registry = Metrics()
+
+
+class RateMeter():
+    """
+    Events per second over a sliding time window, e.g. the displayed frames per second.
+    """
+    def __init__(self, window_s:float = 2.0):
+        self.window_s = window_s
+        self._times = deque()
+
+    def tick(self, now:float = None):
+        now = time.perf_counter() if now is None else now
+        self._times.append(now)
+        while self._times[0] < now - self.window_s:
+            self._times.popleft()
+
+    def rate(self) -> float:
+        if len(self._times) < 2:
+            return 0.0
+        return (len(self._times) - 1)/max(self._times[-1] - self._times[0], 1e-9)
+
+
+def flatten_snapshot(snapshot:dict) -> dict:
+    # One column per timer statistic and counter, for the CSV file
+    flat = {"time": snapshot["time"], "uptime_s": snapshot["uptime_s"]}
+    for name, summary in snapshot["timers"].items():
+        for key, value in summary.items():
+            flat[f"{name}.{key}"] = value
+    for name, value in snapshot["counters"].items():
+        flat[name] = value
+    return flat
+
+
+class MetricsWriter(threading.Thread):
+    """
+    Appends a snapshot of the metrics to a file every interval_s seconds and once more when stopped.
+    A .csv path gets one row per snapshot (the header is written again when new metrics appear),
+    any other path one JSON object per line.
+    `error` holds the exception of the last failed write (None if every write succeeded), it is also printed to stderr,
+    so it does not mix with the results the tools print to stdout.
+    """
+    def __init__(self, path, metrics:Metrics = registry, interval_s:float = 10.0):
+        super().__init__(name="MetricsWriter", daemon=True)
+        self.path = path
+        self.metrics = metrics
+        self.interval_s = interval_s
+        self._csvColumns = None
+        self.error = None
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self._stopEvent.wait(self.interval_s):
+            self.write_snapshot()
+        self.write_snapshot()
+
+    def write_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        try:
+            if self.path.lower().endswith(".csv"):
+                row = flatten_snapshot(snapshot)
+                with open(self.path, 'a', newline="") as f:
+                    if self._csvColumns is None or not set(row).issubset(self._csvColumns):
+                        self._csvColumns = list(row)
+                        csv.writer(f).writerow(self._csvColumns)
+                    csv.DictWriter(f, self._csvColumns, restval="").writerow(row)
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(snapshot) + "\n")
+        except OSError as e:
+            self.error = e
+            print(f"Writing the metrics to {self.path} failed: {e}", file=sys.stderr)
+
+
+def start_writer_from_environment(metrics:Metrics = registry) -> MetricsWriter:
+    """
+    Starts a MetricsWriter if GAMEPICO_METRICS is set. Returns it, or None.
+    """
+    path = os.environ.get("GAMEPICO_METRICS")
+    if not path:
+        return None
+    writer = MetricsWriter(path, metrics, float(os.environ.get("GAMEPICO_METRICS_INTERVAL", "10")))
+    writer.start()
+    return writer
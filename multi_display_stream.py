@@ -0,0 +1,234 @@
+# Live view of several GamePicos side by side, e.g. for a test bench
+#
+# All devices are received by one multi_stream_receiver.MultiStreamReceiver thread. Every device gets a tile with its
+# own live view, FPS and error counters. GamePicos are connected as soon as they are plugged in, other ports can be added by hand.
+
+import ttkbootstrap as ttk
+from ttkbootstrap.constants import *
+
+import math
+
+import time
+
+import multi_stream_receiver
+
+import stream_protocol
+
+import metrics
+
+import port_discovery
+
+import frame_renderer
+
+
+class DeviceTile():
+    """
+    The live view and the counters of one device in the grid.
+    """
+    def __init__(self, parent, session:multi_stream_receiver.DeviceSession, scaleFactor:int, removeCommand):
+        self.session = session
+        self.portName = session.portName
+        self.renderer = frame_renderer.FrameRenderer(scaleFactor)
+        # Time at which a failed port is opened again
+        self.reconnectTime = None
+
+        self.frame = ttk.LabelFrame(parent, text=self.portName, padding=10)
+        self.imageLabel = ttk.Label(self.frame)
+        self.imageLabel.pack(anchor=CENTER, fill=None, side=TOP, expand=True)
+        self.statsLabel = ttk.Label(self.frame, text="Connecting...")
+        self.statsLabel.pack(fill=X, side=TOP, expand=False, pady=(10, 0))
+        self.removeButton = ttk.Button(self.frame, text="Disconnect", style="secondary.TButton", command=lambda: removeCommand(self))
+        self.removeButton.pack(fill=X, side=TOP, expand=False, pady=(10, 0))
+
+    def show_latest_frame(self) -> bool:
+        frame = self.session.ringBuffer.pop_latest()
+        if frame is None:
+            return False
+        if self.renderer.render(frame["data"], frame["width"], frame["height"]):
+            self.imageLabel.configure(image=self.renderer.photoImage)
+        metrics.registry.record("frame_latency", time.perf_counter() - frame["receivedTime"])
+        return True
+
+    def update_stats(self):
+        session = self.session
+        statsText = (f"{session.frameRate.rate():.1f} FPS\n"
+                     f"Received frames: {session.receivedFrames}\n"
+                     f"Dropped frames: {session.ringBuffer.droppedFrames + session.ringBuffer.skippedFrames}\n"
+                     f"Timeouts: {session.timeouts}")
+        if session.link is not None:
+            statsText += (f"\nProtocol: v{session.link['version']}\n"
+                          f"Delta frames: {session.protocolStats['deltaFrames']}\n"
+                          f"CRC errors: {session.protocolStats['crcErrors']}\n"
+                          f"Delta errors: {session.protocolStats['deltaErrors']}\n"
+                          f"Retransmits: {session.protocolStats['retransmitRequests']}\n"
+                          + stream_protocol.link_summary(session.link, session.linkTuner))
+        elif session.receivedFrames > 0:
+            # The original protocol has no way to change its parameters
+            statsText += f"\nProtocol: v1, {session.packetCount} packets per frame"
+        if session.error is not None:
+            statsText += f"\nError: {session.error}"
+        self.statsLabel.configure(text=statsText)
+
+
+class main_window(ttk.Window):
+    def __init__(self):
+        # Initialize the main window and set the title, theme and minimal size
+        super().__init__("Live screen streams", "darkly")
+        self.minsize(600, 500)
+
+        # Set up the default theme and style font
+        self.defaultFont = "Consolas"
+        self.style.configure(".", font=f"{self.defaultFont} 9")
+
+        # One thread receives every device, the GUI only takes the newest frame of each device
+        self.receiver = multi_stream_receiver.MultiStreamReceiver()
+        self.receiver.start()
+        self.tiles = []
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        self.metricsWriter = metrics.start_writer_from_environment()
+        self.displayRate = metrics.RateMeter()
+
+        self.scaleFactors = [1, 2, 3, 4]
+        self.scaleFactor = 2
+
+        # Ports are found on a background thread, the GUI only reads the cached lists
+        self.portScanner = port_discovery.PortScanner()
+        self.portScanner.start()
+        self.portListVersion = -1
+        self.availablePorts = []
+        # Ports that were disconnected by hand are not connected automatically again until they are unplugged
+        self.ignoredPorts = set()
+        self.connectRetryInterval_s = 2
+        self.statsInterval_s = 0.5
+        self.nextStatsTime = 0
+
+        self.init_GUI()
+
+        self.after(10, self.check_data_available)
+
+
+    def init_GUI(self):
+        self.leftFrame = ttk.Frame(self, padding=10)
+        self.rightFrame = ttk.Frame(self, padding=10)
+
+        self.operationFrame = ttk.LabelFrame(self.leftFrame, text="Devices:", padding=10)
+        self.operationFrame.pack(fill=BOTH, side=LEFT, expand=False)
+
+        self.portFrame = ttk.Frame(self.operationFrame)
+        self.portFrame.pack(fill=X, side=TOP, expand=False)
+        self.portLabel = ttk.Label(self.portFrame, text="Port: ")
+        self.portLabel.pack(fill=X, side=LEFT, expand=True)
+        # Not read-only, so ports that are not found by the scanner (e.g. pseudo terminals of fake devices) can be typed in
+        self.portBox = ttk.Combobox(self.portFrame, values=self.availablePorts)
+        self.portBox.pack(fill=X, side=RIGHT, expand=True)
+
+        self.addButton = ttk.Button(self.operationFrame, text="Connect", command=self.add_selected_port)
+        self.addButton.pack(fill=X, side=TOP, expand=False, pady=(5, 10))
+
+        self.autoConnect = ttk.BooleanVar(value=True)
+        self.autoConnectButton = ttk.Checkbutton(self.operationFrame, text="Connect every GamePico found", variable=self.autoConnect)
+        self.autoConnectButton.pack(fill=X, side=TOP, expand=False, pady=(0, 10))
+
+        self.scaleFrame = ttk.Frame(self.operationFrame)
+        self.scaleFrame.pack(fill=X, side=TOP, expand=False, pady=(0, 10))
+        self.scaleLabel = ttk.Label(self.scaleFrame, text="Scale: ")
+        self.scaleLabel.pack(fill=X, side=LEFT, expand=True)
+        self.scaleBox = ttk.Combobox(self.scaleFrame, values=[f"{scaleFactor}x" for scaleFactor in self.scaleFactors], state=READONLY)
+        self.scaleBox.pack(fill=X, side=RIGHT, expand=True)
+        self.scaleBox.set(f"{self.scaleFactor}x")
+        self.scaleBox.bind("<<ComboboxSelected>>", self.change_scale_factor)
+
+        self.statsLabel = ttk.Label(self.operationFrame, text="")
+        self.statsLabel.pack(fill=X, side=TOP, expand=False, pady=10)
+
+        self.gridFrame = ttk.Frame(self.rightFrame)
+        self.gridFrame.pack(fill=BOTH, side=TOP, expand=True)
+
+        self.leftFrame.pack(anchor=NE, fill=NONE, side=LEFT, expand=False)
+        self.rightFrame.pack(anchor=NW, fill=BOTH, side=RIGHT, expand=True)
+
+
+    def change_scale_factor(self, *_):
+        self.scaleFactor = int(self.scaleBox.get().rstrip("x"))
+        for tile in self.tiles:
+            tile.renderer.set_scale_factor(self.scaleFactor)
+
+
+    def add_selected_port(self):
+        portName = self.portBox.get().strip()
+        if portName != "":
+            self.ignoredPorts.discard(portName)
+            self.add_device(portName)
+
+
+    def add_device(self, portName):
+        if any(tile.portName == portName for tile in self.tiles):
+            return
+        tile = DeviceTile(self.gridFrame, self.receiver.add_device(portName), self.scaleFactor, self.remove_device)
+        self.tiles.append(tile)
+        self.layout_tiles()
+
+
+    def remove_device(self, tile:DeviceTile):
+        self.receiver.remove_device(tile.session)
+        self.ignoredPorts.add(tile.portName)
+        self.tiles.remove(tile)
+        tile.frame.destroy()
+        self.layout_tiles()
+
+
+    def layout_tiles(self):
+        # As square as possible, so the views stay large with many devices
+        columns = max(1, math.ceil(math.sqrt(len(self.tiles))))
+        for i, tile in enumerate(self.tiles):
+            tile.frame.grid(row=i//columns, column=i % columns, padx=5, pady=5, sticky=NSEW)
+
+
+    def check_data_available(self):
+        if self.portScanner.version != self.portListVersion:
+            self.portListVersion = self.portScanner.version
+            self.availablePorts = list(self.portScanner.ports)
+            self.portBox.configure(values=self.availablePorts)
+            # Unplugged ports are connected automatically again once they come back
+            self.ignoredPorts &= set(self.availablePorts)
+
+        if self.autoConnect.get():
+            for portName in self.portScanner.picoPorts:
+                if portName not in self.ignoredPorts:
+                    self.add_device(portName)
+
+        now = time.perf_counter()
+        for tile in self.tiles:
+            if tile.show_latest_frame():
+                self.displayRate.tick(now)
+            if tile.session.closed and tile.session.error is not None:
+                # The port failed, open it again after a while
+                if tile.reconnectTime is None:
+                    tile.reconnectTime = now + self.connectRetryInterval_s
+                    tile.update_stats()
+                    self.portScanner.rescan()
+                elif now >= tile.reconnectTime:
+                    tile.reconnectTime = None
+                    tile.session = self.receiver.add_device(tile.portName)
+
+        if now >= self.nextStatsTime:
+            self.nextStatsTime = now + self.statsInterval_s
+            for tile in self.tiles:
+                tile.update_stats()
+            self.statsLabel.configure(text=f"Devices: {len(self.tiles)}\nDisplayed frames: {self.displayRate.rate():.1f} FPS")
+
+        self.after(10, self.check_data_available)
+
+
+    def on_close(self):
+        self.receiver.stop()
+        if self.metricsWriter is not None:
+            self.metricsWriter.stop()
+        self.portScanner.stop()
+        self.destroy()
+
+
+if __name__ == "__main__":
+    mainWindow = main_window()
+    mainWindow.mainloop()
@@ -0,0 +1,440 @@
+# Receives the live streams of several GamePicos at once on a single background thread
+#
+# Every device gets a DeviceSession: a state machine for the handshake, the original ready/continue/retry/end protocol and
+# version 2 (stream_protocol.FrameReceiver). The ports are opened without blocking and one selector waits on all of them,
+# so a slow or silent device never holds up the others. Windows cannot select on serial ports, there the ports are polled.
+#
+# Running this file directly streams from several fake devices on pseudo terminals (see benchmark.FakeGamePico)
+# and checks that every device delivered its own frames.
+
+import os
+
+import queue
+
+import selectors
+
+import threading
+
+import time
+
+import serial
+
+import stream_protocol
+
+from stream_receiver import FrameRingBuffer, ReceivedFrame
+
+import metrics
+
+
+class DeviceSession():
+    """
+    The connection to one device, driven by MultiStreamReceiver. The counters can be read from any thread.
+    The arguments are the same as for stream_receiver.SerialReceiver, version 2 links are negotiated and tuned the same way.
+    """
+    def __init__(self, portName, baudrate:int = 115200, width:int = 240, height:int = 240, packetCount:int = 16, timeoutMs:int = 500,
+                 readyInterval_s:float = 0.04, window:int = 4, helloTimeout_s:float = 0.3, ringBufferSize:int = 3,
+                 requestedBaudrate:int = 921600, tuneLink:bool = True):
+        self.portName = portName
+        self.ringBuffer = FrameRingBuffer(ringBufferSize)
+        self.baudrate = baudrate
+        self.width = width
+        self.height = height
+        self.packetCount = packetCount
+        self.timeoutMs = timeoutMs
+        self.readyInterval_s = readyInterval_s
+        self.window = window
+        self.helloTimeout_s = helloTimeout_s
+        self.requestedBaudrate = requestedBaudrate
+        self.tuneLink = tuneLink
+
+        # Set once the device answered the version 2 handshake
+        self.link = None
+        self.protocolStats = stream_protocol.new_protocol_stats()
+        # Set if the device can change its link parameters, it holds the measured throughput
+        self.linkTuner = None
+
+        # Optional stream_recorder.StreamRecorder that gets every received frame of this device
+        self.recorder = None
+
+        # Set if the port failed, the session is closed then
+        self.error = None
+        self.receivedFrames = 0
+        self.timeouts = 0
+        self.frameRate = metrics.RateMeter()
+
+        self.port = None
+        self._state = None
+        self._deadline = 0
+        self._input = bytearray()
+        self._output = bytearray()
+        self._sequence = 0
+
+        self._frameReceiver = None
+        self._baseFrameNumber = None
+        self._pendingLink = None
+        self._linkAttempts = 0
+        self._linkStartTime = 0
+        self._frameStartTime = 0
+        self._packetStartTime = 0
+        self._rawData = bytearray()
+
+    @property
+    def closed(self) -> bool:
+        return self.port is None
+
+    @property
+    def errors(self) -> int:
+        return self.timeouts + self.protocolStats["crcErrors"] + self.protocolStats["deltaErrors"]
+
+    def open(self, now:float):
+        self.port = serial.Serial(self.portName, self.baudrate, timeout=0, write_timeout=0)
+        self.port.reset_input_buffer()
+        self._state = "hello"
+        self._deadline = now + self.helloTimeout_s
+        self._send(stream_protocol.hello_command())
+
+    def close(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+
+    @property
+    def wantsWrite(self) -> bool:
+        return len(self._output) > 0
+
+    def _send(self, data:bytes):
+        self._output += data
+
+    def flush(self):
+        """
+        Writes as much of the queued commands as the port takes without blocking.
+        """
+        if len(self._output) > 0:
+            written = self.port.write(self._output)
+            del self._output[:written or 0]
+
+    def on_readable(self, now:float):
+        data = self.port.read(65536)
+        if len(data) == 0:
+            return
+
+        if self._state == "v2":
+            self._send(self._frameReceiver.feed(data, now))
+            self._check_frame_v2(now)
+            return
+
+        self._input += data
+        if self._state == "hello":
+            if b"\n" in self._input:
+                line = self._input.split(b"\n", 1)[0]
+                self._input.clear()
+                link = stream_protocol.parse_hello(line)
+                if link is not None:
+                    self._start_v2(link, now)
+                else:
+                    self._start_v1(now)
+        elif self._state == "link":
+            # Late packets of the previous frame may still arrive before the answer
+            start = self._input.rfind(b"LINK")
+            if start >= 0 and b"\n" in self._input[start:]:
+                answer = stream_protocol.parse_link_answer(self._input[start:].split(b"\n", 1)[0])
+                self._input.clear()
+                if answer is not None:
+                    self._finish_link(answer, now)
+        elif self._state == "ready":
+            # The device has a frame
+            if len(self._input) >= 2:
+                self._input.clear()
+                self._state = "packets"
+                self._rawData = bytearray()
+                self._frameStartTime = now
+                self._packetStartTime = now
+                self._send(b"continue\n")
+        elif self._state == "packets":
+            self._receive_packets_v1(now)
+
+    def poll(self, now:float):
+        """
+        Handles the timeouts, called regularly even if nothing was received.
+        """
+        if self._state == "v2":
+            self._send(self._frameReceiver.poll(now))
+            self._check_frame_v2(now)
+        elif self._state == "hello":
+            if now >= self._deadline:
+                # Devices with only the original protocol ignore the hello line
+                self._start_v1(now)
+        elif self._state == "link":
+            if now >= self._deadline:
+                self._send_link_command(now)
+        elif self._state == "ready":
+            if now >= self._deadline:
+                # Announce again that a frame can be sent
+                self._deadline = now + self.readyInterval_s
+                self._send(b"ready\n")
+        elif self._state == "packets":
+            if (now - self._packetStartTime)*1000 > self.timeoutMs:
+                metrics.registry.count("retries")
+                self._input.clear()
+                self._packetStartTime = now
+                self._send(b"retry\n")
+            if (now - self._frameStartTime)*1000 > self.timeoutMs:
+                metrics.registry.count("timeouts")
+                self.timeouts += 1
+                self._start_v1(now)
+
+    def _start_v1(self, now:float):
+        self._state = "ready"
+        self._input.clear()
+        self._deadline = now + self.readyInterval_s
+        self._send(b"ready\n")
+
+    def _receive_packets_v1(self, now:float):
+        frameSize = self.width*self.height*2
+        packetSize = frameSize//self.packetCount
+        while len(self._input) >= packetSize:
+            metrics.registry.count("serial_bytes", packetSize)
+            self._rawData += self._input[:packetSize]
+            del self._input[:packetSize]
+            if len(self._rawData) == frameSize:
+                self._send(b"end\n")
+                self.push_frame(bytes(self._rawData), self.width, self.height, now)
+                self._start_v1(now)
+                return
+            self._packetStartTime = now
+            self._send(b"continue\n")
+
+    def _start_v2(self, link:stream_protocol.LinkInfo, now:float):
+        # Delta frames patch the last received frame in place, a full frame is requested again after any failure
+        self._frameReceiver = stream_protocol.FrameReceiver(link, self.window, stats=self.protocolStats)
+        self._baseFrameNumber = None
+        self.link = link
+        # Devices without the link command do not answer at all, so it is only sent once after the handshake
+        self._change_link(link["packetSize"], self.requestedBaudrate, 1, now)
+
+    def _change_link(self, packetSize:int, baudrate:int, attempts:int, now:float):
+        self._state = "link"
+        self._pendingLink = (packetSize, baudrate)
+        self._linkAttempts = attempts
+        self._send_link_command(now)
+
+    def _send_link_command(self, now:float):
+        # The command is repeated if the answer got lost, until then the device may already use the new size
+        if self._linkAttempts == 0:
+            # The device cannot change its link, or it stopped answering. Frames are requested anyway, they time out in the second case.
+            self.linkTuner = None
+            self._request_frame_v2(now)
+            return
+        self._linkAttempts -= 1
+        self._input.clear()
+        self._linkStartTime = now
+        self._deadline = now + self.helloTimeout_s
+        self._send(stream_protocol.link_command(*self._pendingLink))
+
+    def _finish_link(self, answer:tuple, now:float):
+        stream_protocol.apply_link_answer(self.link, answer, self.window, now - self._linkStartTime)
+        if self.link["baudrate"] > 0 and self.port.baudrate != self.link["baudrate"]:
+            self.port.baudrate = self.link["baudrate"]
+        if self.linkTuner is None and self.tuneLink:
+            self.linkTuner = stream_protocol.LinkTuner(self.link)
+        self._request_frame_v2(now)
+
+    def _request_frame_v2(self, now:float):
+        self._state = "v2"
+        receiver = self._frameReceiver
+        self._send(receiver.start(receiver.frameNumber + 1, now, self._baseFrameNumber))
+
+    def _check_frame_v2(self, now:float):
+        receiver = self._frameReceiver
+        if not receiver.done:
+            return
+        if receiver.result is None:
+            # A delta frame that could not be applied is only counted in protocolStats["deltaErrors"]
+            if receiver.timedOut:
+                self.timeouts += 1
+            self._baseFrameNumber = None
+        else:
+            self.push_frame(bytes(receiver.result), self.link["width"], self.link["height"], now)
+            self._baseFrameNumber = receiver.frameNumber
+
+        packetSize = self.linkTuner.frame_finished(self.protocolStats, now) if self.linkTuner is not None else None
+        if packetSize is not None:
+            self._change_link(packetSize, 0, 3, now)
+        else:
+            self._request_frame_v2(now)
+
+    def push_frame(self, rawData:bytes, width:int, height:int, now:float):
+        self._sequence += 1
+        self.receivedFrames += 1
+        self.frameRate.tick(now)
+        metrics.registry.count("frames_received")
+        frame = ReceivedFrame(
+            data=rawData,
+            width=width,
+            height=height,
+            sequence=self._sequence,
+            receivedTime=now
+        )
+        self.ringBuffer.push(frame)
+
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.add_frame(frame)
+
+
+class MultiStreamReceiver(threading.Thread):
+    """
+    Drives any number of DeviceSessions on one thread. Devices can be added and removed at any time from other threads.
+    A device whose port fails is closed and keeps its `error`, add it again to reconnect.
+    Arguments:
+        tick_s (float): longest wait for data before the timeouts of the sessions are checked
+    """
+    def __init__(self, tick_s:float = 0.005):
+        super().__init__(name="MultiStreamReceiver", daemon=True)
+        self.tick_s = tick_s
+        self._changes = queue.SimpleQueue()
+        self._sessions = []
+        self._stopEvent = threading.Event()
+        # Serial ports are not selectable on Windows, they are read without blocking every tick instead
+        self._selector = selectors.DefaultSelector() if os.name != "nt" else None
+
+    def add_device(self, portName, **sessionArguments) -> DeviceSession:
+        """
+        Arguments:
+            sessionArguments: passed to DeviceSession
+        Returns:
+            DeviceSession: the new session, it is opened on the receiver thread
+        """
+        session = DeviceSession(portName, **sessionArguments)
+        self._changes.put(("add", session))
+        return session
+
+    def remove_device(self, session:DeviceSession):
+        self._changes.put(("remove", session))
+
+    def stop(self):
+        self._stopEvent.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        try:
+            while not self._stopEvent.is_set():
+                self._apply_changes()
+                readable = self._wait()
+                now = time.perf_counter()
+                for session in list(self._sessions):
+                    try:
+                        if session in readable:
+                            session.on_readable(now)
+                        session.poll(now)
+                        session.flush()
+                    except (serial.SerialException, OSError) as e:
+                        session.error = e
+                        self._close(session)
+                        continue
+                    self._update_events(session)
+        finally:
+            for session in list(self._sessions):
+                self._close(session)
+            if self._selector is not None:
+                self._selector.close()
+
+    def _apply_changes(self):
+        while True:
+            try:
+                change, session = self._changes.get_nowait()
+            except queue.Empty:
+                return
+            if change == "remove":
+                if session in self._sessions:
+                    self._close(session)
+                continue
+
+            try:
+                session.open(time.perf_counter())
+            except (serial.SerialException, OSError, ValueError) as e:
+                session.error = e
+                session.close()
+                continue
+            self._sessions.append(session)
+            if self._selector is not None:
+                self._selector.register(session.port, selectors.EVENT_READ, session)
+
+    def _update_events(self, session:DeviceSession):
+        # Waiting for a writable port is only needed while the port did not take all commands
+        if self._selector is None:
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session.wantsWrite else 0)
+        if self._selector.get_key(session.port).events != events:
+            self._selector.modify(session.port, events, session)
+
+    def _close(self, session:DeviceSession):
+        self._sessions.remove(session)
+        if self._selector is not None:
+            self._selector.unregister(session.port)
+        session.close()
+
+    def _wait(self) -> set:
+        """
+        Returns:
+            set: the sessions that may have received data
+        """
+        if self._selector is None or len(self._sessions) == 0:
+            time.sleep(self.tick_s)
+            return set(self._sessions)
+        return {key.data for key, _ in self._selector.select(self.tick_s)}
+
+
+def self_check(deviceCount:int = 4, duration_s:float = 2.0):
+    import pty
+    import tty
+
+    import numpy as np
+
+    import benchmark
+
+    width = 240
+    height = 240
+    rng = np.random.default_rng(0)
+    devices = []
+    descriptors = []
+    receiver = MultiStreamReceiver()
+    receiver.start()
+    sessions = []
+    try:
+        for i in range(deviceCount):
+            master, slave = pty.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            descriptors += [master, slave]
+            # Half of the devices only speak the original protocol, every device sends frames that only it uses
+            frames = [benchmark.generate_content("noise", width, height, j, rng) for j in range(3)]
+            device = benchmark.FakeGamePico(master, frames, width, height, protocol=2 if i % 2 == 0 else 1)
+            device.start()
+            devices.append(device)
+            sessions.append(receiver.add_device(os.ttyname(slave), width=width, height=height))
+
+        time.sleep(duration_s)
+        for device, session in zip(devices, sessions):
+            if session.error is not None:
+                raise AssertionError(f"{session.portName} failed: {session.error}")
+            frame = session.ringBuffer.pop_latest()
+            if frame is None or bytes(frame["data"]) not in device.frames:
+                raise AssertionError(f"{session.portName} did not receive the frames of its device")
+            if (session.link is not None) != (device.protocol == 2):
+                raise AssertionError(f"{session.portName} negotiated the wrong protocol")
+    finally:
+        receiver.stop()
+        for device in devices:
+            device.stop()
+        for descriptor in descriptors:
+            os.close(descriptor)
+
+    print(f"Multi-device check passed: {deviceCount} devices at once, " + ", ".join(
+        f"v{2 if session.link is not None else 1} {session.receivedFrames/duration_s:.1f} frames/s" for session in sessions))
+
+
+if __name__ == "__main__":
+    self_check()
@@ -0,0 +1,251 @@
+# Registry of the pixel formats a V2 .binFrame can use (see "binFrame format info.md")
+#
+# Every format decodes to RGB888 for viewing and exporting, and to big-endian RGB565 for the tools that work on raw values
+# (delta frames, GIF palettes, duplicate detection). Palettes are stored as RGB565, so that conversion is lossless.
+# The indexed formats decode with one table lookup per byte of data: a table built from the palette maps each
+# possible byte directly to all of the pixels it contains.
+#
+# Running this file directly checks that every format reproduces encoded frames exactly and benchmarks the decoders.
+
+import numpy as np
+
+import time
+
+import rgb565
+
+
+# Ids stored in byte 22 of a V2 header
+rgb565BE = 0
+rgb565LE = 1
+indexed8 = 2
+indexed4 = 3
+indexed1 = 4
+
+formats = {}
+
+
+class PixelFormat():
+    """
+    Base class of the pixel formats. Each row of pixel data starts on a whole byte.
+    Arguments:
+        id (int): the id stored in the header
+        name (str): short name for command lines and messages
+        bitsPerPixel (int): size of one pixel in the data
+        paletteSize (int): maximum number of palette entries, 0 for formats without a palette
+    """
+    def __init__(self, id:int, name:str, bitsPerPixel:int, paletteSize:int = 0):
+        self.id = id
+        self.name = name
+        self.bitsPerPixel = bitsPerPixel
+        self.paletteSize = paletteSize
+
+    def row_size(self, width:int) -> int:
+        return (width*self.bitsPerPixel + 7)//8
+
+    def frame_size(self, width:int, height:int) -> int:
+        """
+        Returns the number of bytes of the (decompressed) pixel data of a frame.
+        """
+        return self.row_size(width)*height
+
+    def to_rgb565(self, rawData, width:int, height:int, palette:bytes = b"", out:np.ndarray = None) -> np.ndarray:
+        """
+        Returns:
+            ndarray: of shape (height, width), dtype='>u2' (out, if it was given)
+        """
+        raise NotImplementedError
+
+    def to_rgb888(self, rawData, width:int, height:int, palette:bytes = b"", out:np.ndarray = None) -> np.ndarray:
+        """
+        Returns:
+            ndarray: of shape (height, width, 3), dtype=uint8 (out, if it was given)
+        """
+        return rgb565.rgb565_to_rgb888(self.to_rgb565(rawData, width, height, palette), out)
+
+    def encode(self, values565:np.ndarray, palette:bytes = b"") -> bytes:
+        """
+        Encodes big-endian RGB565 values of shape (height, width) in this format.
+        Raises ValueError if a color is missing from the palette.
+        """
+        raise NotImplementedError
+
+
+class RGB565Format(PixelFormat):
+    def __init__(self, id:int, name:str, byteorder:str):
+        super().__init__(id, name, 16)
+        self.byteorder = byteorder
+        self.dtype = '>u2' if byteorder == "big" else '<u2'
+
+    def to_rgb565(self, rawData, width:int, height:int, palette:bytes = b"", out:np.ndarray = None) -> np.ndarray:
+        values = np.frombuffer(rawData, dtype=self.dtype, count=width*height).reshape((height, width))
+        if out is None:
+            return values.astype('>u2')
+        np.copyto(out, values)
+        return out
+
+    def to_rgb888(self, rawData, width:int, height:int, palette:bytes = b"", out:np.ndarray = None) -> np.ndarray:
+        return rgb565.convert_buffer(rawData, width, height, self.byteorder, out)
+
+    def encode(self, values565:np.ndarray, palette:bytes = b"") -> bytes:
+        return values565.astype(self.dtype).tobytes()
+
+
+class IndexedFormat(PixelFormat):
+    """
+    1, 2, 4 or 8 bit palette indices, the first pixel in the most significant bits of each byte.
+    Indices beyond the palette of a frame are shown black.
+    """
+    def __init__(self, id:int, name:str, bitsPerPixel:int):
+        super().__init__(id, name, bitsPerPixel, 1 << bitsPerPixel)
+        self.pixelsPerByte = 8//bitsPerPixel
+        self._tables = (None, None, None)
+
+    def byte_tables(self, palette:bytes) -> tuple:
+        """
+        Returns:
+            tuple: (RGB565 table, RGB888 table), mapping each of the 256 byte values to the pixels it contains.
+                Their rows are single elements of pixelsPerByte*2 and pixelsPerByte*3 bytes, so one lookup copies all pixels at once.
+        """
+        # A recording usually keeps its palette, so the tables of the last palette are kept
+        tables = self._tables
+        if tables[0] == palette:
+            return tables[1], tables[2]
+
+        colors = np.zeros(self.paletteSize, dtype='>u2')
+        colors[:len(palette)//2] = np.frombuffer(palette, dtype='>u2', count=min(len(palette)//2, self.paletteSize))
+        shifts = np.arange(8 - self.bitsPerPixel, -1, -self.bitsPerPixel)
+        indices = (np.arange(256)[:, None] >> shifts) & (self.paletteSize - 1)
+        table565 = colors[indices]
+        table888 = rgb565.rgb565_to_rgb888(table565)
+        table565 = np.ascontiguousarray(table565).view(f'V{self.pixelsPerByte*2}').reshape(256)
+        table888 = table888.reshape((256, self.pixelsPerByte*3)).view(f'V{self.pixelsPerByte*3}').reshape(256)
+        self._tables = (bytes(palette), table565, table888)
+        return table565, table888
+
+    def _lookup(self, rawData, width:int, height:int, table:np.ndarray, out:np.ndarray, channels:tuple) -> np.ndarray:
+        rowSize = self.row_size(width)
+        data = np.frombuffer(rawData, dtype=np.uint8, count=rowSize*height).reshape((height, rowSize))
+        if rowSize*self.pixelsPerByte == width and out.flags.c_contiguous:
+            # No padding at the end of the rows, so the lookup writes straight into out
+            np.take(table, data, out=out.reshape((height, -1)).view(table.dtype))
+        else:
+            pixels = np.take(table, data).view(out.dtype).reshape((height, rowSize*self.pixelsPerByte) + channels)
+            out[:] = pixels[:, :width]
+        return out
+
+    def to_rgb565(self, rawData, width:int, height:int, palette:bytes = b"", out:np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty((height, width), dtype='>u2')
+        return self._lookup(rawData, width, height, self.byte_tables(palette)[0], out, ())
+
+    def to_rgb888(self, rawData, width:int, height:int, palette:bytes = b"", out:np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.uint8)
+        return self._lookup(rawData, width, height, self.byte_tables(palette)[1], out, (3,))
+
+    def encode(self, values565:np.ndarray, palette:bytes = b"") -> bytes:
+        colors = np.frombuffer(palette, dtype='>u2')
+        positions = np.full(65536, -1, dtype=np.int32)
+        # The first entry wins for colors that are in the palette twice
+        positions[colors[::-1]] = np.arange(len(colors) - 1, -1, -1)
+        indices = positions[values565]
+        if indices.min(initial=0) < 0:
+            raise ValueError("A color of the frame is not in the palette")
+
+        height, width = values565.shape
+        padded = np.zeros((height, self.row_size(width)*self.pixelsPerByte), dtype=np.uint8)
+        padded[:, :width] = indices
+        packed = np.zeros((height, self.row_size(width)), dtype=np.uint8)
+        for i in range(self.pixelsPerByte):
+            packed |= padded[:, i::self.pixelsPerByte] << (8 - self.bitsPerPixel*(i + 1))
+        return packed.tobytes()
+
+
+def register(pixelFormat:PixelFormat):
+    formats[pixelFormat.id] = pixelFormat
+
+
+def get(formatId:int) -> PixelFormat:
+    """
+    Raises ValueError for unknown formats.
+    """
+    pixelFormat = formats.get(formatId)
+    if pixelFormat is None:
+        raise ValueError(f"Unsupported pixel format {formatId}")
+    return pixelFormat
+
+
+def by_name(name:str) -> PixelFormat:
+    for pixelFormat in formats.values():
+        if pixelFormat.name == name:
+            return pixelFormat
+    raise ValueError(f"Unknown pixel format {name}")
+
+
+register(RGB565Format(rgb565BE, "rgb565", "big"))
+register(RGB565Format(rgb565LE, "rgb565le", "little"))
+register(IndexedFormat(indexed8, "indexed8", 8))
+register(IndexedFormat(indexed4, "indexed4", 4))
+register(IndexedFormat(indexed1, "indexed1", 1))
+
+
+def smallest_format(values565:np.ndarray) -> tuple:
+    """
+    Picks the smallest format that stores the frame exactly: an indexed format if it has few enough colors, RGB565 otherwise.
+    Returns:
+        tuple: (PixelFormat, palette as big-endian RGB565 bytes, b"" for RGB565)
+    """
+    colors = np.unique(values565)
+    for formatId in (indexed1, indexed4, indexed8):
+        pixelFormat = formats[formatId]
+        if len(colors) <= pixelFormat.paletteSize:
+            return pixelFormat, colors.astype('>u2').tobytes()
+    return formats[rgb565BE], b""
+
+
+def benchmark(width:int = 240, height:int = 240, iterations:int = 200):
+    rng = np.random.default_rng(0)
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    for pixelFormat in formats.values():
+        palette = rng.integers(0, 65536, pixelFormat.paletteSize, dtype=np.uint16).astype('>u2').tobytes()
+        rawData = rng.integers(0, 256, pixelFormat.frame_size(width, height), dtype=np.uint8).tobytes()
+        pixelFormat.to_rgb888(rawData, width, height, palette, out)
+
+        startTime = time.perf_counter()
+        for _ in range(iterations):
+            pixelFormat.to_rgb888(rawData, width, height, palette, out)
+        frameTime = (time.perf_counter() - startTime) / iterations
+        print(f"{pixelFormat.name}: {frameTime*1000:.3f} ms/frame, {pixelFormat.frame_size(width, height)} bytes/frame")
+
+
+def verify():
+    rng = np.random.default_rng(0)
+    # Odd widths leave padding bits at the end of the rows
+    for width, height in ((240, 240), (13, 7), (1, 3)):
+        for pixelFormat in formats.values():
+            if pixelFormat.paletteSize > 0:
+                colors = rng.choice(65536, pixelFormat.paletteSize, replace=False).astype('>u2')
+                palette = colors.tobytes()
+                values565 = colors[rng.integers(0, len(colors), (height, width))]
+            else:
+                palette = b""
+                values565 = rng.integers(0, 65536, (height, width), dtype=np.uint16).astype('>u2')
+
+            rawData = pixelFormat.encode(values565, palette)
+            if len(rawData) != pixelFormat.frame_size(width, height):
+                raise AssertionError(f"{pixelFormat.name} encodes {len(rawData)} bytes instead of {pixelFormat.frame_size(width, height)}")
+            if not np.array_equal(pixelFormat.to_rgb565(rawData, width, height, palette), values565):
+                raise AssertionError(f"{pixelFormat.name} does not decode to the encoded RGB565 values at {width}x{height}")
+            if not np.array_equal(pixelFormat.to_rgb888(rawData, width, height, palette), rgb565.rgb565_to_rgb888(values565)):
+                raise AssertionError(f"{pixelFormat.name} does not decode to the expected RGB888 values at {width}x{height}")
+
+            chosenFormat, chosenPalette = smallest_format(values565)
+            if chosenFormat.frame_size(width, height) > pixelFormat.frame_size(width, height):
+                raise AssertionError(f"smallest_format() picked {chosenFormat.name} for a frame that fits {pixelFormat.name}")
+
+    print(f"All {len(formats)} pixel formats reproduce the encoded frames exactly.")
+
+
+if __name__ == "__main__":
+    verify()
+    benchmark()
@@ -0,0 +1,129 @@
+# Finds the serial port of a GamePico from the USB metadata of the ports, without opening any of them
+#
+# The scan runs on a background thread and is cached. It is repeated when a device is plugged in or out
+# (if the platform allows detecting that cheaply), when rescan() is called, and otherwise with a growing interval.
+
+import os
+
+import sys
+
+import threading
+
+import time
+
+from serial.tools import list_ports
+
+
+# USB vendor id of Raspberry Pi, used by every RP2040 firmware (MicroPython, CircuitPython, the Pico SDK)
+picoVendorId = 0x2E8A
+
+
+def list_ports_by_kind() -> tuple:
+    """
+    Returns:
+        tuple: (sorted names of the RP2040 ports, sorted names of the ports of other USB devices)
+    """
+    picoPorts = []
+    otherPorts = []
+    for port in list_ports.comports():
+        if port.vid == picoVendorId:
+            picoPorts.append(port.device)
+        elif port.vid is not None:
+            # Ports without USB metadata are built-in serial ports, which never belong to a GamePico
+            otherPorts.append(port.device)
+    return (sorted(picoPorts), sorted(otherPorts))
+
+
+def list_ports_sorted(onlyPico:bool = False) -> list:
+    """
+    Lists the serial ports from the enumeration metadata, the RP2040 ports first.
+    Arguments:
+        onlyPico (bool): leave out the ports of other devices
+
+    Returns:
+        list: of port names (e.g. "COM5" or "/dev/ttyACM0")
+    """
+    picoPorts, otherPorts = list_ports_by_kind()
+    return picoPorts if onlyPico else picoPorts + otherPorts
+
+
+def hotplug_signature():
+    """
+    Returns a value that changes when a device is plugged in or out, or None where that cannot be checked cheaply.
+    On Linux and macOS the device nodes are created and removed in /dev, which changes its modification time.
+    """
+    if sys.platform.startswith('win'):
+        return None
+    try:
+        return os.stat("/dev").st_mtime_ns
+    except OSError:
+        return None
+
+
+class PortScanner(threading.Thread):
+    """
+    Keeps the list of available ports up to date on a background thread.
+    `ports` can be read at any time without blocking, `version` increases whenever it changes.
+    """
+    def __init__(self, onlyPico:bool = False, minInterval_s:float = 1.0, maxInterval_s:float = 10.0, hotplugInterval_s:float = 0.5):
+        super().__init__(name="PortScanner", daemon=True)
+        self.onlyPico = onlyPico
+        self.minInterval_s = minInterval_s
+        self.maxInterval_s = maxInterval_s
+        self.hotplugInterval_s = hotplugInterval_s
+
+        self.ports = []
+        # The ports in `ports` that belong to an RP2040
+        self.picoPorts = []
+        self.version = 0
+        self.error = None
+
+        self._rescanEvent = threading.Event()
+        self._stopEvent = threading.Event()
+
+    def rescan(self):
+        """
+        Requests a scan as soon as possible, e.g. after the connection to a port failed.
+        """
+        self._rescanEvent.set()
+
+    def stop(self):
+        self._stopEvent.set()
+        self._rescanEvent.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        interval = self.minInterval_s
+        while not self._stopEvent.is_set():
+            self._rescanEvent.clear()
+            signature = hotplug_signature()
+            self.scan()
+
+            # Scan again sooner while nothing was found, back off while nothing changes
+            if len(self.ports) == 0:
+                interval = self.minInterval_s
+            else:
+                interval = min(interval*2, self.maxInterval_s)
+
+            nextScan = time.monotonic() + interval
+            while not self._stopEvent.is_set() and time.monotonic() < nextScan:
+                if self._rescanEvent.wait(self.hotplugInterval_s):
+                    break
+                if signature is not None and hotplug_signature() != signature:
+                    interval = self.minInterval_s
+                    break
+
+    def scan(self):
+        try:
+            picoPorts, otherPorts = list_ports_by_kind()
+        except OSError as e:
+            self.error = e
+            return
+        self.error = None
+        ports = picoPorts if self.onlyPico else picoPorts + otherPorts
+        if ports != self.ports:
+            # Set before the version changes, so a reader that sees the new version also sees both lists
+            self.picoPorts = picoPorts
+            self.ports = ports
+            self.version += 1
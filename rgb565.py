@@ -0,0 +1,157 @@
+# RGB565 -> RGB888 conversion through a precomputed lookup table shared by all tools
+#
+# Running this file directly checks the table against the arithmetic formula and benchmarks both.
+
+import numpy as np
+
+import time
+
+
+_lookupTable = None
+_lookupTablePixels = None
+_lookupTableRGBA = None
+
+
+def formula_convert(values565:np.ndarray) -> np.ndarray:
+    """
+    Converts the 16-bit color format to the 24-bit RGB format arithmetically.
+    This is the reference implementation the lookup table is built from.
+    Arguments:
+        values565 (ndarray): ndarray of shape (H, W) or flat, dtype=uint16
+
+    Returns:
+        ndarray: of shape (H, W, 3), dtype=uint8
+    """
+    r5 = (values565 >> 11) & 0x1F
+    g6 = (values565 >> 5) & 0x3F
+    b5 = values565 & 0x1F
+
+    # Convert to 8-bit (0–255) by scaling:
+    r8 = ((r5 * 255) // 31).astype(np.uint8)
+    g8 = ((g6 * 255) // 63).astype(np.uint8)
+    b8 = ((b5 * 255) // 31).astype(np.uint8)
+
+    return np.stack((r8, g8, b8), axis=-1)
+
+
+def get_lookup_table() -> np.ndarray:
+    """
+    Returns the (65536, 3) uint8 table mapping every RGB565 value to RGB888.
+    The table is built on first use and shared afterwards.
+    """
+    global _lookupTable, _lookupTablePixels
+    if _lookupTable is None:
+        table = formula_convert(np.arange(65536, dtype=np.uint32))
+        table.flags.writeable = False
+        # Viewing each 3 byte row as one element lets a lookup copy whole pixels instead of single channels
+        _lookupTablePixels = table.view('V3').reshape(65536)
+        _lookupTable = table
+    return _lookupTable
+
+
+def rgb565_to_rgb888(values565:np.ndarray, out:np.ndarray = None) -> np.ndarray:
+    """
+    Converts the 16-bit color format to the 24-bit RGB format with a single table lookup.
+    Arguments:
+        values565 (ndarray): ndarray of shape (H, W) or flat, dtype=uint16 of either byte order
+        out (ndarray): optional preallocated uint8 output of shape values565.shape + (3,)
+
+    Returns:
+        ndarray: of shape (H, W, 3), dtype=uint8 (out, if it was given)
+    """
+    get_lookup_table()
+    if out is None:
+        out = np.empty(values565.shape + (3,), dtype=np.uint8)
+    np.take(_lookupTablePixels, values565, out=out.view('V3').reshape(values565.shape))
+    return out
+
+
+def get_lookup_table_rgba() -> np.ndarray:
+    """
+    Returns the (65536,) uint32 table mapping every RGB565 value to a whole RGBA pixel.
+    In memory the bytes of each element are R, G, B, 255, so an array of them can be used directly as an RGBA image.
+    """
+    global _lookupTableRGBA
+    if _lookupTableRGBA is None:
+        table = np.empty((65536, 4), dtype=np.uint8)
+        table[:, :3] = get_lookup_table()
+        table[:, 3] = 255
+        table = table.view(np.uint32).reshape(65536)
+        table.flags.writeable = False
+        _lookupTableRGBA = table
+    return _lookupTableRGBA
+
+
+def rgb565_to_rgba8888(values565:np.ndarray, out:np.ndarray, indices:np.ndarray = None) -> np.ndarray:
+    """
+    Converts the 16-bit color format to opaque RGBA pixels packed in uint32 values, without any temporary arrays
+    when the index buffer is given.
+    Arguments:
+        values565 (ndarray): ndarray of shape (H, W), dtype=uint16 of either byte order
+        out (ndarray): preallocated uint32 output of shape (H, W)
+        indices (ndarray): optional preallocated intp scratch buffer of shape (H, W)
+
+    Returns:
+        ndarray: out
+    """
+    table = get_lookup_table_rgba()
+    if indices is None:
+        indices = values565.astype(np.intp)
+    else:
+        np.copyto(indices, values565)
+    # With mode="clip" np.take writes straight into out instead of buffering the result
+    np.take(table, indices, out=out, mode="clip")
+    return out
+
+
+def convert_buffer(raw_data, width:int, height:int, byteorder:str = "big", out:np.ndarray = None) -> np.ndarray:
+    """
+    Converts a raw RGB565 buffer (bytes, bytearray or memoryview) without copying the source.
+    Arguments:
+        byteorder (str): "big" for the .binFrame / stream data, "little" for little-endian sources
+
+    Returns:
+        ndarray: of shape (height, width, 3), dtype=uint8
+    """
+    dtype = '>u2' if byteorder == "big" else '<u2'
+    values565 = np.frombuffer(raw_data, dtype=dtype, count=width*height).reshape((height, width))
+    return rgb565_to_rgb888(values565, out)
+
+
+def benchmark(width:int = 240, height:int = 240, iterations:int = 200):
+    rawData = np.random.default_rng(0).integers(0, 65536, width*height, dtype=np.uint16).astype('>u2').tobytes()
+    values565 = np.frombuffer(rawData, dtype='>u2').reshape((height, width))
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    get_lookup_table()
+
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        formula_convert(values565)
+    formulaTime = (time.perf_counter() - startTime) / iterations
+
+    startTime = time.perf_counter()
+    for _ in range(iterations):
+        rgb565_to_rgb888(values565, out)
+    tableTime = (time.perf_counter() - startTime) / iterations
+
+    print(f"Formula: {formulaTime*1000:.3f} ms/frame")
+    print(f"Lookup table: {tableTime*1000:.3f} ms/frame ({formulaTime/tableTime:.1f}x faster)")
+
+
+def verify():
+    allValues = np.arange(65536, dtype=np.uint16)
+    expected = formula_convert(allValues)
+
+    for dtype in ('>u2', '<u2'):
+        values = allValues.astype(dtype)
+        if not np.array_equal(rgb565_to_rgb888(values), expected):
+            raise AssertionError(f"Lookup table does not match the formula for {dtype}")
+        if not np.array_equal(convert_buffer(values.tobytes(), 256, 256, "big" if dtype == '>u2' else "little"), expected.reshape((256, 256, 3))):
+            raise AssertionError(f"Buffer conversion does not match the formula for {dtype}")
+
+    print("Lookup table matches the formula for all 65536 values in both byte orders.")
+
+
+if __name__ == "__main__":
+    verify()
+    benchmark()
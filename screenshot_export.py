@@ -5,27 +5,28 @@ from ttkbootstrap.dialogs import Messagebox
 
 import numpy as np
 
-import time
+from tkinter.filedialog import askdirectory, askopenfilename
 
-from typing import TypedDict
+from PIL import ImageTk
 
-from tkinter.filedialog import askdirectory
+import os
 
-from PIL import Image, ImageTk
+import sys
 
-import gzip
+import multiprocessing
 
-import os
+import binframe
+from binframe import HeaderData
+
+import animated_export
+
+import frame_cache
 
-class HeaderData(TypedDict):
-    version: int
-    headerLength: int
-    width: int
-    height: int
-    id: int
-    frameTime: int
-    gzip: bool
-    gzip_wbits: int
+import task_runner
+
+import batch_export
+
+import metrics
 
 
 class main_window(ttk.Window):
@@ -40,16 +41,37 @@ class main_window(ttk.Window):
 
         self.sourceDirectory = ""
         self.loadedFiles = []
+        self.frameIndex = None
 
         self.selectedFile = ""
+        # Position of the selected file in the frame index, so navigating never has to search for it
+        self.selectedPosition = 0
         self.selectedFileIndex = ttk.StringVar()
 
+        # New frames in the selected folder (e.g. from a running recording) are added while this is enabled
+        self.watchDirectory = ttk.BooleanVar(value=False)
+        self.watchInterval_ms = 500
+
         self.frameTime_ms = 25
 
-        self.supportedFormats = ("png", "bmp", "gif")
+        # Decoded frames are kept for quick navigation, the frames ahead are decoded in the background
+        self.frameCacheBudget_MB = 256
+        self.readAheadFrames = 8
+        self.frameCache = frame_cache.DecodedFrameCache(self.frameCacheBudget_MB*1024*1024)
+        self.framePrefetcher = None
+
+        # Loading and exporting runs in the background, only the results are handled on the GUI thread
+        self.taskRunner = task_runner.TkTaskRunner(self)
+        self.previewTask = None
+        self.exportTask = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.metricsWriter = metrics.start_writer_from_environment()
+
+        self.supportedFormats = ("png", "bmp") + animated_export.supportedFormats + batch_export.stackFormats
         self.exportModes = {"selected":"Just the selected image", "all":"All"}
 
         self.init_GUI()
+        self.after(self.watchInterval_ms, self.check_directory)
 
 
     def init_GUI(self):
@@ -108,6 +130,18 @@ class main_window(ttk.Window):
             )
         self.exportButton.pack(fill=X, side=BOTTOM, expand=False, pady=10)
 
+        # Only shown while an export is running
+        self.progressFrame = ttk.Frame(self.operationFrame)
+        self.progressBar = ttk.Progressbar(self.progressFrame, mode=DETERMINATE, bootstyle=(SUCCESS, STRIPED))
+        self.progressBar.pack(fill=X, side=LEFT, expand=True, padx=(0, 10))
+        self.cancelButton = ttk.Button(
+            self.progressFrame,
+            text="Cancel",
+            style="danger.TButton",
+            command=self.cancel_export
+        )
+        self.cancelButton.pack(fill=NONE, side=RIGHT, expand=False)
+
 
         self.selectedFileFrame = ttk.LabelFrame(self.previewFrame, text="Selected image:", padding = 10)
         self.selectedFileFrame.pack(fill=BOTH, side=TOP, expand=False)
@@ -168,7 +202,7 @@ class main_window(ttk.Window):
         self.rightFrame.pack_forget()
 
 
-    def select_file(self, index:int):
+    def select_file(self, index:int, direction:int = 1):
         if index >= len(self.loadedFiles):
             index = 0
         elif index < 0:
@@ -177,20 +211,31 @@ class main_window(ttk.Window):
         if not self.selectedFileIndex.get() == "":
             self.selectedFileIndex.set(index+1)
 
+        self.selectedPosition = index
         self.selectedFile = self.loadedFiles[index]
 
         self.pathLabel.configure(text=self.selectedFile)
         self.load_and_convert_image(self.loadedFiles[index])
-        self.update_image_preview()
+        self.framePrefetcher.navigate(index, direction)
 
     
     def next_file(self, *_):
-        self.select_file(self.loadedFiles.index(self.selectedFile)+1)
-        self.selectedFileIndex.set(self.loadedFiles.index(self.selectedFile)+1)
+        self.select_file(self.selectedPosition+1)
+        self.selectedFileIndex.set(self.selectedPosition+1)
 
     def previous_file(self, *_):
-        self.select_file(self.loadedFiles.index(self.selectedFile)-1)
-        self.selectedFileIndex.set(self.loadedFiles.index(self.selectedFile)+1)
+        self.select_file(self.selectedPosition-1, -1)
+        self.selectedFileIndex.set(self.selectedPosition+1)
+
+
+    def arrow_key_pressed(self, event):
+        # The arrow keys move the cursor while the frame number is being edited
+        if self.frameIndex is None or len(self.loadedFiles) == 0 or self.focus_get() is self.currentFileNumberBox:
+            return
+        if event.keysym == "Right":
+            self.next_file()
+        else:
+            self.previous_file()
 
 
     def number_entry_changed(self, *_):
@@ -201,7 +246,7 @@ class main_window(ttk.Window):
 
     
     def validate_format_selection(self, *_):
-        if self.formatBox.get() == "gif":
+        if self.formatBox.get() in animated_export.supportedFormats + batch_export.stackFormats:
             self.modeBox.set(self.exportModes["all"])
             self.modeBox.configure(state=DISABLED)
         else:
@@ -239,7 +284,7 @@ class main_window(ttk.Window):
 
 
     def reset_file_number_box(self):
-        self.selectedFileIndex.set(self.loadedFiles.index(self.selectedFile)+1)
+        self.selectedFileIndex.set(self.selectedPosition+1)
         
 
     def init_top_menu(self):
@@ -251,6 +296,21 @@ class main_window(ttk.Window):
             command=self.select_directory, 
             accelerator="Ctrl+O"
         )
+        self.fileMenu.add_command(
+            label="Open .binFrames archive", 
+            command=self.select_archive, 
+            accelerator="Ctrl+Shift+O"
+        )
+        self.fileMenu.add_separator()
+        self.fileMenu.add_command(
+            label="Refresh folder",
+            command=self.refresh_directory,
+            accelerator="F5"
+        )
+        self.fileMenu.add_checkbutton(
+            label="Watch folder for new frames",
+            variable=self.watchDirectory
+        )
 
         self.topMenu.add_cascade(label="File", menu=self.fileMenu)
         self.configure(menu=self.topMenu)
@@ -258,9 +318,16 @@ class main_window(ttk.Window):
 
     def init_shortcuts(self):
         self.bind("<Control-o>", self.select_directory)
+        self.bind("<Control-O>", self.select_archive)
+        self.bind("<Left>", self.arrow_key_pressed)
+        self.bind("<Right>", self.arrow_key_pressed)
+        self.bind("<F5>", self.refresh_directory)
+
 
+    def select_directory(self, *_):
+        if self.export_running():
+            return
 
-    def select_directory(self):
         self.sourceDirectory = askdirectory(
             parent=self, 
             mustexist=True, 
@@ -283,22 +350,60 @@ class main_window(ttk.Window):
                     bootstyle=WARNING
             ).show_toast()
 
+
+    def select_archive(self, *_):
+        if self.export_running():
+            return
+
+        archivePath = askopenfilename(
+            parent=self,
+            title="Please select the input archive",
+            filetypes=[("Frame archives", "*.binFrames"), ("All files", "*")]
+        )
+
+        if not archivePath == "":
+            self.sourceDirectory = archivePath
+            self.load_directory()
+        else:
+            popup.ToastNotification(
+                    title=f"Operation cancelled",
+                    message=f"No archive was selected",
+                    duration=5000,
+                    icon="❌",
+                    bootstyle=WARNING
+            ).show_toast()
+
     
     def update_image_preview(self):
-        self.previewImage = ImageTk.PhotoImage(self.convertedImage)
-        self.imageLabel.configure(image=self.previewImage)
+        with metrics.registry.timer("render"):
+            self.previewImage = ImageTk.PhotoImage(self.convertedImage)
+            self.imageLabel.configure(image=self.previewImage)
 
 
     def load_directory(self):
-        self.loadedFiles = []
-
-        for file in os.listdir(self.sourceDirectory):
-            if os.path.isfile(self.sourceDirectory + "/" + file) and str(file).endswith(".binFrame"):
-                self.loadedFiles.append(self.sourceDirectory + "/" + file)
+        # The source is either a directory or a .binFrames archive, headers are only read once they are needed
+        if self.framePrefetcher is not None:
+            self.framePrefetcher.stop()
+            self.framePrefetcher = None
+        if self.frameIndex is not None and hasattr(self.frameIndex, "close"):
+            self.frameIndex.close()
+        try:
+            self.frameIndex = binframe.open_frames(self.sourceDirectory)
+        except ValueError:
+            self.frameIndex = None
+            popup.ToastNotification(
+                    title=f"Operation cancelled",
+                    message=f"The selected file is not a supported archive.",
+                    duration=5000,
+                    icon="❌",
+                    bootstyle=WARNING
+            ).show_toast()
+            self.hide_GUI()
+            return
+        self.loadedFiles = self.frameIndex.paths
+        self.framePrefetcher = frame_cache.FramePrefetcher(self.frameIndex, self.frameCache, self.readAheadFrames)
 
         if len(self.loadedFiles) > 0:
-            self.loadedFiles.sort()
-            
             popup.ToastNotification(
                 title=f"Success",
                 message=f"Successfully found {len(self.loadedFiles)} supported files.",
@@ -308,11 +413,8 @@ class main_window(ttk.Window):
             ).show_toast()
 
             self.select_file(0)
-            self.selectedFileIndex.set(self.loadedFiles.index(self.selectedFile)+1)
-            self.totalFilesNumber.configure(state=ACTIVE)
-            self.totalFilesNumber.delete(0, END)
-            self.totalFilesNumber.insert(0, str(len(self.loadedFiles)))
-            self.totalFilesNumber.configure(state=READONLY)
+            self.selectedFileIndex.set(self.selectedPosition+1)
+            self.update_total_files_number()
             self.show_GUI()
         else:
             popup.ToastNotification(
@@ -325,115 +427,130 @@ class main_window(ttk.Window):
             self.hide_GUI()
        
 
-    @staticmethod
-    def color_array_convert(values565:np.ndarray) -> np.ndarray:
-        """ 
-        Converts the 16-bit color format to the 24-bit RGB format.
-        Arguments:
-            values565 (ndarray): ndarray of shape (H, W) or flat, dtype=uint16
-        
-        Returns:
-            ndarray: of shape (H, W, 3), dtype=uint8
-        """
-        r5 = (values565 >> 11) & 0x1F
-        g6 = (values565 >> 5) & 0x3F
-        b5 = values565 & 0x1F
+    def update_total_files_number(self):
+        self.totalFilesNumber.configure(state=ACTIVE)
+        self.totalFilesNumber.delete(0, END)
+        self.totalFilesNumber.insert(0, str(len(self.loadedFiles)))
+        self.totalFilesNumber.configure(state=READONLY)
+
+
+    def check_directory(self):
+        # Only a single stat while nothing changed, so it can run often
+        if self.watchDirectory.get():
+            self.refresh_directory()
+        self.after(self.watchInterval_ms, self.check_directory)
+
 
-        # Convert to 8-bit (0–255) by scaling:
-        r8 = ((r5 * 255) // 31).astype(np.uint8)
-        g8 = ((g6 * 255) // 63).astype(np.uint8)
-        b8 = ((b5 * 255) // 31).astype(np.uint8)
+    def refresh_directory(self, *_):
+        # An export works with the positions at its start
+        if self.frameIndex is None or self.export_running():
+            return
+        wasEmpty = len(self.loadedFiles) == 0
+        followLatest = self.selectedPosition == len(self.loadedFiles) - 1
+        try:
+            changed = self.frameIndex.refresh()
+        except OSError:
+            return
+        if not changed:
+            return
 
-        return np.stack((r8, g8, b8), axis=-1)
+        self.loadedFiles = self.frameIndex.paths
+        self.framePrefetcher.decoder.reset()
+        self.update_total_files_number()
+        if len(self.loadedFiles) == 0:
+            self.hide_GUI()
+            return
+        if wasEmpty:
+            self.select_file(0)
+            self.show_GUI()
+            return
+
+        if followLatest:
+            # Like the live view, the newest frame stays selected while frames are added
+            self.select_file(len(self.loadedFiles) - 1)
+            return
+        try:
+            self.selectedPosition = self.frameIndex.index_of(self.selectedFile)
+        except KeyError:
+            # The selected file was deleted, the frame that is now at its position is shown instead
+            self.select_file(min(self.selectedPosition, len(self.loadedFiles) - 1))
+            return
+        self.selectedFileIndex.set(self.selectedPosition+1)
+        self.framePrefetcher.navigate(self.selectedPosition)
+
+
+    @staticmethod
+    def color_array_convert(values565:np.ndarray) -> np.ndarray:
+        return binframe.color_array_convert(values565)
 
 
     @staticmethod
     def is_bit_set(byte: int, bitIndex: int) -> bool:
-        return (byte >> bitIndex) & 1 == 1
+        return binframe.is_bit_set(byte, bitIndex)
 
 
     def read_file_header(self, path) -> HeaderData:
-        with open(path, 'rb') as f:
-            if int.from_bytes(f.read(2), "big", signed=False) == 1:
-                headerData = HeaderData()
-                headerData["version"] = 1
-                headerData["headerLength"] = 32
-                headerData["width"] = int.from_bytes(f.read(4), "big", signed=False)
-                headerData["height"] = int.from_bytes(f.read(4), "big", signed=False)
-                headerData["id"] = int.from_bytes(f.read(4), "big", signed=False)
-                headerData["frameTime"] = int.from_bytes(f.read(4), "big", signed=False)
-                flagByte = f.read(1)
-                headerData["gzip"] = self.is_bit_set(int.from_bytes(flagByte, "big", signed=False), 0)
-                headerData["gzip_wbits"] = int.from_bytes(f.read(1), "big", signed=False)
-                f.close()
-                return headerData
-            else:
-                f.close()
-                raise ValueError("Unsupported file version")
+        return binframe.read_file_header(path)
 
 
     def load_and_convert_image(self, path, scaleFactor:int = 1): 
-        headerData = self.read_file_header(path)
-        outputImage = Image.new("RGB", (headerData["width"], headerData["height"]))
-
-        with open(path, 'rb') as f:
-            if headerData["version"] == 1:
-                print(f"Loading image data: {path}")
-                startTime = time.time_ns()
-                # Decompress data if the gzip compression flag is True
-                if headerData["gzip"]:
-                    try:
-                        f.seek(headerData["headerLength"])
-                        rawData = gzip.decompress(f.read())
-                    except gzip.BadGzipFile:
-                        popup.ToastNotification(
-                        title=f"The file is corrupted",
-                        message=f"The data in the selected file is either corrupted or in an unsupported format.",
-                        duration=5000,
-                        icon="❌",
-                        bootstyle=WARNING
-                        ).show_toast()
-                        return
-                else:
-                    f.seek(headerData["headerLength"])
-                    rawData = f.read()
-
-                f.close()
-                print(f"Elapsed {(time.time_ns() - startTime)//1000/1000} ms")
-
-                print(f"Converting image, ", end="")
-                startTime = time.time_ns()
-                outputImage = self.convert_image(rawData, headerData["width"], headerData["height"])
-                print(f"elapsed {(time.time_ns() - startTime)//1000/1000} ms")
-
-            else:
-                f.close()
-                raise ValueError("Unsupported file version")
-
-        self.convertedImage = outputImage
+        index = self.frameIndex.index_of(path)
+
+        # Frames that were already viewed or prefetched come straight from the cache
+        metrics.registry.count("preview_requests")
+        cachedImage = self.frameCache.get(self.framePrefetcher.frame_key(index))
+        if cachedImage is not None:
+            metrics.registry.count("preview_cache_hits")
+            self.convertedImage = cachedImage
+            self.update_image_preview()
+            return
+
+        # Everything else is decoded on a worker thread, a newer selection makes the older one obsolete
+        if self.previewTask is not None:
+            self.previewTask.cancel()
+        self.previewTask = self.taskRunner.submit(
+            lambda task, prefetcher: prefetcher.load(index),
+            self.framePrefetcher,
+            onDone=lambda image: self.preview_loaded(path, image),
+            onError=lambda error: self.preview_failed(path, error)
+        )
 
-    
-    def convert_image(self, raw_data, width, height):
-        # Convert raw RGB565 data from a bytearray to a NumPy array
-        image_data_565 = np.frombuffer(raw_data, dtype='>u2').reshape((height, width))
 
-        # Convert the RGB565 array to RGB888 array
-        rgb888_data = self.color_array_convert(image_data_565)
+    def preview_loaded(self, path, image):
+        if not path == self.selectedFile:
+            return
+        self.convertedImage = image
+        self.update_image_preview()
 
-        # Create the image using Pillow
-        img = Image.fromarray(rgb888_data, 'RGB')
 
-        return img
+    def preview_failed(self, path, error):
+        if isinstance(error, task_runner.TaskCancelled) or not path == self.selectedFile:
+            return
+        popup.ToastNotification(
+        title=f"The file is corrupted",
+        message=f"The data in the selected file is either corrupted or in an unsupported format.",
+        duration=5000,
+        icon="❌",
+        bootstyle=WARNING
+        ).show_toast()
+
+    
+    def convert_image(self, raw_data, width, height):
+        return binframe.convert_image(raw_data, width, height)
     
 
     def save_image(self, inputPath, savePath):
-        outputImage = self.convertedImage
+        # Runs on a worker thread, the selected file is normally already in the cache
+        outputImage = self.framePrefetcher.load(self.frameIndex.index_of(inputPath))
         outputImage.save(savePath)
 
     def export_selected(self, *_):
         self.export()
 
     def export(self):
+        if self.export_running():
+            return
+
         format = self.formatBox.get()
 
         if self.modeBox.get() == self.exportModes["selected"]:
@@ -454,42 +571,153 @@ class main_window(ttk.Window):
                 bootstyle=INFO
             ).show_toast()
             return
-        
-        if format in ["png", "bmp"]:
-            for file in filesToExport:
-                exportPath = outputDirectory + "/" + str(file).split("/")[-1][:-8] + format
-                self.save_image(file, exportPath)
-        elif format == "gif":
+
+        self.exportTask = self.taskRunner.submit(
+            self.export_task,
+            format,
+            filesToExport,
+            outputDirectory,
+            onDone=self.export_finished,
+            onError=self.export_failed,
+            onProgress=self.export_progress
+        )
+        self.exportButton.configure(state=DISABLED)
+        self.progressBar.configure(value=0, maximum=len(filesToExport))
+        self.progressFrame.pack(fill=X, side=BOTTOM, expand=False, pady=10)
+
+    def export_task(self, task:task_runner.Task, format, filesToExport, outputDirectory) -> tuple:
+        """
+        Runs on a worker thread.
+        Returns:
+            tuple: (number of exported frames, list of (export path, error) for frames that could not be exported,
+                number of duplicate frames merged into the frames before them instead of being decoded again)
+        """
+        if format in animated_export.supportedFormats:
+            exportPath = outputDirectory + "/" + (str(self.loadedFiles[0]).split("/")[-1][:-8]) + animated_export.fileExtensions[format]
+
+            try:
+                writtenFrames = animated_export.export_animation(
+                    self.frameIndex,
+                    exportPath,
+                    format,
+                    self.frameTime_ms,
+                    task.report_progress
+                )
+            except task_runner.TaskCancelled:
+                # Do not leave a half written animation behind
+                os.remove(exportPath)
+                raise
+            return (len(self.frameIndex), [], len(self.frameIndex) - writtenFrames)
+
+        if format in batch_export.stackFormats:
             exportPath = outputDirectory + "/" + (str(self.loadedFiles[0]).split("/")[-1][:-8]) + format
 
-            frames = []
+            try:
+                binframe.save_stack(self.frameIndex, exportPath, progressCallback=task.report_progress, workers=None)
+            except task_runner.TaskCancelled:
+                os.remove(exportPath)
+                raise
+            return (len(filesToExport), [], 0)
+
+        if len(filesToExport) == 1:
+            self.save_image(filesToExport[0], outputDirectory + "/" + str(filesToExport[0]).split("/")[-1][:-8] + format)
+            task.report_progress(1, 1)
+            return (1, [], 0)
+
+        # Many still images are exported by all CPU cores, spawned workers do not inherit the Tk state
+        exported, failed, _ = batch_export.export_frames(
+            self.frameIndex,
+            outputDirectory,
+            format,
+            progressCallback=task.report_progress,
+            mpContext=multiprocessing.get_context("spawn")
+        )
+        return (exported, failed, 0)
 
-            self.selectedFileIndex.set(0)
-            
-            for file in filesToExport:
-                headerData = self.read_file_header(file)
-                self.select_file(int(self.selectedFileIndex.get()))
+    def export_progress(self, done, total):
+        self.progressBar.configure(value=done, maximum=total)
 
-                for i in range(max(1, headerData["frameTime"]//self.frameTime_ms)):
-                    frames.append(self.convertedImage)
-                    self.update()
+    def export_finished(self, result):
+        exportedFrames, failed, mergedFrames = result
+        self.hide_export_progress()
+        if len(failed) > 0:
+            # The failures are counted in metrics.registry ("export_errors") by batch_export
+            failedNames = ", ".join(str(path).split("/")[-1] for path, _ in failed[:3])
+            popup.ToastNotification(
+                title="Export finished with errors",
+                message=f"Exported {exportedFrames} frames, {len(failed)} frames could not be exported ({failedNames}{', ...' if len(failed) > 3 else ''}): {failed[0][1]}",
+                duration=5000,
+                icon="⚠",
+                bootstyle=WARNING
+            ).show_toast()
+            return
+        popup.ToastNotification(
+            title="Export finished",
+            message=f"Successfully exported {exportedFrames} frames."
+                    + (f" {mergedFrames} duplicate frames were merged into the frames before them instead of being decoded again." if mergedFrames > 0 else ""),
+            duration=5000,
+            icon="✅",
+            bootstyle=SUCCESS
+        ).show_toast()
+
+    def export_failed(self, error):
+        self.hide_export_progress()
+        if isinstance(error, task_runner.TaskCancelled):
+            popup.ToastNotification(
+                title="Operation cancelled",
+                message="The export was cancelled.",
+                duration=5000,
+                icon="❌",
+                bootstyle=WARNING
+            ).show_toast()
+        else:
+            popup.ToastNotification(
+                title="Export failed",
+                message=f"The export failed: {error}",
+                duration=5000,
+                icon="❌",
+                bootstyle=DANGER
+            ).show_toast()
 
-                self.selectedFileIndex.set(filesToExport.index(file) + 1)
+    def hide_export_progress(self):
+        self.exportTask = None
+        self.progressFrame.pack_forget()
+        self.exportButton.configure(state=NORMAL)
 
-            self.select_file(int(self.selectedFileIndex.get()))
+    def cancel_export(self):
+        if self.exportTask is not None:
+            self.exportTask.cancel()
 
-            print(f"Saving GIF: {exportPath}")
-            firstFrame = frames[0]
-            firstFrame.save(
-                exportPath,
-                format="GIF",
-                append_images=frames[1:],
-                save_all=True,
-                duration=50,
-                loop=0
-            )
+    def export_running(self) -> bool:
+        if self.exportTask is None:
+            return False
+        popup.ToastNotification(
+            title="Export in progress",
+            message="Please wait until the export finishes or cancel it.",
+            duration=5000,
+            icon="⏳",
+            bootstyle=INFO
+        ).show_toast()
+        return True
+
+    def on_close(self):
+        self.cancel_export()
+        if self.previewTask is not None:
+            self.previewTask.cancel()
+        if self.framePrefetcher is not None:
+            self.framePrefetcher.stop()
+        if self.frameIndex is not None:
+            self.frameIndex.close()
+        self.taskRunner.shutdown()
+        if self.metricsWriter is not None:
+            self.metricsWriter.stop()
+        self.destroy()
 
         
 if __name__ == "__main__":
+    # Any command line arguments switch to the headless batch exporter
+    if len(sys.argv) > 1:
+        raise SystemExit(batch_export.main())
+
     mainWindow = main_window()
     mainWindow.mainloop()      
\ No newline at end of file
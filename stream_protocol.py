@@ -0,0 +1,636 @@
+# Host side of the versioned live stream protocol (see "Stream protocol info.md")
+#
+# Running this file directly performs a loopback check: the reference device sender from stream_sender.py
+# is run on a pseudo terminal, packets are corrupted and dropped on purpose and every received frame is verified.
+
+import struct
+
+import time
+
+import zlib
+
+from typing import TypedDict
+
+import delta_codec
+
+import metrics
+
+
+protocolVersion = 2
+
+packetMagic = b"\xa5\x5a"
+# Packets of a delta frame (see "binFrame format info.md", delta data) carry their own magic
+deltaPacketMagic = b"\xa5\x5d"
+# Magic, frame number, packet sequence number, packet count, payload length, CRC32
+packetHeaderStruct = struct.Struct(">2sHHHHI")
+
+# Used until the link was negotiated
+defaultRetransmitTimeoutMs = 100
+# Bounds of the negotiated read timeout and the packet sizes tried by LinkTuner
+minRetransmitTimeoutMs = 20
+maxRetransmitTimeoutMs = 500
+minPacketSize = 256
+# Assumed payload throughput of a USB CDC link (full speed USB) for the read timeout
+usbThroughput = 1_000_000
+
+
+class LinkInfo(TypedDict):
+    version: int
+    width: int
+    height: int
+    packetSize: int
+    delta: bool
+    # Negotiated with the link command, the announced packet size and the current baud rate until then
+    maxPacketSize: int
+    # 0 for USB CDC devices, their baud rate setting has no effect on the speed
+    baudrate: int
+    retransmitTimeoutMs: int
+
+
+class ProtocolStats(TypedDict):
+    packets: int
+    deltaFrames: int
+    crcErrors: int
+    # Delta frames whose rectangles did not fit the frame, they are given up like a timeout but are no link errors
+    deltaErrors: int
+    retransmitRequests: int
+    timeouts: int
+    bytesReceived: int
+
+
+def new_protocol_stats() -> ProtocolStats:
+    return ProtocolStats(packets=0, deltaFrames=0, crcErrors=0, deltaErrors=0, retransmitRequests=0, timeouts=0, bytesReceived=0)
+
+
+def packet_crc(header:bytes, payload) -> int:
+    # The CRC covers the frame number, sequence number, packet count, payload length and the payload
+    return zlib.crc32(payload, zlib.crc32(header[2:10])) & 0xFFFFFFFF
+
+
+def pack_packet(frameNumber:int, sequence:int, packetCount:int, payload, magic:bytes = packetMagic) -> bytes:
+    header = packetHeaderStruct.pack(magic, frameNumber & 0xFFFF, sequence, packetCount, len(payload), 0)
+    return packetHeaderStruct.pack(magic, frameNumber & 0xFFFF, sequence, packetCount, len(payload), packet_crc(header, payload)) + bytes(payload)
+
+
+def hello_command() -> bytes:
+    return f"hello {protocolVersion}\n".encode("utf-8")
+
+
+def parse_hello(line:bytes) -> LinkInfo:
+    """
+    Parses the answer of the device to hello_command().
+    Returns the link parameters announced by the device, or None if the line is not a version 2 answer.
+    """
+    fields = line.decode("utf-8", errors="replace").split()
+    if len(fields) not in (5, 6) or fields[0] != "HELLO" or fields[1] != str(protocolVersion):
+        return None
+    try:
+        return LinkInfo(version=protocolVersion, width=int(fields[2]), height=int(fields[3]), packetSize=int(fields[4]), delta=fields[5:] == ["delta"],
+                        maxPacketSize=int(fields[4]), baudrate=0, retransmitTimeoutMs=defaultRetransmitTimeoutMs)
+    except ValueError:
+        return None
+
+
+def negotiate(serialPort, timeout:float = 0.3) -> LinkInfo:
+    """
+    Asks the device for the streaming protocol version 2.
+    Returns the link parameters announced by the device, or None if it only speaks the original protocol.
+    Devices that can send delta frames add "delta" to their answer.
+    """
+    serialPort.reset_input_buffer()
+    serialPort.write(hello_command())
+
+    previousTimeout = serialPort.timeout
+    serialPort.timeout = timeout
+    try:
+        line = serialPort.readline()
+    finally:
+        serialPort.timeout = previousTimeout
+
+    return parse_hello(line)
+
+
+class FrameReceiver():
+    """
+    The host side of one frame transfer as a state machine without any I/O, so a single thread can drive many devices.
+    start() requests a frame, feed() takes the bytes received since the last call and poll() handles the timeouts.
+    Each of them returns the commands that have to be sent to the device (b"" if there are none).
+    Once `done` is set, `result` holds the frame data (`out`), or None if the frame was given up.
+    `timedOut` tells whether it was given up after frameTimeoutMs, otherwise its delta data could not be applied.
+    Damaged or missing packets are requested again one by one, the frame is only given up after frameTimeoutMs.
+    Arguments:
+        retransmitTimeoutMs (int): optional, the negotiated read timeout of the link is used otherwise
+        out (bytearray): optional preallocated buffer of width*height*2 bytes, it is reused for every frame
+    The packet size and the read timeout of the link may change between frames.
+    """
+    def __init__(self, link:LinkInfo, window:int = 4, frameTimeoutMs:int = 2000, retransmitTimeoutMs:int = None, stats:ProtocolStats = None, out:bytearray = None):
+        self.link = link
+        self.window = window
+        self.frameTimeoutMs = frameTimeoutMs
+        self.retransmitTimeoutMs = retransmitTimeoutMs
+        self.stats = stats if stats is not None else new_protocol_stats()
+
+        self.out = out if out is not None else bytearray(link["width"]*link["height"]*2)
+        # Received bytes that do not form a complete packet yet
+        self._input = bytearray()
+
+        self.done = True
+        self.result = None
+        self.timedOut = False
+        self.frameNumber = 0
+
+    def start(self, frameNumber:int, now:float, baseFrameNumber:int = None) -> bytes:
+        """
+        Arguments:
+            frameNumber (int): number of the requested frame, packets of other frames are ignored
+            baseFrameNumber (int): number of the frame that `out` holds, the device may then send only the changes against it.
+                A delta frame patches `out` in place. Without it (or if the device does not support deltas) a full frame is requested.
+                After a failed frame `out` may hold a partial frame.
+        """
+        self.frameNumber = frameNumber & 0xFFFF
+        self.done = False
+        self.timedOut = False
+        self._fullPacketCount = (len(self.out) + self.link["packetSize"] - 1)//self.link["packetSize"]
+        self._retransmitTimeoutMs = self.retransmitTimeoutMs or self.link["retransmitTimeoutMs"]
+        self.result = None
+        # The kind of frame and the packet count are only known after the first intact packet
+        self._magic = None
+        self._packetCount = None
+        self._received = None
+        self._deltaData = None
+        self._deltaLength = 0
+        self._receivedCount = 0
+        self._lowestMissing = 0
+        # Time of the last retransmit request per packet, so the same packet is not requested over and over
+        self._requestTimes = {}
+        self._startTime = now
+        self._lastInputTime = now
+
+        request = f"frame {self.frameNumber} {self.window}"
+        if baseFrameNumber is not None and self.link["delta"]:
+            request += f" {baseFrameNumber & 0xFFFF}"
+        return (request + "\n").encode("utf-8")
+
+    def feed(self, data, now:float) -> bytes:
+        # Bytes arriving between frames are kept, they are dropped as packets of another frame once the next frame started
+        self._input += data
+        if len(data) > 0:
+            self._lastInputTime = now
+        commands = []
+        while not self.done:
+            fields, payload = self._next_packet()
+            if fields is None:
+                break
+            self._handle_packet(fields, payload, now, commands)
+        return b"".join(commands)
+
+    def poll(self, now:float) -> bytes:
+        if self.done:
+            return b""
+        if (now - self._startTime)*1000 > self.frameTimeoutMs:
+            self.stats["timeouts"] += 1
+            metrics.registry.count("timeouts")
+            self.timedOut = True
+            self.done = True
+            return b"end\n"
+
+        if (now - self._lastInputTime)*1000 <= self._retransmitTimeoutMs:
+            return b""
+        # Nothing arrived in time, the acknowledgement or the packets were lost
+        self._lastInputTime = now
+        commands = [f"ack {self._lowestMissing}\n".encode("utf-8")]
+        if self._received is None or not self._received[self._lowestMissing]:
+            commands.append(self._request_again(self._lowestMissing, now))
+        return b"".join(commands)
+
+    def _request_again(self, sequence:int, now:float) -> bytes:
+        self._requestTimes[sequence] = now
+        self.stats["retransmitRequests"] += 1
+        metrics.registry.count("retries")
+        return f"nak {sequence}\n".encode("utf-8")
+
+    def _next_packet(self) -> tuple:
+        """
+        Takes the next packet from the received bytes, resynchronizing on the magic bytes if needed.
+        Returns:
+            tuple: (header fields, payload), (None, None) if more bytes are needed or (header fields, None) if the CRC did not match
+        """
+        data = self._input
+        # Find the magic bytes, skipping any garbage in between
+        position = data.find(packetMagic[:1])
+        while position >= 0 and position + 1 < len(data) and data[position + 1] not in (packetMagic[1], deltaPacketMagic[1]):
+            position = data.find(packetMagic[:1], position + 1)
+        if position < 0:
+            data.clear()
+            return (None, None)
+        del data[:position]
+
+        if len(data) < packetHeaderStruct.size:
+            return (None, None)
+        fields = packetHeaderStruct.unpack_from(data)
+        if fields[4] > self.link["packetSize"]:
+            del data[:packetHeaderStruct.size]
+            return (fields, None)
+
+        packetLength = packetHeaderStruct.size + fields[4]
+        if len(data) < packetLength:
+            return (None, None)
+        header = bytes(data[:packetHeaderStruct.size])
+        payload = bytes(data[packetHeaderStruct.size:packetLength])
+        del data[:packetLength]
+        if packet_crc(header, payload) != fields[5]:
+            return (fields, None)
+        return (fields, payload)
+
+    def _handle_packet(self, fields:tuple, payload:bytes, now:float, commands:list):
+        kind, packetFrameNumber, sequence, count, length, _ = fields
+        received = self._received
+        if payload is None:
+            self.stats["crcErrors"] += 1
+            metrics.registry.count("crc_errors")
+            # The header can be damaged too, only trust a sequence number that fits this frame
+            if packetFrameNumber == self.frameNumber and count == self._packetCount and sequence < count and not received[sequence]:
+                commands.append(self._request_again(sequence, now))
+            return
+
+        if packetFrameNumber != self.frameNumber or sequence >= count:
+            return
+        if self._magic is None:
+            # A delta is always smaller than the full frame
+            if count > self._fullPacketCount or (kind == packetMagic and count != self._fullPacketCount):
+                return
+            self._magic = kind
+            self._packetCount = count
+            received = self._received = [False]*count
+            if kind == deltaPacketMagic:
+                self._deltaData = bytearray(count*self.link["packetSize"])
+        elif kind != self._magic or count != self._packetCount:
+            return
+
+        self.stats["packets"] += 1
+        self.stats["bytesReceived"] += packetHeaderStruct.size + length
+        metrics.registry.count("serial_bytes", packetHeaderStruct.size + length)
+        if received[sequence]:
+            return
+
+        offset = sequence*self.link["packetSize"]
+        if self._magic == deltaPacketMagic:
+            self._deltaData[offset:offset + length] = payload
+            if sequence == count - 1:
+                self._deltaLength = offset + length
+        else:
+            self.out[offset:offset + length] = payload
+        received[sequence] = True
+        self._receivedCount += 1
+
+        if self._receivedCount == count:
+            commands.append(b"end\n")
+            self._finish()
+        elif sequence == self._lowestMissing:
+            while self._lowestMissing < count and received[self._lowestMissing]:
+                self._lowestMissing += 1
+            commands.append(f"ack {self._lowestMissing}\n".encode("utf-8"))
+        else:
+            # A gap in front of this packet, request the missing ones unless that was done recently
+            for missing in range(self._lowestMissing, sequence):
+                if not received[missing] and (now - self._requestTimes.get(missing, 0))*1000 > self._retransmitTimeoutMs:
+                    commands.append(self._request_again(missing, now))
+
+    def _finish(self):
+        self.done = True
+        if self._magic == deltaPacketMagic:
+            try:
+                delta_codec.apply_delta(self.out, self.link["width"], self.link["height"], self._deltaData[:self._deltaLength])
+            except ValueError:
+                self.stats["deltaErrors"] += 1
+                metrics.registry.count("delta_errors")
+                return
+            self.stats["deltaFrames"] += 1
+        self.result = self.out
+
+
+def receive_frame(serialPort, link:LinkInfo, frameNumber:int, window:int = 4, frameTimeoutMs:int = 2000, retransmitTimeoutMs:int = None, stats:ProtocolStats = None, out:bytearray = None, baseFrameNumber:int = None):
+    """
+    Receives one frame with a sliding window of packets in flight, blocking until it is complete or given up (see FrameReceiver).
+    Arguments:
+        frameNumber (int): number of the requested frame, packets of other frames are ignored
+        out (bytearray): optional preallocated buffer of width*height*2 bytes
+        baseFrameNumber (int): number of the frame that `out` holds, the device may then send only the changes against it
+
+    Returns:
+        bytearray: the frame data (`out` if it was given), or None on timeout. After a timeout `out` may hold a partial frame.
+    """
+    receiver = FrameReceiver(link, window, frameTimeoutMs, retransmitTimeoutMs, stats, out)
+
+    previousTimeout = serialPort.timeout
+    serialPort.timeout = (retransmitTimeoutMs or link["retransmitTimeoutMs"])/1000
+    try:
+        serialPort.write(receiver.start(frameNumber, time.perf_counter(), baseFrameNumber))
+        while not receiver.done:
+            data = serialPort.read(max(1, serialPort.in_waiting))
+            now = time.perf_counter()
+            commands = receiver.feed(data, now) + receiver.poll(now)
+            if len(commands) > 0:
+                serialPort.write(commands)
+        return receiver.result
+    finally:
+        serialPort.timeout = previousTimeout
+
+
+def link_command(packetSize:int, baudrate:int = 0) -> bytes:
+    """
+    Asks the device to send packets of packetSize bytes from the next frame on, and to switch to baudrate (0 keeps the current one).
+    Only sent between frames.
+    """
+    return f"link {packetSize} {baudrate}\n".encode("utf-8")
+
+
+def parse_link_answer(line:bytes) -> tuple:
+    """
+    Returns:
+        tuple: (packet size, largest packet size of the device, baud rate or 0 for USB CDC), or None if the line is no answer to link_command()
+    """
+    fields = line.decode("utf-8", errors="replace").split()
+    if len(fields) != 4 or fields[0] != "LINK":
+        return None
+    try:
+        return (int(fields[1]), int(fields[2]), int(fields[3]))
+    except ValueError:
+        return None
+
+
+def retransmit_timeout(link:LinkInfo, window:int, roundTrip_s:float) -> int:
+    """
+    Read timeout of a link: a round trip plus the time the packets in flight need at the speed of the link.
+    """
+    throughput = link["baudrate"]/10 if link["baudrate"] > 0 else usbThroughput
+    timeoutMs = (2*roundTrip_s + window*link["packetSize"]/throughput)*1000
+    return int(min(max(timeoutMs, minRetransmitTimeoutMs), maxRetransmitTimeoutMs))
+
+
+def apply_link_answer(link:LinkInfo, answer:tuple, window:int, roundTrip_s:float):
+    packetSize, maxPacketSize, baudrate = answer
+    link["packetSize"] = packetSize
+    link["maxPacketSize"] = maxPacketSize
+    link["baudrate"] = baudrate
+    link["retransmitTimeoutMs"] = retransmit_timeout(link, window, roundTrip_s)
+
+
+def negotiate_link(serialPort, link:LinkInfo, packetSize:int, baudrate:int = 0, window:int = 4, timeout:float = 0.3) -> bool:
+    """
+    Sets the packet size (and the baud rate, for devices behind a UART) of a version 2 link between frames.
+    The read timeout of the link is derived from the measured round trip. The baud rate of serialPort follows the device.
+    Returns:
+        bool: False if the device did not answer, it does not support changing the link then and `link` is unchanged
+    """
+    previousTimeout = serialPort.timeout
+    serialPort.timeout = timeout
+    startTime = time.perf_counter()
+    try:
+        serialPort.write(link_command(packetSize, baudrate))
+        # Late packets of the previous frame may still arrive before the answer
+        answer = None
+        while answer is None and time.perf_counter() - startTime < timeout:
+            line = serialPort.readline()
+            if len(line) == 0:
+                break
+            answer = parse_link_answer(line[line.rfind(b"LINK"):])
+    finally:
+        serialPort.timeout = previousTimeout
+    if answer is None:
+        return False
+
+    apply_link_answer(link, answer, window, time.perf_counter() - startTime)
+    if link["baudrate"] > 0 and serialPort.baudrate != link["baudrate"]:
+        serialPort.baudrate = link["baudrate"]
+    return True
+
+
+class LinkTuner():
+    """
+    Chooses the packet size of a version 2 link from the retries and the throughput of the last frames.
+    A clean link doubles the packet size up to the largest size of the device, so fewer packets and acknowledgements are needed.
+    Retries halve it, so a damaged packet costs less to send again. A size that was slower or had too many retries
+    is not tried again for a while.
+    Arguments:
+        windowFrames (int): number of frames measured before each decision
+        highRetryRate (float): share of retransmit requests and CRC errors per packet above which the packets get smaller
+        holdWindows (int): number of windows a rejected size is not tried again
+    """
+    def __init__(self, link:LinkInfo, windowFrames:int = 8, highRetryRate:float = 0.02, holdWindows:int = 16):
+        self.link = link
+        self.windowFrames = windowFrames
+        self.highRetryRate = highRetryRate
+        self.holdWindows = holdWindows
+
+        # Payload bytes per second and retry rate of the last window
+        self.throughput = 0.0
+        self.retryRate = 0.0
+        self.windows = 0
+
+        self._frames = 0
+        self._windowStart = None
+        self._windowStats = None
+        # Packet size -> throughput measured with it, and the window until which a size is not tried again
+        self._throughputs = {}
+        self._holdUntil = {}
+        self._previousSize = None
+
+    def frame_finished(self, stats:ProtocolStats, now:float) -> int:
+        """
+        Called after every frame (received or given up) with the stats of the link.
+        Returns:
+            int: the packet size to negotiate before the next frame, or None to keep the current one
+        """
+        if self._windowStart is None:
+            self._start_window(stats, now)
+            return None
+        self._frames += 1
+        if self._frames < self.windowFrames:
+            return None
+
+        elapsed = max(now - self._windowStart, 1e-9)
+        packets = stats["packets"] - self._windowStats["packets"]
+        retries = stats["retransmitRequests"] - self._windowStats["retransmitRequests"] + stats["crcErrors"] - self._windowStats["crcErrors"]
+        self.throughput = (stats["bytesReceived"] - self._windowStats["bytesReceived"])/elapsed
+        self.retryRate = retries/max(packets, 1)
+        self.windows += 1
+        self._start_window(stats, now)
+
+        packetSize = self.link["packetSize"]
+        self._throughputs[packetSize] = self.throughput
+        if self.retryRate > self.highRetryRate and packetSize > minPacketSize:
+            return self._change_size(max(minPacketSize, packetSize//2))
+
+        previousSize = self._previousSize
+        if previousSize is not None and previousSize < packetSize and self._throughputs.get(previousSize, 0) > self.throughput*1.05:
+            # Larger packets did not help
+            return self._change_size(previousSize)
+
+        largerSize = min(packetSize*2, self.link["maxPacketSize"])
+        if self.retryRate == 0 and largerSize > packetSize and self._holdUntil.get(largerSize, 0) <= self.windows:
+            return self._change_size(largerSize)
+        return None
+
+    def _start_window(self, stats:ProtocolStats, now:float):
+        self._frames = 0
+        self._windowStart = now
+        self._windowStats = dict(stats)
+
+    def _change_size(self, packetSize:int) -> int:
+        currentSize = self.link["packetSize"]
+        if packetSize < currentSize:
+            self._holdUntil[currentSize] = self.windows + self.holdWindows
+        self._previousSize = currentSize
+        return packetSize
+
+
+def link_summary(link:LinkInfo, linkTuner:LinkTuner = None) -> str:
+    """
+    Describes the negotiated parameters of a link for the stats of the GUIs.
+    """
+    text = (f"Packet size: {link['packetSize']} B (max {link['maxPacketSize']})\n"
+            f"Baud rate: {link['baudrate'] if link['baudrate'] > 0 else 'USB CDC'}\n"
+            f"Read timeout: {link['retransmitTimeoutMs']} ms")
+    if linkTuner is None:
+        return text + "\nLink tuning: off"
+    return text + f"\nThroughput: {linkTuner.throughput/1000:.1f} kB/s\nRetry rate: {linkTuner.retryRate*100:.1f} %"
+
+
+def tuner_check():
+    def run(packetsPerFrame:int, retriesPerFrame:int, windows:int = 20) -> list:
+        link = LinkInfo(version=protocolVersion, width=240, height=240, packetSize=7200, delta=False,
+                        maxPacketSize=16384, baudrate=0, retransmitTimeoutMs=defaultRetransmitTimeoutMs)
+        tuner = LinkTuner(link)
+        stats = new_protocol_stats()
+        sizes = []
+        now = 0.0
+        for _ in range(windows*tuner.windowFrames + 1):
+            stats["packets"] += packetsPerFrame
+            stats["retransmitRequests"] += retriesPerFrame
+            stats["bytesReceived"] += 115200
+            now += 0.02
+            packetSize = tuner.frame_finished(stats, now)
+            if packetSize is not None:
+                link["packetSize"] = packetSize
+                sizes.append(packetSize)
+        return sizes
+
+    # A clean link grows to the largest packets of the device and stays there
+    sizes = run(16, 0)
+    if sizes != [14400, 16384]:
+        raise AssertionError(f"A clean link was tuned to {sizes}")
+    # A noisy link backs off to the smallest packets
+    sizes = run(16, 2)
+    if sizes[-1] != minPacketSize:
+        raise AssertionError(f"A noisy link was tuned to {sizes}")
+    print(f"Link tuner check passed: a clean link grows to 16384 byte packets, a noisy one backs off to {minPacketSize} bytes")
+
+
+def loopback_check(frameCount:int = 20, corruptEvery:int = 7, dropEvery:int = 11, delta:bool = True):
+    import os
+    import pty
+    import threading
+    import tty
+
+    import serial
+
+    import stream_sender
+
+    width = 240
+    height = 240
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+
+    # Every frame redraws a rectangle of the previous one, every fifth frame changes completely
+    frames = []
+    frame = bytearray(width*height*2)
+    for i in range(frameCount):
+        if i % 5 == 0:
+            frame[:] = bytes((i*7 + j) & 0xFF for j in range(256))*(width*height*2//256)
+        else:
+            x = (i*37) % (width - 40)
+            y = (i*53) % (height - 40)
+            for row in range(y, y + 40):
+                frame[(row*width + x)*2:(row*width + x + 40)*2] = bytes((i,))*80
+        frames.append(bytes(frame))
+    packetsSent = [0]
+
+    def device_write(data):
+        # Damage and lose some packet payloads on their way to the host
+        if len(data) > 64:
+            packetsSent[0] += 1
+            if packetsSent[0] % dropEvery == 0:
+                return
+            if packetsSent[0] % corruptEvery == 0:
+                data = bytearray(data)
+                data[len(data)//2] ^= 0xFF
+        while len(data) > 0:
+            try:
+                written = os.write(master, data)
+            except BlockingIOError:
+                time.sleep(0.001)
+                continue
+            data = data[written:]
+
+    def device_read():
+        try:
+            return os.read(master, 256)
+        except (BlockingIOError, OSError):
+            return b""
+
+    currentFrame = [0]
+    sender = stream_sender.StreamSender(device_read, device_write, width, height, lambda: frames[currentFrame[0]], packetSize=3600, delta=delta)
+    stopEvent = threading.Event()
+
+    def device_loop():
+        while not stopEvent.is_set():
+            if not sender.poll():
+                time.sleep(0.0005)
+
+    deviceThread = threading.Thread(target=device_loop, daemon=True)
+    deviceThread.start()
+
+    stats = new_protocol_stats()
+    try:
+        with serial.Serial(os.ttyname(slave), 115200, timeout=0.5) as serialPort:
+            link = negotiate(serialPort)
+            if link is None:
+                raise AssertionError("The device did not answer the version 2 handshake")
+            if link["delta"] != delta:
+                raise AssertionError("The device announced the wrong delta support")
+            frameBuffer = bytearray(width*height*2)
+            baseFrameNumber = None
+            for i in range(frameCount):
+                if i % 4 == 0:
+                    # Packet sizes may change between any two frames, even while delta frames are sent
+                    packetSize = (1800, 3600, 14400, 65535)[i//4 % 4]
+                    if not negotiate_link(serialPort, link, packetSize):
+                        raise AssertionError("The device did not answer the link command")
+                    if link["packetSize"] != min(packetSize, link["maxPacketSize"]):
+                        raise AssertionError(f"The device uses packets of {link['packetSize']} bytes instead of {packetSize}")
+                currentFrame[0] = i
+                data = receive_frame(serialPort, link, i, stats=stats, out=frameBuffer, baseFrameNumber=baseFrameNumber)
+                if data is None or bytes(data) != frames[i]:
+                    raise AssertionError(f"Frame {i} was not received correctly")
+                baseFrameNumber = i
+            if delta and stats["deltaFrames"] == 0:
+                raise AssertionError("No delta frames were sent")
+    finally:
+        stopEvent.set()
+        deviceThread.join()
+        os.close(master)
+        os.close(slave)
+
+    print(f"Loopback check passed{' with delta frames' if delta else ''}: {frameCount} frames ({stats['deltaFrames']} deltas), "
+          f"{stats['bytesReceived']} bytes received, {packetsSent[0]} packets sent, {stats['crcErrors']} CRC errors, "
+          f"{stats['retransmitRequests']} retransmit requests, {stats['timeouts']} timeouts")
+
+
+if __name__ == "__main__":
+    tuner_check()
+    loopback_check(delta=False)
+    loopback_check(delta=True)
@@ -0,0 +1,209 @@
+# Background receiver for the live stream of a GamePico
+#
+# The receiver thread owns the serial port, runs the streaming protocol (version 2 if the device supports it,
+# the original ready/continue/retry/end handshake otherwise) and pushes complete frames into a small ring buffer,
+# from which the GUI only takes the newest one.
+
+import threading
+
+import time
+
+from collections import deque
+
+from typing import TypedDict
+
+import serial
+
+import stream_protocol
+
+import metrics
+
+
+class ReceivedFrame(TypedDict):
+    data: bytes
+    width: int
+    height: int
+    sequence: int
+    receivedTime: float
+
+
+class FrameRingBuffer():
+    """
+    Thread-safe ring buffer of received frames. When it is full, the oldest frame is dropped.
+    """
+    def __init__(self, capacity:int = 3):
+        self._frames = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self.droppedFrames = 0
+        self.skippedFrames = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._frames)
+
+    def push(self, frame:ReceivedFrame):
+        with self._lock:
+            if len(self._frames) == self._frames.maxlen:
+                self.droppedFrames += 1
+            self._frames.append(frame)
+
+    def pop_latest(self) -> ReceivedFrame:
+        """
+        Returns the newest frame and discards the older ones, or None if there is no new frame.
+        """
+        with self._lock:
+            if len(self._frames) == 0:
+                return None
+            frame = self._frames.pop()
+            self.skippedFrames += len(self._frames)
+            self._frames.clear()
+            return frame
+
+
+class SerialReceiver(threading.Thread):
+    """
+    Receives frames from one serial port until stop() is called or the port fails.
+    After the thread ends, `error` holds the exception that stopped it (None after stop()).
+    Version 2 links are negotiated after the handshake (see stream_protocol.negotiate_link) and their packet size is
+    tuned from the observed retries and throughput while the stream runs. The original protocol keeps its fixed parameters.
+    Arguments:
+        requestedBaudrate (int): baud rate asked for from devices behind a UART, USB CDC devices keep their speed
+        tuneLink (bool): adjust the packet size while streaming
+    """
+    def __init__(self, portName, ringBuffer:FrameRingBuffer, baudrate:int = 115200, width:int = 240, height:int = 240, packetCount:int = 16, timeoutMs:int = 500, readyInterval_s:float = 0.04, window:int = 4,
+                 requestedBaudrate:int = 921600, tuneLink:bool = True):
+        super().__init__(name=f"SerialReceiver {portName}", daemon=True)
+        self.portName = portName
+        self.ringBuffer = ringBuffer
+        self.baudrate = baudrate
+        self.width = width
+        self.height = height
+        self.packetCount = packetCount
+        self.timeoutMs = timeoutMs
+        self.readyInterval_s = readyInterval_s
+        self.window = window
+        self.requestedBaudrate = requestedBaudrate
+        self.tuneLink = tuneLink
+
+        # Set once the device answered the version 2 handshake
+        self.link = None
+        self.protocolStats = stream_protocol.new_protocol_stats()
+        # Set if the device can change its link parameters, it holds the measured throughput
+        self.linkTuner = None
+
+        # Optional stream_recorder.StreamRecorder that gets every received frame, not only the displayed ones
+        self.recorder = None
+
+        self.error = None
+        self.receivedFrames = 0
+        self.timeouts = 0
+
+        self._stopEvent = threading.Event()
+        self._sequence = 0
+
+    def stop(self):
+        self._stopEvent.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        try:
+            with serial.Serial(self.portName, self.baudrate, timeout=self.timeoutMs/1000) as serialPort:
+                link = stream_protocol.negotiate(serialPort)
+                if link is not None:
+                    if stream_protocol.negotiate_link(serialPort, link, link["packetSize"], self.requestedBaudrate, self.window):
+                        self.linkTuner = stream_protocol.LinkTuner(link)
+                    self.link = link
+                    self.receive_frames_v2(serialPort)
+                    return
+
+                while not self._stopEvent.is_set():
+                    # Announce that a frame can be sent and wait shortly for the answer of the device
+                    serialPort.timeout = self.readyInterval_s
+                    serialPort.write("ready\n".encode("utf-8"))
+                    if len(serialPort.read(2)) == 2:
+                        serialPort.timeout = self.timeoutMs/1000
+                        with metrics.registry.timer("receive"):
+                            self.receive_frame(serialPort)
+        except (serial.SerialException, OSError) as e:
+            self.error = e
+
+    def receive_frames_v2(self, serialPort:serial.Serial):
+        # Delta frames patch the last received frame in place, a full frame is requested again after any failure
+        frameBuffer = bytearray(self.link["width"]*self.link["height"]*2)
+        baseFrameNumber = None
+        frameNumber = 0
+        while not self._stopEvent.is_set():
+            deltaErrors = self.protocolStats["deltaErrors"]
+            with metrics.registry.timer("receive"):
+                rawData = stream_protocol.receive_frame(serialPort, self.link, frameNumber, self.window, stats=self.protocolStats,
+                                                        out=frameBuffer, baseFrameNumber=baseFrameNumber)
+            if rawData is None:
+                # A delta frame that could not be applied is only counted in protocolStats["deltaErrors"]
+                if self.protocolStats["deltaErrors"] == deltaErrors:
+                    self.timeouts += 1
+                baseFrameNumber = None
+            else:
+                self.push_frame(bytes(rawData), self.link["width"], self.link["height"])
+                baseFrameNumber = frameNumber
+            frameNumber = (frameNumber + 1) & 0xFFFF
+
+            if self.tuneLink and self.linkTuner is not None:
+                packetSize = self.linkTuner.frame_finished(self.protocolStats, time.perf_counter())
+                if packetSize is not None:
+                    self.change_packet_size(serialPort, packetSize)
+
+    def change_packet_size(self, serialPort:serial.Serial, packetSize:int):
+        # The command is repeated if the answer got lost, until then the device may already use the new size
+        for _ in range(3):
+            if stream_protocol.negotiate_link(serialPort, self.link, packetSize, 0, self.window):
+                return
+        self.linkTuner = None
+
+    def push_frame(self, rawData:bytes, width:int, height:int):
+        self._sequence += 1
+        self.receivedFrames += 1
+        metrics.registry.count("frames_received")
+        frame = ReceivedFrame(
+            data=rawData,
+            width=width,
+            height=height,
+            sequence=self._sequence,
+            receivedTime=time.perf_counter()
+        )
+        self.ringBuffer.push(frame)
+
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.add_frame(frame)
+
+    def receive_frame(self, serialPort:serial.Serial):
+        frameSize = self.width*self.height*2
+        packetSize = frameSize//self.packetCount
+
+        startTime = time.perf_counter()
+
+        rawData = bytearray()
+
+        serialPort.write("continue\n".encode("utf-8"))
+
+        while len(rawData) != frameSize:
+            if self._stopEvent.is_set():
+                return
+            packet = serialPort.read(packetSize)
+            metrics.registry.count("serial_bytes", len(packet))
+            if len(packet) == packetSize:
+                rawData += packet
+                serialPort.write("continue\n".encode("utf-8"))
+            else:
+                metrics.registry.count("retries")
+                serialPort.write("retry\n".encode("utf-8"))
+
+            if (time.perf_counter() - startTime)*1000 > self.timeoutMs:
+                metrics.registry.count("timeouts")
+                self.timeouts += 1
+                return
+
+        serialPort.write("end\n".encode("utf-8"))
+
+        self.push_frame(bytes(rawData), self.width, self.height)
@@ -0,0 +1,159 @@
+# Records the received live stream to disk, either as .binFrame files or as one .binFrames archive
+#
+# The receiver thread only puts frames into a bounded queue. Compression and disk writes happen on the
+# writer thread, so they never delay the reception. If the writer falls behind, new frames are dropped and counted.
+
+import os
+
+import queue
+
+import threading
+
+import zlib
+
+import numpy as np
+
+import binframe
+
+import pixel_formats
+
+import binframe_archive
+
+from stream_receiver import ReceivedFrame
+
+
+class StreamRecorder(threading.Thread):
+    """
+    Writes every frame passed to add_frame() as a .binFrame with a sequential id, V1 unless it is stored in an indexed pixel format.
+    The frameTime of a frame is the measured time until the next recorded frame, so it is written
+    only once that frame arrives. The last frame keeps a frameTime of 0.
+    Arguments:
+        path: directory for .binFrame files, or the path of the new archive if archive is True
+        compressLevel (int): GZIP compression level 1-9, None to store the frames uncompressed
+        queueSize (int): number of frames that may wait for the writer
+        mergeDuplicates (bool): do not write frames identical to the frame before them, that frame is shown longer instead
+        indexedColors (bool): store frames with at most 256 colors as V2 frames with a palette and 8, 4 or 1 bits per pixel
+        checksums (bool): store the CRC32 of each payload in its header, so frame_fsck.py can find damaged frames
+    """
+    def __init__(self, path, archive:bool = False, compressLevel:int = None, queueSize:int = 64, gzip_wbits:int = 31, mergeDuplicates:bool = True,
+                 indexedColors:bool = False, checksums:bool = True):
+        super().__init__(name="StreamRecorder", daemon=True)
+        self.path = path
+        self.archive = archive
+        self.compressLevel = compressLevel
+        self.gzip_wbits = gzip_wbits
+        self.mergeDuplicates = mergeDuplicates
+        self.indexedColors = indexedColors
+        self.checksums = checksums
+
+        self.recordedFrames = 0
+        self.droppedFrames = 0
+        self.duplicateFrames = 0
+        self.indexedFrames = 0
+        self.writtenBytes = 0
+        # Set if writing failed, the recording stops then
+        self.error = None
+
+        self._queue = queue.Queue(maxsize=queueSize)
+        self._closed = False
+
+        if archive:
+            self._writer = binframe_archive.BinFramesWriter(path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._writer = None
+
+        self.start()
+
+    def add_frame(self, frame:ReceivedFrame):
+        """
+        Called from the receiver thread, never blocks.
+        """
+        if self._closed or self.error is not None:
+            return
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.droppedFrames += 1
+
+    @property
+    def queuedFrames(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        """
+        Writes the frames that are still queued and finishes the recording.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        pending = None
+        pendingDigest = None
+        frame = None
+        try:
+            while True:
+                frame = self._queue.get()
+                if frame is None:
+                    break
+                if self.mergeDuplicates:
+                    digest = binframe.frame_digest(frame["data"])
+                    if digest == pendingDigest:
+                        # Skipped, so the frameTime of the pending frame lasts until the next different frame
+                        self.duplicateFrames += 1
+                        continue
+                    pendingDigest = digest
+                if pending is not None:
+                    # At least 1 ms, because a frameTime of 0 would mark the frame as a screenshot
+                    self.write_frame(pending, max(1, round((frame["receivedTime"] - pending["receivedTime"])*1000)))
+                pending = frame
+            if pending is not None:
+                self.write_frame(pending, 0)
+        except (OSError, ValueError) as e:
+            self.error = e
+            # Discard the frames queued in the meantime until close() is called
+            while frame is not None:
+                frame = self._queue.get()
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+
+    def write_frame(self, frame:ReceivedFrame, frameTime:int):
+        payload = frame["data"]
+        pixelFormat = None
+        if self.indexedColors:
+            values565 = np.frombuffer(payload, dtype='>u2').reshape((frame["height"], frame["width"]))
+            pixelFormat, palette = pixel_formats.smallest_format(values565)
+            if pixelFormat.id == pixel_formats.rgb565BE:
+                pixelFormat = None
+            else:
+                payload = pixelFormat.encode(values565, palette)
+                self.indexedFrames += 1
+
+        wbits = None
+        if self.compressLevel is not None:
+            wbits = self.gzip_wbits
+            compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, wbits)
+            payload = compressor.compress(payload) + compressor.flush()
+
+        payloadCrc = zlib.crc32(payload) if self.checksums else None
+        if pixelFormat is None:
+            header = binframe.pack_header(frame["width"], frame["height"], self.recordedFrames, frameTime, wbits, False, payloadCrc)
+        else:
+            header = binframe.pack_header_v2(frame["width"], frame["height"], self.recordedFrames, frameTime, wbits, False,
+                                             pixelFormat.id, palette, payloadCrc)
+
+        if self._writer is not None:
+            self._writer.add_frame(header + payload)
+        else:
+            # Renamed once complete, so a viewer refreshing the directory never sees a partially written frame
+            path = f"{self.path}/frame_{self.recordedFrames:06d}.binFrame"
+            with open(path + ".part", 'wb') as f:
+                f.write(header)
+                f.write(payload)
+            os.replace(path + ".part", path)
+        self.recordedFrames += 1
+        self.writtenBytes += len(header) + len(payload)
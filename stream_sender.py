@@ -0,0 +1,192 @@
+# Reference device side sender of the live stream protocol version 2 (see "Stream protocol info.md")
+#
+# The module only uses what MicroPython provides, so it can be copied to the PICO as it is (together with delta_codec.py).
+# It also runs on a PC, where stream_protocol.py uses it for its loopback check.
+
+import struct
+
+try:
+    from binascii import crc32
+except ImportError:
+    from zlib import crc32
+
+import delta_codec
+
+
+protocolVersion = 2
+packetMagic = b"\xa5\x5a"
+deltaPacketMagic = b"\xa5\x5d"
+
+
+class StreamSender():
+    """
+    Arguments:
+        read (function): returns the bytes received so far without blocking (b"" if there are none)
+        write (function): sends bytes to the host
+        getFrame (function): returns the current frame as a bytes-like object of width*height*2 bytes (big-endian RGB565)
+        delta (bool): send only the changes against the frame the host already has.
+            This keeps copies of the last sent frame and of the frame being sent, which cost 2*width*height*2 bytes of RAM.
+        maxPacketSize (int): largest packet size the host may ask for with the link command
+        setBaudrate (function): optional, switches the UART to another baud rate. Without it the device is treated as USB CDC.
+        baudrates (tuple): the baud rates setBaudrate supports
+    """
+    def __init__(self, read, write, width, height, getFrame, packetSize=7200, delta=True, tileSize=16, maxPacketSize=16384, setBaudrate=None, baudrates=()):
+        self._read = read
+        self._write = write
+        self.width = width
+        self.height = height
+        self.getFrame = getFrame
+        self.packetSize = packetSize
+        self.delta = delta
+        self.tileSize = tileSize
+        self.maxPacketSize = maxPacketSize
+        self.setBaudrate = setBaudrate
+        self.baudrates = baudrates
+        # Baud rate set by the link command, 0 while it was not changed or for USB CDC
+        self.baudrate = 0
+
+        self._lineBuffer = b""
+        self._frame = None
+        self._magic = packetMagic
+        self._packetCount = 0
+        # A new packet size only applies from the next frame on
+        self._framePacketSize = packetSize
+        self._frameNumber = 0
+        # Copy of the last frame that was sent and its number, deltas are encoded against it
+        self._previousFrame = bytearray(width*height*2) if delta else None
+        self._previousFrameNumber = None
+        # Snapshot of the frame being sent, so changes of the framebuffer during the transfer or before a retransmit
+        # cannot make the host hold another frame than the one deltas are encoded against
+        self._currentFrame = bytearray(width*height*2) if delta else None
+        self._window = 1
+        # Packets below base were acknowledged, packets below next were sent at least once
+        self._base = 0
+        self._next = 0
+        self._retransmitQueue = []
+
+    def poll(self):
+        """
+        Handles the received commands and sends at most one packet.
+        Call it in a loop. Returns True if there was anything to do.
+        """
+        busy = False
+
+        data = self._read()
+        if data:
+            busy = True
+            self._lineBuffer += data
+            while b"\n" in self._lineBuffer:
+                line, self._lineBuffer = self._lineBuffer.split(b"\n", 1)
+                self._handle_line(line)
+
+        if self._frame is None:
+            return busy
+
+        if len(self._retransmitQueue) > 0:
+            self._send_packet(self._retransmitQueue.pop(0))
+            return True
+
+        if self._next < self._packetCount and self._next < self._base + self._window:
+            self._send_packet(self._next)
+            self._next += 1
+            return True
+
+        return busy
+
+    def _handle_line(self, line):
+        fields = line.split()
+        if len(fields) == 0:
+            return
+
+        try:
+            if fields[0] == b"hello" and len(fields) == 2:
+                if int(fields[1]) >= protocolVersion:
+                    self._write(("HELLO %d %d %d %d%s\n" % (protocolVersion, self.width, self.height, self.packetSize, " delta" if self.delta else "")).encode())
+            elif fields[0] == b"frame" and len(fields) in (3, 4):
+                baseFrameNumber = int(fields[3]) if len(fields) == 4 else None
+                self._start_frame(int(fields[1]) & 0xFFFF, max(1, int(fields[2])), baseFrameNumber)
+            elif fields[0] == b"ack" and len(fields) == 2:
+                self._base = max(self._base, min(int(fields[1]), self._packetCount))
+            elif fields[0] == b"nak" and len(fields) == 2:
+                sequence = int(fields[1])
+                # Packets that were not sent yet will be sent anyway
+                if self._frame is not None and sequence < self._next and sequence not in self._retransmitQueue:
+                    self._retransmitQueue.append(sequence)
+            elif fields[0] == b"end":
+                self._frame = None
+            elif fields[0] == b"link" and len(fields) == 3:
+                self._change_link(int(fields[1]), int(fields[2]))
+        except ValueError:
+            pass
+
+    def _change_link(self, packetSize, baudrate):
+        self.packetSize = max(64, min(packetSize, self.maxPacketSize))
+        newBaudrate = 0
+        if self.setBaudrate is not None and baudrate > 0:
+            # The fastest supported baud rate that does not exceed the requested one
+            for supported in self.baudrates:
+                if newBaudrate < supported <= baudrate:
+                    newBaudrate = supported
+        if newBaudrate == 0:
+            newBaudrate = self.baudrate
+        self._write(("LINK %d %d %d\n" % (self.packetSize, self.maxPacketSize, newBaudrate)).encode())
+        # Switched after the answer, which the host still receives at the old baud rate
+        if newBaudrate != self.baudrate:
+            self.baudrate = newBaudrate
+            self.setBaudrate(newBaudrate)
+
+    def _start_frame(self, frameNumber, window, baseFrameNumber):
+        frame = self.getFrame()
+        payload = None
+        if self.delta:
+            self._currentFrame[:] = frame
+            frame = self._currentFrame
+            # The host holds the last sent frame, so only the changes are needed
+            if baseFrameNumber is not None and baseFrameNumber == self._previousFrameNumber:
+                payload = delta_codec.encode_delta(self._previousFrame, frame, self.width, self.height, self.tileSize)
+            # The snapshot becomes the base of the next delta, the old base is overwritten by the next snapshot
+            self._previousFrame, self._currentFrame = self._currentFrame, self._previousFrame
+            self._previousFrameNumber = frameNumber
+
+        if payload is None:
+            self._magic = packetMagic
+            payload = frame
+        else:
+            self._magic = deltaPacketMagic
+
+        self._frame = memoryview(payload)
+        self._framePacketSize = self.packetSize
+        self._packetCount = (len(payload) + self.packetSize - 1)//self.packetSize
+        self._frameNumber = frameNumber
+        self._window = window
+        self._base = 0
+        self._next = 0
+        self._retransmitQueue = []
+
+    def _send_packet(self, sequence):
+        payload = self._frame[sequence*self._framePacketSize:(sequence + 1)*self._framePacketSize]
+        header = struct.pack(">HHHH", self._frameNumber, sequence, self._packetCount, len(payload))
+        crc = crc32(payload, crc32(header)) & 0xFFFFFFFF
+        self._write(self._magic + header + struct.pack(">I", crc))
+        self._write(payload)
+
+
+def run_over_usb(getFrame, width=240, height=240, packetSize=7200, delta=True):
+    """
+    Serves frames to the host over the USB serial port of the PICO (MicroPython only).
+    """
+    import sys
+    import select
+
+    poller = select.poll()
+    poller.register(sys.stdin, select.POLLIN)
+
+    def read():
+        data = b""
+        while poller.poll(0):
+            data += sys.stdin.buffer.read(1)
+        return data
+
+    sender = StreamSender(read, sys.stdout.buffer.write, width, height, getFrame, packetSize, delta)
+    while True:
+        sender.poll()
@@ -0,0 +1,544 @@
+# Rebroadcasts the live stream of a GamePico to any number of local viewers over HTTP
+#
+# Usage: python stream_server.py [serial port] [--http-port 8080] [--bind 127.0.0.1] [--jpeg-quality 80]
+# Without a serial port the first GamePico found is used. display_stream.py can run the same server next to its window.
+#
+#   /              viewer page (MJPEG image and a WebSocket canvas)
+#   /stream.mjpg   MJPEG stream (multipart/x-mixed-replace), playable by browsers, VLC, ffmpeg, OpenCV
+#   /frame.jpg     the newest frame as one JPEG
+#   /ws            WebSocket sending every frame as one binary message: sequence (int32), width and height (int16),
+#                  then the big-endian RGB565 data (all integers big-endian)
+#   /stats         counters as JSON
+#
+# Every frame is converted into each output format at most once, however many viewers are connected. Viewers always get
+# the newest frame: a slow viewer skips frames, nothing is queued for it. Only the Python standard library and Pillow are used.
+#
+# Running this file with --check streams from a fake device on a pseudo terminal to several local viewers and checks them.
+
+import argparse
+
+import base64
+
+import hashlib
+
+import io
+
+import json
+
+import select
+
+import struct
+
+import threading
+
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+import rgb565
+
+import metrics
+
+from stream_receiver import ReceivedFrame
+
+
+mjpegBoundary = "gamepicoframe"
+# Sequence, width, height in front of the RGB565 data of a WebSocket message
+wsFrameHeaderStruct = struct.Struct(">IHH")
+# Defined by RFC 6455 for the Sec-WebSocket-Accept header
+wsGuid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+viewerPage = """<!DOCTYPE html>
+<html>
+<head><title>GamePico live stream</title></head>
+<body style="background:#222;color:#ddd;font-family:monospace">
+<p>MJPEG:</p>
+<img src="/stream.mjpg" style="image-rendering:pixelated;width:480px">
+<p>WebSocket (raw RGB565): <span id="fps"></span></p>
+<canvas id="view" style="image-rendering:pixelated;width:480px"></canvas>
+<script>
+const canvas = document.getElementById("view");
+const context = canvas.getContext("2d");
+const socket = new WebSocket("ws://" + location.host + "/ws");
+socket.binaryType = "arraybuffer";
+let frames = 0;
+socket.onmessage = (event) => {
+    const view = new DataView(event.data);
+    const width = view.getUint16(4), height = view.getUint16(6);
+    if (canvas.width != width || canvas.height != height) { canvas.width = width; canvas.height = height; }
+    const image = context.createImageData(width, height);
+    for (let i = 0; i < width*height; i++) {
+        const value = view.getUint16(8 + i*2);
+        image.data[i*4] = (value >> 11) * 255 / 31;
+        image.data[i*4 + 1] = ((value >> 5) & 63) * 255 / 63;
+        image.data[i*4 + 2] = (value & 31) * 255 / 31;
+        image.data[i*4 + 3] = 255;
+    }
+    context.putImageData(image, 0, 0);
+    frames++;
+};
+setInterval(() => { document.getElementById("fps").textContent = frames + " FPS"; frames = 0; }, 1000);
+</script>
+</body>
+</html>
+"""
+
+
+class FrameBroadcaster():
+    """
+    Holds the newest frame for any number of viewers. A frame is converted into an output format when the first viewer
+    asks for it in that format, all other viewers get the same result. Publishing never waits for an encoder.
+    Arguments:
+        jpegQuality (int): quality of the MJPEG and JPEG outputs
+    """
+    def __init__(self, jpegQuality:int = 80):
+        self.jpegQuality = jpegQuality
+        self.encoders = {"rgb888": self._encode_rgb888, "jpeg": self._encode_jpeg, "rgb565": self._encode_rgb565}
+
+        self._condition = threading.Condition()
+        self._frame = None
+        self._sequence = 0
+        self.closed = False
+        # Format -> (sequence, encoded data) of the newest frame encoded in it
+        self._encoded = {}
+        # One lock per format, so viewers of the same format wait for one encoder instead of all encoding the frame
+        self._encodeLocks = {format: threading.Lock() for format in self.encoders}
+
+        self.publishedFrames = 0
+        self.encodedFrames = {format: 0 for format in self.encoders}
+
+    def publish(self, frame:ReceivedFrame):
+        with self._condition:
+            self._frame = frame
+            self._sequence += 1
+            self.publishedFrames += 1
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Wakes all waiting viewers, so their connections end.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def wait_for_frame(self, lastSequence:int, timeout:float = None) -> int:
+        """
+        Returns:
+            int: the sequence number of the newest frame once it is newer than lastSequence,
+                lastSequence after the timeout or once the broadcaster was closed
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.closed or self._sequence > lastSequence, timeout)
+            return lastSequence if self.closed else self._sequence
+
+    def get(self, format:str) -> tuple:
+        """
+        Returns:
+            tuple: (sequence number, the newest frame in the format), (0, None) before the first frame
+        """
+        with self._condition:
+            sequence = self._sequence
+            frame = self._frame
+        if frame is None:
+            return (0, None)
+        return (sequence, self._encoded_frame(format, sequence, frame))
+
+    def _encoded_frame(self, format:str, sequence:int, frame:ReceivedFrame):
+        cached = self._encoded.get(format)
+        if cached is not None and cached[0] >= sequence:
+            return cached[1]
+        with self._encodeLocks[format]:
+            # Another viewer may have encoded it while this one waited
+            cached = self._encoded.get(format)
+            if cached is not None and cached[0] >= sequence:
+                return cached[1]
+            with metrics.registry.timer(f"encode_{format}"):
+                data = self.encoders[format](sequence, frame)
+            self._encoded[format] = (sequence, data)
+            self.encodedFrames[format] += 1
+            return data
+
+    def _encode_rgb888(self, sequence:int, frame:ReceivedFrame):
+        return rgb565.convert_buffer(frame["data"], frame["width"], frame["height"])
+
+    def _encode_jpeg(self, sequence:int, frame:ReceivedFrame) -> bytes:
+        output = io.BytesIO()
+        Image.fromarray(self._encoded_frame("rgb888", sequence, frame), 'RGB').save(output, "JPEG", quality=self.jpegQuality)
+        return output.getvalue()
+
+    def _encode_rgb565(self, sequence:int, frame:ReceivedFrame) -> bytes:
+        return wsFrameHeaderStruct.pack(sequence & 0xFFFFFFFF, frame["width"], frame["height"]) + bytes(frame["data"])
+
+    def stats(self) -> dict:
+        return {"publishedFrames": self.publishedFrames, "encodedFrames": dict(self.encodedFrames)}
+
+
+def websocket_accept(key:str) -> str:
+    return base64.b64encode(hashlib.sha1((key + wsGuid).encode("ascii")).digest()).decode("ascii")
+
+
+def websocket_header(opcode:int, length:int) -> bytes:
+    # Unmasked frame with the FIN bit set, as sent by a server
+    if length < 126:
+        return struct.pack(">BB", 0x80 | opcode, length)
+    if length < 65536:
+        return struct.pack(">BBH", 0x80 | opcode, 126, length)
+    return struct.pack(">BBQ", 0x80 | opcode, 127, length)
+
+
+def read_websocket_frame(stream) -> tuple:
+    """
+    Reads one frame sent by a client (always masked).
+    Returns:
+        tuple: (opcode, payload), opcode 8 (close) if the connection ended
+    """
+    header = stream.read(2)
+    if len(header) < 2:
+        return (8, b"")
+    opcode = header[0] & 0x0F
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", stream.read(2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", stream.read(8))[0]
+    mask = stream.read(4) if header[1] & 0x80 else bytes(4)
+    payload = bytearray(stream.read(length))
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return (opcode, bytes(payload))
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    # Set on the server by StreamServer
+    server: "StreamHTTPServer"
+    # A viewer that stops reading is disconnected after this time instead of holding its thread forever
+    timeout = 30
+
+    def log_message(self, format, *args):
+        # Every viewer reconnecting would otherwise print a line
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/":
+            self.send_bytes(viewerPage.encode("utf-8"), "text/html; charset=utf-8")
+        elif path == "/frame.jpg":
+            self.send_snapshot()
+        elif path == "/stream.mjpg":
+            self.send_mjpeg()
+        elif path == "/ws":
+            self.send_websocket()
+        elif path == "/stats":
+            self.send_bytes(json.dumps(self.server.stats()).encode("utf-8"), "application/json")
+        else:
+            self.send_error(404)
+
+    def send_bytes(self, data:bytes, contentType:str):
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_snapshot(self):
+        broadcaster = self.server.broadcaster
+        if broadcaster.wait_for_frame(0, self.server.frameWait_s) == 0:
+            self.send_error(503, "No frame was received yet")
+            return
+        self.send_bytes(broadcaster.get("jpeg")[1], "image/jpeg")
+
+    def frames(self, format:str):
+        """
+        Generator of the newest frames in a format until the server stops. Frames that arrive while
+        the previous one is still being sent are skipped, only the newest one is sent next.
+        """
+        broadcaster = self.server.broadcaster
+        sequence = 0
+        while not broadcaster.closed:
+            newSequence = broadcaster.wait_for_frame(sequence, self.server.frameWait_s)
+            if newSequence == sequence:
+                yield None
+                continue
+            sequence, data = broadcaster.get(format)
+            yield data
+
+    def send_mjpeg(self):
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={mjpegBoundary}")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        with self.server.track_client("mjpeg"):
+            try:
+                for data in self.frames("jpeg"):
+                    if data is None:
+                        continue
+                    self.wfile.write(f"--{mjpegBoundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(data)}\r\n\r\n".encode("ascii"))
+                    self.wfile.write(data)
+                    self.wfile.write(b"\r\n")
+                    metrics.registry.count("mjpeg_frames_sent")
+            except (ConnectionError, OSError):
+                pass
+
+    def send_websocket(self):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if self.headers.get("Upgrade", "").lower() != "websocket" or key is None:
+            self.send_error(400, "Expected a WebSocket handshake")
+            return
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", websocket_accept(key))
+        self.end_headers()
+        self.wfile.flush()
+
+        with self.server.track_client("websocket"):
+            try:
+                for data in self.frames("rgb565"):
+                    # The viewer only sends pings and the close frame, checked between frames without blocking
+                    if select.select([self.connection], [], [], 0)[0]:
+                        opcode, payload = read_websocket_frame(self.rfile)
+                        if opcode == 8:
+                            self.wfile.write(websocket_header(8, 0))
+                            return
+                        if opcode == 9:
+                            self.wfile.write(websocket_header(10, len(payload)) + payload)
+                    if data is None:
+                        continue
+                    self.wfile.write(websocket_header(2, len(data)))
+                    self.wfile.write(data)
+                    metrics.registry.count("websocket_frames_sent")
+            except (ConnectionError, OSError, struct.error):
+                pass
+
+
+class StreamHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address:tuple, broadcaster:FrameBroadcaster, frameWait_s:float = 1.0):
+        super().__init__(address, StreamRequestHandler)
+        self.broadcaster = broadcaster
+        # Longest wait for a new frame before a viewer connection checks whether the server stops or the viewer left
+        self.frameWait_s = frameWait_s
+        self.clients = {"mjpeg": 0, "websocket": 0}
+        self._clientsLock = threading.Lock()
+
+    def track_client(self, kind:str):
+        server = self
+
+        class ClientTracker():
+            def __enter__(self):
+                with server._clientsLock:
+                    server.clients[kind] += 1
+
+            def __exit__(self, *_):
+                with server._clientsLock:
+                    server.clients[kind] -= 1
+
+        return ClientTracker()
+
+    def stats(self) -> dict:
+        with self._clientsLock:
+            clients = dict(self.clients)
+        return {"clients": clients, **self.broadcaster.stats()}
+
+
+class StreamServer():
+    """
+    Runs the HTTP server on a background thread. Frames are passed to publish(), e.g. from the GUI loop.
+    Arguments:
+        port (int): TCP port, 0 picks a free one (see `url`)
+        host (str): address to listen on, only this computer by default
+    """
+    def __init__(self, port:int = 8080, host:str = "127.0.0.1", jpegQuality:int = 80):
+        self.broadcaster = FrameBroadcaster(jpegQuality)
+        self.httpServer = StreamHTTPServer((host, port), self.broadcaster)
+        self.host, self.port = self.httpServer.server_address[:2]
+        self._thread = threading.Thread(target=self.httpServer.serve_forever, name="StreamServer", daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    def publish(self, frame:ReceivedFrame):
+        self.broadcaster.publish(frame)
+
+    def stop(self):
+        self.broadcaster.close()
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        self._thread.join()
+
+
+def run_headless(portName, httpPort:int, host:str, jpegQuality:int) -> int:
+    import port_discovery
+    import stream_receiver
+
+    server = StreamServer(httpPort, host, jpegQuality)
+    print(f"Serving the live stream on {server.url}")
+    ringBuffer = stream_receiver.FrameRingBuffer(3)
+    receiver = None
+    reconnectInterval_s = 2
+    try:
+        while True:
+            if receiver is None or not receiver.is_alive():
+                if receiver is not None:
+                    print(f"The connection to {receiver.portName} failed: {receiver.error}")
+                    time.sleep(reconnectInterval_s)
+                ports = [portName] if portName is not None else port_discovery.list_ports_sorted(onlyPico=True)
+                if len(ports) == 0:
+                    receiver = None
+                    time.sleep(reconnectInterval_s)
+                    continue
+                receiver = stream_receiver.SerialReceiver(ports[0], ringBuffer)
+                receiver.start()
+                print(f"Receiving from {ports[0]}")
+
+            frame = ringBuffer.pop_latest()
+            if frame is None:
+                time.sleep(0.002)
+                continue
+            server.publish(frame)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if receiver is not None:
+            receiver.stop()
+        server.stop()
+
+
+def self_check(viewers:int = 4, duration_s:float = 2.0):
+    import os
+    import pty
+    import socket
+    import tty
+    import urllib.request
+
+    import numpy as np
+
+    import benchmark
+    import stream_receiver
+
+    width = 240
+    height = 240
+    rng = np.random.default_rng(0)
+    frames = [benchmark.generate_content("noise", width, height, i, rng) for i in range(5)]
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    device = benchmark.FakeGamePico(master, frames, width, height, protocol=2)
+    device.start()
+    ringBuffer = stream_receiver.FrameRingBuffer(3)
+    receiver = stream_receiver.SerialReceiver(os.ttyname(slave), ringBuffer)
+    receiver.start()
+    server = StreamServer(0)
+
+    received = {"mjpeg": 0, "websocket": 0}
+    errors = []
+    stopEvent = threading.Event()
+
+    def mjpeg_viewer():
+        with urllib.request.urlopen(server.url + "stream.mjpg") as response:
+            while not stopEvent.is_set():
+                line = response.readline()
+                if line.startswith(b"Content-Length:"):
+                    response.readline()
+                    Image.open(io.BytesIO(response.read(int(line.split(b":")[1])))).verify()
+                    received["mjpeg"] += 1
+
+    def websocket_viewer():
+        with socket.create_connection((server.host, server.port)) as connection:
+            key = base64.b64encode(os.urandom(16)).decode("ascii")
+            connection.sendall(f"GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                               f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode("ascii"))
+            stream = connection.makefile("rb")
+            response = b""
+            while not response.endswith(b"\r\n\r\n"):
+                response += stream.read(1)
+            if websocket_accept(key).encode("ascii") not in response:
+                raise AssertionError("Wrong Sec-WebSocket-Accept in the handshake")
+            while not stopEvent.is_set():
+                opcode, payload = read_websocket_frame(stream)
+                if opcode == 8:
+                    # The server stopped
+                    return
+                _, frameWidth, frameHeight = wsFrameHeaderStruct.unpack_from(payload)
+                if opcode != 2 or (frameWidth, frameHeight) != (width, height) or payload[wsFrameHeaderStruct.size:] not in frames:
+                    raise AssertionError("A WebSocket message does not contain a frame of the device")
+                received["websocket"] += 1
+            # Masked close frame, as sent by a client
+            connection.sendall(bytes((0x88, 0x80)) + bytes(4))
+
+    def run_viewer(viewer):
+        try:
+            viewer()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_viewer, args=(mjpeg_viewer if i % 2 == 0 else websocket_viewer,), daemon=True) for i in range(viewers)]
+    # A viewer that connects and never reads, it must not hold up the others or queue frames
+    stalledViewer = socket.create_connection((server.host, server.port))
+    stalledViewer.sendall(b"GET /stream.mjpg HTTP/1.0\r\n\r\n")
+    try:
+        for thread in threads:
+            thread.start()
+        startTime = time.perf_counter()
+        while time.perf_counter() - startTime < duration_s:
+            frame = ringBuffer.pop_latest()
+            if frame is None:
+                time.sleep(0.001)
+                continue
+            server.publish(frame)
+        with urllib.request.urlopen(server.url + "stats") as response:
+            stats = json.load(response)
+    finally:
+        stopEvent.set()
+        stalledViewer.close()
+        server.stop()
+        for thread in threads:
+            thread.join(5)
+        receiver.stop()
+        device.stop()
+        os.close(master)
+        os.close(slave)
+
+    if len(errors) > 0:
+        raise errors[0]
+    if received["mjpeg"] == 0 or received["websocket"] == 0:
+        raise AssertionError(f"A viewer did not receive any frames: {received}")
+    for format in ("jpeg", "rgb565"):
+        if stats["encodedFrames"][format] > stats["publishedFrames"]:
+            raise AssertionError(f"Frames were encoded as {format} more than once: {stats}")
+    print(f"Stream server check passed: {stats['publishedFrames']} frames published to {viewers + 1} viewers, "
+          f"{stats['encodedFrames']['jpeg']} JPEG and {stats['encodedFrames']['rgb565']} RGB565 encodes, "
+          f"{received['mjpeg']} MJPEG and {received['websocket']} WebSocket frames received")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receive the live stream of a GamePico and serve it to local viewers as MJPEG and over a WebSocket.")
+    parser.add_argument("port", nargs="?", default=None, help="serial port of the GamePico (default: the first GamePico found)")
+    parser.add_argument("--http-port", type=int, default=8080)
+    parser.add_argument("--bind", default="127.0.0.1", help="address to listen on, 0.0.0.0 for other computers too")
+    parser.add_argument("--jpeg-quality", type=int, default=80)
+    parser.add_argument("--check", action="store_true", help="stream from a fake device to local viewers and check them")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        self_check()
+        return 0
+    metricsWriter = metrics.start_writer_from_environment()
+    try:
+        return run_headless(args.port, args.http_port, args.bind, args.jpeg_quality)
+    finally:
+        if metricsWriter is not None:
+            metricsWriter.stop()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
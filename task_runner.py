@@ -0,0 +1,130 @@
+# Runs slow jobs (file I/O, decompression, conversion, exports) on worker threads
+# and hands their results back to the Tk main loop through `after`, so the GUI never blocks.
+
+import queue
+
+import sys
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task():
+    """
+    Handle of a submitted job. The job function receives it as its first argument
+    to report progress and to check whether it was cancelled.
+    """
+    def __init__(self, runner, onProgress):
+        self._runner = runner
+        self._onProgress = onProgress
+        self._cancelEvent = threading.Event()
+
+        # Only the newest progress value is delivered, no matter how often it is reported
+        self._progressLock = threading.Lock()
+        self._latestProgress = None
+        self._progressPosted = False
+
+    def cancel(self):
+        self._cancelEvent.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelEvent.is_set()
+
+    def check_cancelled(self):
+        if self._cancelEvent.is_set():
+            raise TaskCancelled()
+
+    def report_progress(self, done:int, total:int):
+        """
+        Called from the job. Raises TaskCancelled if the task was cancelled,
+        so it can be passed directly as a progress callback to long running functions.
+        """
+        self.check_cancelled()
+        if self._onProgress is None:
+            return
+
+        with self._progressLock:
+            self._latestProgress = (done, total)
+            if self._progressPosted:
+                return
+            self._progressPosted = True
+        self._runner._post(self._deliver_progress)
+
+    def _deliver_progress(self):
+        with self._progressLock:
+            progress = self._latestProgress
+            self._progressPosted = False
+        if not self.cancelled:
+            self._onProgress(*progress)
+
+
+class TkTaskRunner():
+    """
+    Thread pool bridged to a Tk window. Callbacks (onDone, onError, onProgress)
+    are always called on the Tk main thread. An exception in a callback is passed to
+    the report_callback_exception of the window and does not stop the runner.
+    """
+    def __init__(self, root, workers:int = 2, pollInterval_ms:int = 20):
+        self._root = root
+        self._pollInterval_ms = pollInterval_ms
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="TkTaskRunner")
+        self._events = queue.SimpleQueue()
+        self._activeTasks = 0
+        self._polling = False
+
+    def submit(self, function, *args, onDone = None, onError = None, onProgress = None) -> Task:
+        """
+        Runs function(task, *args) on a worker thread.
+        onDone receives the return value, onError the raised exception (TaskCancelled after a cancellation).
+        """
+        task = Task(self, onProgress)
+        self._activeTasks += 1
+        self._executor.submit(self._run, task, function, args, onDone, onError)
+
+        if not self._polling:
+            self._polling = True
+            self._root.after(self._pollInterval_ms, self._poll)
+        return task
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, task:Task, function, args, onDone, onError):
+        try:
+            task.check_cancelled()
+            result = function(task, *args)
+        except Exception as e:
+            self._post(self._finish, onError, e)
+        else:
+            self._post(self._finish, onDone, result)
+
+    def _finish(self, callback, value):
+        self._activeTasks -= 1
+        if callback is not None:
+            callback(value)
+
+    def _post(self, callback, *args):
+        self._events.put((callback, args))
+
+    def _poll(self):
+        while True:
+            try:
+                callback, args = self._events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception:
+                # Reported like an exception in any other Tk callback, the remaining events and the polling go on
+                self._root.report_callback_exception(*sys.exc_info())
+
+        if self._activeTasks > 0:
+            self._root.after(self._pollInterval_ms, self._poll)
+        else:
+            self._polling = False